@@ -0,0 +1,51 @@
+"""
+Per-slice latency of `Counts.__getitem__` with label keys. Run from the
+repository root with:
+    python -m benchmarks.bench_counts_slicing
+"""
+
+import timeit
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import random as sparse_random
+
+from cellforest import Counts
+
+N_CELLS = 200_000
+N_GENES = 2_000
+DENSITY = 0.01
+N_KEYS = [1, 1_000, 100_000]
+
+
+def build_counts(n_cells=N_CELLS, n_genes=N_GENES, density=DENSITY, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = sparse_random(n_cells, n_genes, density=density, format="csr", random_state=seed)
+    cell_ids = pd.DataFrame([f"CELL{i}-1" for i in range(n_cells)])
+    features = pd.DataFrame(
+        {0: [f"ENSG{i:011d}" for i in range(n_genes)], 1: [f"GENE{i % (n_genes - 100)}" for i in range(n_genes)]}
+    )
+    return Counts(matrix, cell_ids, features), rng
+
+
+def time_slice(counts, key, number):
+    return min(timeit.repeat(lambda: counts[key], number=number, repeat=3)) / number
+
+
+def main():
+    counts, rng = build_counts()
+    counts[:, "GENE0"]  # build label indices once, as in a slicing loop
+    print(f"Counts: {counts.shape[0]} cells x {counts.shape[1]} genes, nnz={counts.nnz}")
+    print(f"{'axis':<8}{'n_keys':>10}{'latency (ms)':>16}")
+    for n_keys in N_KEYS:
+        cells = counts.cell_ids.values[rng.choice(counts.shape[0], n_keys, replace=False)].tolist()
+        number = max(1, 100 // n_keys)
+        print(f"{'cells':<8}{n_keys:>10}{1e3 * time_slice(counts, cells, number):>16.3f}")
+    for n_keys in N_KEYS[:2]:
+        genes = counts.genes.values[rng.choice(counts.shape[1], n_keys, replace=False)].tolist()
+        number = max(1, 100 // n_keys)
+        print(f"{'genes':<8}{n_keys:>10}{1e3 * time_slice(counts, (slice(None), genes), number):>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
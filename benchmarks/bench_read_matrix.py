@@ -0,0 +1,57 @@
+"""
+Read time of a gzipped 10X `matrix.mtx.gz` with `read_mtx` versus
+`scipy.io.mmread`. Run from the repository root with:
+    python -m benchmarks.bench_read_matrix
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import io
+from scipy.sparse import random as sparse_random
+
+from cellforest.utils import compress
+from cellforest.utils.cellranger.matrix_market import read_mtx
+
+N_CELLS = 20_000
+N_GENES = 30_000
+DENSITY = 0.005
+N_WORKERS = [None, 2, 4]
+
+
+def write_lane(dirpath, n_cells=N_CELLS, n_genes=N_GENES, density=DENSITY, seed=0):
+    """Write a (features x cells) integer matrix, sorted by cell as 10X does"""
+    matrix = sparse_random(n_cells, n_genes, density=density, format="csr", random_state=seed)
+    matrix.data = np.ceil(matrix.data * 10)
+    filepath = Path(dirpath) / "matrix.mtx"
+    io.mmwrite(str(filepath), matrix.T.tocsc().astype(np.int64), field="integer")
+    compress(filepath, keep_orig=False)
+    return Path(str(filepath) + ".gz"), matrix.nnz
+
+
+def time_call(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath, nnz = write_lane(tmp)
+        print(f"matrix: {N_CELLS} cells x {N_GENES} genes, nnz={nnz}")
+        print(f"{'reader':<24}{'time (s)':>10}")
+        mm_time, expected = time_call(lambda: io.mmread(str(filepath)).T.tocsr(), repeat=1)
+        print(f"{'mmread + transpose':<24}{mm_time:>10.2f}")
+        for n_workers in N_WORKERS:
+            read_time, matrix = time_call(lambda: read_mtx(filepath, n_workers=n_workers))
+            assert (matrix != expected).nnz == 0
+            print(f"{f'read_mtx(n_workers={n_workers})':<24}{read_time:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Throughput of `Counts.reindex_features`, which conforms a lane to reference
+features by permuting its column indices. Run from the repository root with:
+    python -m benchmarks.bench_reindex_features
+"""
+
+import time
+
+import numpy as np
+
+from benchmarks.bench_counts_slicing import build_counts
+
+
+def main():
+    counts, rng = build_counts()
+    reference = counts.features.iloc[rng.permutation(counts.shape[1])].reset_index(drop=True)
+    print(f"Counts: {counts.shape[0]} cells x {counts.shape[1]} genes, nnz={counts.nnz}")
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        counts.reindex_features(reference)
+        times.append(time.perf_counter() - start)
+    elapsed = min(times)
+    nbytes = counts.indices.nbytes * 2  # indices read and rewritten
+    print(f"reindex_features: {elapsed * 1e3:.1f} ms ({nbytes / elapsed / 1e9:.2f} GB/s of indices)")
+    stacked = counts.vstack(counts.reindex_features(reference))
+    assert np.array_equal(stacked.indptr[-1], 2 * counts.nnz)
+
+
+if __name__ == "__main__":
+    main()
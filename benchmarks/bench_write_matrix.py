@@ -0,0 +1,59 @@
+"""
+Export time of a gzipped 10X `matrix.mtx.gz` with `write_mtx` versus
+`scipy.io.mmwrite` followed by a separate compression pass. Run from the
+repository root with:
+    python -m benchmarks.bench_write_matrix
+"""
+
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import io
+from scipy.sparse import random as sparse_random
+
+from cellforest.utils import compress
+from cellforest.utils.cellranger.matrix_market import write_mtx
+
+N_CELLS = 20_000
+N_GENES = 30_000
+DENSITY = 0.005
+N_WORKERS = [None, 2, 4]
+
+
+def build_matrix(n_cells=N_CELLS, n_genes=N_GENES, density=DENSITY, seed=0):
+    matrix = sparse_random(n_cells, n_genes, density=density, format="csr", random_state=seed)
+    matrix.data = np.ceil(matrix.data * 10)
+    return matrix.astype(np.int64)
+
+
+def time_call(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def mmwrite_compress(filepath, matrix):
+    io.mmwrite(str(filepath), matrix.T)
+    compress(filepath, keep_orig=False)
+
+
+def main():
+    matrix = build_matrix()
+    print(f"matrix: {N_CELLS} cells x {N_GENES} genes, nnz={matrix.nnz}")
+    print(f"{'writer':<26}{'time (s)':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        mm_time = time_call(lambda: mmwrite_compress(tmp / "mm.mtx", matrix), repeat=1)
+        print(f"{'mmwrite + compress':<26}{mm_time:>10.2f}")
+        for n_workers in N_WORKERS:
+            write_time = time_call(lambda: write_mtx(tmp / "matrix.mtx.gz", matrix, n_workers=n_workers))
+            print(f"{f'write_mtx(n_workers={n_workers})':<26}{write_time:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,14 @@ from cellforest.utils.r.Convert import Convert
 def hook_unify_matrix_node(dp):
     """
     If node has counts matrix output, ensure that all desired formats are
-    present (e.g. pickle, rds, anndata, cellranger)
+    present (e.g. columnar store, rds, anndata, cellranger). R reads and
+    writes the columnar store directly, so conversion doesn't go through Python
     """
-    # TODO: currently hardcoded to pickle and rds, but fix this later
+    # TODO: currently hardcoded to columnar store and rds, but fix this later
     if dp.matrix_layer:
-        pickle_path = dp.forest[dp.process_name].path_map["rna"]
+        store_path = dp.forest[dp.process_name].path_map["rna"]
         rds_path = dp.forest[dp.process_name].path_map["rna_r"]
-        if pickle_path.exists() and not rds_path.exists():
-            Convert.pickle_to_rds_dir(pickle_path.parent)
-        elif rds_path.exists() and not pickle_path.exists():
-            Convert.rds_to_pickle_dir(rds_path.parent)
+        if store_path.exists() and not rds_path.exists():
+            Convert.store_to_rds(store_path, rds_path)
+        elif rds_path.exists() and not store_path.exists():
+            Convert.rds_to_store(rds_path, store_path.parent / "meta.parquet", store_path)
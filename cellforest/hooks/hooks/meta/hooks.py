@@ -0,0 +1,7 @@
+from dataforest.hooks import hook
+
+
+@hook
+def hook_refresh_meta(dp):
+    """Marks `meta` to check for the new outputs of the process on next access"""
+    dp.forest.refresh_meta()
@@ -0,0 +1,30 @@
+from dataforest.hooks import hook
+
+from cellforest.utils.cache import ProcessCache
+
+
+@hook
+def hook_process_cache_key(dp):
+    """
+    Computes the `ProcessCache` key of the process from its inputs, before
+    the run adds downstream data to `meta`, for the `process_cache` wrapper
+    to restore from and `hook_store_process_cache` to store under
+    """
+    if ProcessCache.is_cached_process(dp.process_name):
+        keys = getattr(dp.forest, "_process_cache_keys", {})
+        keys[dp.process_name] = ProcessCache.get_key(dp.forest, dp.process_name)
+        dp.forest._process_cache_keys = keys
+
+
+@hook
+def hook_store_process_cache(dp):
+    """
+    Adds the outputs of the process to the `ProcessCache`, before they are
+    removed by `hook_clean_unversioned`, if `hook_process_cache_key` keyed it
+    and the forest is unversioned
+    """
+    key = getattr(dp.forest, "_process_cache_keys", {}).pop(dp.process_name, None)
+    if key is None or not ProcessCache.is_stored_forest(dp.forest):
+        return
+    cache = ProcessCache.from_forest(dp.forest)
+    cache.store(key, dp.forest[dp.process_name].path)
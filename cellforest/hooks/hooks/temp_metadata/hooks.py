@@ -8,13 +8,12 @@ from cellforest.templates.WriterMethodsSC import WriterMethodsSC
 @hook(attrs=["temp_metadata"])
 def hook_store_temp_metadata(dp):
     """
-    Stores a temporary metadata file in the current process
+    Stores a temporary metadata file in the current process, as parquet with
+    categorical columns, which both python and R processes read
     """
     if dp.temp_meta:
         dp._metadata_filepath = dp.forest[dp.process_name].path / dp.forest.schema.__class__.TEMP_METADATA_FILENAME
-        WriterMethodsSC.tsv(
-            dp._metadata_filepath, dp.forest[dp.process_name].forest.meta, header=True,
-        )
+        WriterMethodsSC.parquet(dp._metadata_filepath, dp.forest[dp.process_name].forest.meta)
 
 
 @hook(attrs=["temp_metadata"])
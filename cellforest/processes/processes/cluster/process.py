@@ -1,9 +1,21 @@
+import pandas as pd
 from dataforest.hooks import dataprocess
 
+from cellforest.processes.processes.cluster.snn import find_clusters, snn_graph
+from cellforest.processes.processes.reduce.knn import load_knn_graph
+from cellforest.utils.cache import process_cache
+from cellforest.utils.r.run_r_script import run_process_r_script
+
+_PY_METHODS = {"leiden_py": "leiden", "louvain_py": "louvain"}
+
 
 @dataprocess(requires="dim_reduce")
+@process_cache("cluster")
 def cluster(forest: "CellForest"):
     process_name = "cluster"
+    method = forest.spec[process_name].get("method")
+    if method in _PY_METHODS:
+        return _cluster_py(forest, process_name, _PY_METHODS[method])
     input_metadata_path = forest.get_temp_metadata_path(forest, process_name)
     input_rds_path = forest["dim_reduce"].path_map["dimred_r"]
     output_rds_path = forest[process_name].path_map["cluster_r"]
@@ -23,4 +35,23 @@ def cluster(forest: "CellForest"):
         r_functions_filepath,
     ]
     r_clusters_filepath = forest.schema.R_FILEPATHS["FIND_CLUSTERS_SCRIPT"]
-    ProcessMethodsSC._run_r_script(forest, r_clusters_filepath, arg_list, process_name)
+    run_process_r_script(forest, r_clusters_filepath, arg_list, process_name)
+
+
+def _cluster_py(forest: "CellForest", process_name: str, method: str):
+    """
+    SNN clustering from the cached kNN graph of `dim_reduce` at each of the
+    resolutions in `res` (a number or list), in one pass. `clusters` holds
+    the first resolution, in the format of `find_clusters.R`, and
+    `clusters_sweep` holds all of them, with a `res_<res>` column each
+    """
+    spec = forest.spec[process_name]
+    resolutions = spec["res"] if isinstance(spec["res"], (list, tuple)) else [spec["res"]]
+    knn = load_knn_graph(forest, spec.get("k", 20), num_pcs=spec["num_pcs"], exact=spec.get("knn_exact", False))
+    clusterings = find_clusters(snn_graph(knn), resolutions, method=method)
+    cell_ids = forest.f["normalize"]["cell_ids"][0]
+    clusters_df = pd.DataFrame({f"res_{res}": labels for res, labels in zip(resolutions, clusterings)})
+    clusters_df.index = cell_ids
+    path_map = forest[process_name].path_map
+    clusters_df.iloc[:, 0].to_csv(path_map["clusters"], sep="\t", header=False)
+    clusters_df.to_csv(path_map["clusters_sweep"], sep="\t")
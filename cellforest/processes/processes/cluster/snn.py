@@ -0,0 +1,64 @@
+import random
+from typing import Iterable, List
+
+import numpy as np
+from scipy.sparse import csr_matrix, triu
+
+PRUNE_SNN = 1 / 15
+
+
+def snn_graph(knn: csr_matrix, prune: float = PRUNE_SNN) -> csr_matrix:
+    """
+    Shared nearest neighbor graph of a `knn_graph`, as Seurat's
+    `FindNeighbors`: edges are weighted by the Jaccard index of the
+    neighborhoods of their cells, `shared / (2k - shared)`, from a single
+    sparse product of the binary kNN adjacency with its transpose. Edges
+    below `prune` and self loops are dropped
+    """
+    k = knn.indptr[1] - knn.indptr[0]
+    adjacency = csr_matrix((np.ones(knn.nnz, dtype=np.float64), knn.indices, knn.indptr), shape=knn.shape)
+    snn = (adjacency @ adjacency.T).tocsr()
+    snn.data /= 2 * k - snn.data
+    snn.setdiag(0)
+    snn.data[snn.data < prune] = 0
+    snn.eliminate_zeros()
+    return snn
+
+
+def find_clusters(snn: csr_matrix, resolutions: Iterable[float], method: str = "leiden", seed: int = 42) -> List:
+    """
+    Modularity clustering of `snn` at each of `resolutions`, building the
+    graph once. Cluster ids are ordered by decreasing size, as in Seurat
+    Args:
+        method: "leiden" or "louvain"
+    """
+    try:
+        import igraph
+    except ImportError as e:
+        raise ImportError("cluster methods `leiden_py` and `louvain_py` require `igraph` (pip install igraph)") from e
+
+    if method not in ["leiden", "louvain"]:
+        raise ValueError(f"method must be one of ['leiden', 'louvain']. Got: {method}")
+    upper = triu(snn, k=1).tocoo()
+    graph = igraph.Graph(n=snn.shape[0], edges=np.column_stack([upper.row, upper.col]).tolist())
+    weights = upper.data.tolist()
+    clusterings = []
+    for resolution in resolutions:
+        igraph.set_random_number_generator(random.Random(seed))
+        if method == "leiden":
+            communities = graph.community_leiden(
+                objective_function="modularity", weights=weights, resolution=resolution, n_iterations=-1
+            )
+        else:
+            communities = graph.community_multilevel(weights=weights, resolution=resolution)
+        clusterings.append(order_by_size(np.asarray(communities.membership)))
+    return clusterings
+
+
+def order_by_size(labels: np.ndarray) -> np.ndarray:
+    """Relabel clusters 0..n-1 by decreasing size, breaking ties by first appearance"""
+    _, first, inverse, sizes = np.unique(labels, return_index=True, return_inverse=True, return_counts=True)
+    rank = np.lexsort((first, -sizes))
+    new_ids = np.empty_like(rank)
+    new_ids[rank] = np.arange(len(rank))
+    return new_ids[inverse]
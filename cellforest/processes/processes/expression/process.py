@@ -1,11 +1,24 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
 from dataforest.hooks import dataprocess
 
+from cellforest.processes.processes.expression.wilcox import find_all_markers, find_markers
+from cellforest.processes.processes.normalize.process import PY_NORMALIZE_METHODS
+from cellforest.structures.Counts import Counts
+from cellforest.utils.cache import process_cache
+from cellforest.utils.r.run_r_script import run_process_r_script
+
 
 @dataprocess(requires="cluster")
+@process_cache("markers")
 def markers(forest: "CellForest"):
     process_name = "markers"
-    input_metadata_path = ProcessMethodsSC._get_temp_metadata_path(forest, process_name)
-    meta = forest.READER_METHODS.tsv(input_metadata_path, header=0)
+    if forest.spec[process_name]["test"] == "wilcox_py":
+        return _markers_py(forest, process_name)
+    input_metadata_path = forest.get_temp_metadata_path(forest, process_name)
+    meta = forest.READER_METHODS.parquet(input_metadata_path)
     cluster_counts = meta["cluster_id"].value_counts()
     deficient_clusters = cluster_counts[cluster_counts < 2].index.tolist()
     if deficient_clusters:
@@ -26,12 +39,15 @@ def markers(forest: "CellForest"):
         r_functions_filepath,
     ]
     r_find_markers = forest.schema.R_FILEPATHS["FIND_CLUSTER_MARKERS_SCRIPT"]
-    ProcessMethodsSC._run_r_script(forest, r_find_markers, arg_list, "markers")
+    run_process_r_script(forest, r_find_markers, arg_list, "markers")
 
 
 @dataprocess(requires="normalize", comparative=True)
+@process_cache("diffexp_bulk")
 def diffexp_bulk(forest: "CellForest"):
     process_name = "diffexp_bulk"
+    if forest.spec[process_name]["test"] == "wilcox_py":
+        return _diffexp_py(forest, process_name, "diffexp_bulk_result")
     input_metadata_path = forest.get_temp_metadata_path(forest, process_name)
     input_rds_path = forest["normalize"].path_map["matrix_r"]
     output_diffexp_path = forest[process_name].path_map["diffexp_bulk_result"]
@@ -56,13 +72,16 @@ def diffexp_bulk(forest: "CellForest"):
         r_functions_filepath,
     ]
     r_diff_exp_bulk_filepath = forest.schema.R_FILEPATHS["DIFF_EXP_BULK_SCRIPT"]
-    ProcessMethodsSC._run_r_script(forest, r_diff_exp_bulk_filepath, arg_list, process_name)
+    run_process_r_script(forest, r_diff_exp_bulk_filepath, arg_list, process_name)
 
 
 @dataprocess(requires="cluster", comparative=True)
+@process_cache("diffexp")
 def diffexp(forest: "CellForest"):
     # TODO: refactor both diffexp versions into `_get_diffexp_args`
     process_name = "diffexp"
+    if forest.spec[process_name]["test"] == "wilcox_py":
+        return _diffexp_py(forest, process_name, "diffexp_result")
     input_metadata_path = forest.get_temp_metadata_path(forest, process_name)
     input_rds_path = forest["cluster"].path_map["cluster_r"]
     output_diffexp_path = forest[process_name].path_map["diffexp_result"]
@@ -87,4 +106,42 @@ def diffexp(forest: "CellForest"):
         r_functions_filepath,
     ]
     r_diff_exp_filepath = forest.schema.R_FILEPATHS["DIFF_EXP_CLUSTER_SCRIPT"]
-    ProcessMethodsSC._run_r_script(forest, r_diff_exp_filepath, arg_list, process_name)
+    run_process_r_script(forest, r_diff_exp_filepath, arg_list, process_name)
+
+
+def _markers_py(forest: "CellForest", process_name: str):
+    """One-vs-rest markers of all clusters in a single vectorized pass, written to `markers`"""
+    rna, clusters = _load_normalized(forest, forest.meta["cluster_id"])
+    logfc_thresh = forest.spec[process_name]["logfc_thresh"]
+    markers_df = find_all_markers(rna, clusters, logfc_thresh=logfc_thresh)
+    markers_df.to_csv(forest[process_name].path_map["markers"], sep="\t", index=False)
+
+
+def _diffexp_py(forest: "CellForest", process_name: str, output_name: str):
+    """`partition_code` min vs max group markers, as the R `FindMarkers` call"""
+    meta = forest[process_name].forest.meta
+    groups = meta["partition_code"].unique().astype("O")
+    if len(groups) != 2:
+        raise ValueError(f"Exactly two groups required for {process_name}. Got: {groups}")
+    rna, partitions = _load_normalized(forest, meta["partition_code"])
+    logfc_thresh = forest.spec[process_name]["logfc_thresh"]
+    diffexp_df = find_markers(rna, partitions, groups.min(), groups.max(), logfc_thresh=logfc_thresh)
+    diffexp_df.to_csv(forest[process_name].path_map[output_name], sep="\t", index=False)
+
+
+def _load_normalized(forest: "CellForest", groups: pd.Series) -> Tuple[Counts, np.ndarray]:
+    """
+    Log-normalized `Counts` of a python `normalize` method, for the cells of
+    `groups` (indexed by `cell_id`) that have a group, along with their
+    groups, aligned to the rows of the `Counts`. Cells that normalize
+    filtered out are dropped
+    """
+    method = forest.spec["normalize"]["method"]
+    if method not in PY_NORMALIZE_METHODS:
+        raise ValueError(
+            f"`wilcox_py` requires normalize method in {PY_NORMALIZE_METHODS}, which save normalized `Counts`. "
+            f"Got: {method}"
+        )
+    groups = groups.dropna()
+    rna = Counts.load(forest["normalize"].path_map["rna"], cells=groups.index)
+    return rna, groups.reindex(rna.cell_ids).to_numpy()
@@ -0,0 +1,142 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix
+from scipy.stats import norm
+
+from cellforest.structures.Counts import Counts
+
+MIN_PCT = 0.1
+
+
+def find_all_markers(
+    counts: Counts, groups: np.ndarray, logfc_thresh: float = 0.25, min_pct: float = MIN_PCT
+) -> pd.DataFrame:
+    """
+    One-vs-rest Wilcoxon rank-sum markers of every group at once, as Seurat's
+    `FindAllMarkers` on log-normalized `counts`. Group means, detection
+    fractions and log fold changes come from sparse per-group sums, and
+    genes for which no group passes `logfc_thresh` and `min_pct` are dropped
+    before ranking. Genes are ranked once for all groups, with the zeros of
+    each gene as a single tie, so only the nonzero entries are sorted
+    Returns:
+        markers: one row per (group, gene) tested, with Seurat's columns
+            `p_val`, `avg_logFC`, `pct.1`, `pct.2`, `p_val_adj`, `cluster`,
+            and `gene`, sorted by group and p value
+    """
+    labels, codes = np.unique(np.asarray(groups), return_inverse=True)
+    n_cells, n_genes = counts.shape
+    matrix = csc_matrix(counts._matrix, dtype=np.float64)
+    gene_ids = np.repeat(np.arange(n_genes), np.diff(matrix.indptr))
+    group_ids = codes[matrix.indices]
+    n_group = np.bincount(codes, minlength=len(labels)).astype(np.float64)
+    n_rest = n_cells - n_group
+    group_sum, group_nnz = _group_sums(
+        np.expm1(matrix.data), matrix.data > 0, group_ids, gene_ids, len(labels), n_genes
+    )
+    total_sum, total_nnz = group_sum.sum(axis=0), group_nnz.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_fc = np.log1p(group_sum / n_group[:, None]) - np.log1p((total_sum - group_sum) / n_rest[:, None])
+        pct_1 = group_nnz / n_group[:, None]
+        pct_2 = (total_nnz - group_nnz) / n_rest[:, None]
+    passes = (np.maximum(pct_1, pct_2) >= min_pct) & (np.abs(log_fc) >= logfc_thresh)
+    tested = np.flatnonzero(passes.any(axis=0))
+    rank_sum, tie_sum = _rank_sums(matrix[:, tested], codes, len(labels))
+    p_val = _rank_sum_p(rank_sum, tie_sum, n_group, n_cells)
+    group_idx, gene_idx = np.nonzero(passes[:, tested])
+    markers = pd.DataFrame(
+        {
+            "p_val": p_val[group_idx, gene_idx],
+            "avg_logFC": log_fc[group_idx, tested[gene_idx]],
+            "pct.1": pct_1[group_idx, tested[gene_idx]],
+            "pct.2": pct_2[group_idx, tested[gene_idx]],
+            "p_val_adj": np.minimum(p_val[group_idx, gene_idx] * n_genes, 1),
+            "cluster": labels[group_idx],
+            "gene": counts.genes.to_numpy()[tested[gene_idx]],
+        }
+    )
+    return markers.sort_values(["cluster", "p_val"], kind="stable").reset_index(drop=True)
+
+
+def find_markers(
+    counts: Counts,
+    groups: np.ndarray,
+    ident1,
+    ident2: Optional = None,
+    logfc_thresh: float = 0.25,
+    min_pct: float = MIN_PCT,
+) -> pd.DataFrame:
+    """
+    Wilcoxon rank-sum markers of `ident1` against `ident2` (all other cells
+    if `None`), as Seurat's `FindMarkers`, indexed by gene
+    """
+    groups = np.asarray(groups)
+    if ident2 is None:
+        rows = np.arange(len(groups))
+    else:
+        rows = np.flatnonzero((groups == ident1) | (groups == ident2))
+    is_ident1 = groups[rows] == ident1
+    markers = find_all_markers(counts[rows], is_ident1, logfc_thresh, min_pct)
+    markers = markers[markers["cluster"]].drop(columns="cluster")
+    return markers.set_index("gene")
+
+
+def _group_sums(
+    values: np.ndarray, detected: np.ndarray, group_ids: np.ndarray, gene_ids: np.ndarray, n_groups: int, n_genes: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """(groups x genes) sums of `values` and counts of `detected` over the stored entries"""
+    keys = group_ids * n_genes + gene_ids
+    sums = np.bincount(keys, weights=values, minlength=n_groups * n_genes).reshape(n_groups, n_genes)
+    nnz = np.bincount(keys[detected], minlength=n_groups * n_genes).reshape(n_groups, n_genes)
+    return sums, nnz
+
+
+def _rank_sums(matrix: csc_matrix, codes: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (groups x genes) sums of the ranks of each group's cells within each gene
+    (ties averaged), and the tie correction `sum(t^3 - t)` of each gene. The
+    zeros of a gene share the average of the lowest ranks, so only the
+    nonzero entries, which are assumed positive, are sorted
+    """
+    n_cells, n_genes = matrix.shape
+    matrix = matrix.copy()
+    matrix.eliminate_zeros()
+    nnz = np.diff(matrix.indptr)
+    n_zero = n_cells - nnz
+    gene_ids = np.repeat(np.arange(n_genes), nnz)
+    order = np.lexsort((matrix.data, gene_ids))
+    values, genes = matrix.data[order], gene_ids[order]
+    # runs of equal values within a gene, and the positions of their starts within the gene
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (genes[1:] != genes[:-1])
+    run_ids = np.cumsum(new_run) - 1
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(values)))
+    position = run_starts - matrix.indptr[genes[run_starts]]
+    run_ranks = n_zero[genes[run_starts]] + position + (run_lengths + 1) / 2
+    ranks = run_ranks[run_ids]
+    keys = codes[matrix.indices[order]] * n_genes + genes
+    rank_sum = np.bincount(keys, weights=ranks, minlength=n_groups * n_genes).reshape(n_groups, n_genes)
+    group_nnz = np.bincount(keys, minlength=n_groups * n_genes).reshape(n_groups, n_genes)
+    n_group = np.bincount(codes, minlength=n_groups)
+    rank_sum += (n_group[:, None] - group_nnz) * (n_zero + 1) / 2
+    tie_sum = np.bincount(
+        genes[run_starts], weights=run_lengths.astype(np.float64) ** 3 - run_lengths, minlength=n_genes
+    )
+    tie_sum += n_zero.astype(np.float64) ** 3 - n_zero
+    return rank_sum, tie_sum
+
+
+def _rank_sum_p(rank_sum: np.ndarray, tie_sum: np.ndarray, n_group: np.ndarray, n_cells: int) -> np.ndarray:
+    """
+    Two-sided p values of R's `wilcox.test` with the normal approximation,
+    tie correction and continuity correction, for each group against the rest
+    """
+    n_1, n_2 = n_group[:, None], n_cells - n_group[:, None]
+    u = rank_sum - n_1 * (n_1 + 1) / 2
+    z = u - n_1 * n_2 / 2
+    sigma = np.sqrt(n_1 * n_2 / 12 * ((n_cells + 1) - tie_sum / (n_cells * (n_cells - 1))))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (z - np.sign(z) * 0.5) / sigma
+    return np.where(sigma > 0, 2 * norm.sf(np.abs(z)), 1)
@@ -1,12 +1,28 @@
 from dataforest.hooks import dataprocess
+import numpy as np
+from scipy.sparse import csr_matrix
 
 # TODO: what to do about core/utility methods? core module? move to utils?
+from cellforest.processes.processes.normalize.sctransform import sctransform
+from cellforest.processes.processes.normalize.seurat_default import filter_counts, seurat_default_normalize
+from cellforest.structures.Counts import Counts
+from cellforest.utils.cache import process_cache
+from cellforest.utils.cellranger import MtxQC
+from cellforest.utils.cellranger.matrix_market import write_mtx
 from cellforest.utils.r.run_r_script import run_process_r_script
 
+# methods which save normalized `Counts` (`rna`) and mark variable features in `variable_features`
+PY_NORMALIZE_METHODS = ("seurat_default_py", "sctransform_py")
+
 
 @dataprocess(requires="root", matrix_layer=True)
+@process_cache("normalize")
 def normalize(forest: "CellForest"):
     process_name = "normalize"
+    if forest.spec[process_name]["method"] == "seurat_default_py":
+        return _normalize_seurat_default_py(forest, process_name)
+    if forest.spec[process_name]["method"] == "sctransform_py":
+        return _normalize_sctransform_py(forest, process_name)
     input_metadata_path = forest.get_temp_metadata_path(process_name)
     # TODO: add a root filepaths lookup
     input_rds_path = forest.root_dir / "rna.rds"
@@ -39,5 +55,62 @@ def normalize(forest: "CellForest"):
         arg_list += [verbose, nfeatures]
         r_normalize_script = str(forest.schema.__class__.R_FILEPATHS["SEURAT_DEFAULT_NORMALIZE_SCRIPT"])
     else:
-        raise ValueError(f"Invalid normalization method: {method}. Use 'sctransform' or 'seurat_default'")
+        raise ValueError(
+            f"Invalid normalization method: {method}. Use 'sctransform', 'sctransform_py', 'seurat_default', or "
+            f"'seurat_default_py'"
+        )
     run_process_r_script(forest, r_normalize_script, arg_list, process_name)
+
+
+def _normalize_seurat_default_py(forest: "CellForest", process_name: str):
+    """
+    In-process `seurat_default` normalization on `Counts`, without R or matrix
+    serialization. Cells are filtered on the QC metrics in `meta` if it has them
+    """
+    spec = forest.spec[process_name]
+    rna, hvf = seurat_default_normalize(
+        forest.rna,
+        min_genes=spec["min_genes"],
+        max_genes=spec["max_genes"],
+        perc_mito_cutoff=spec["perc_mito_cutoff"],
+        nfeatures=spec["nfeatures"],
+        qc=_get_qc(forest),
+    )
+    path_map = forest[process_name].path_map
+    rna.save(path_map["rna"])
+    rna.cell_ids.to_csv(path_map["cell_ids"], sep="\t", header=False, index=False)
+    hvf.to_csv(path_map["variable_features"], sep="\t", index=False)
+
+
+def _normalize_sctransform_py(forest: "CellForest", process_name: str):
+    """
+    In-process `sctransform` normalization on `Counts`. Pearson residuals of
+    the variable features are saved as a float32 `.npy`, corrected counts as
+    a sparse `.mtx`, and their log1p as the normalized `rna`, as in the `SCT`
+    assay of Seurat
+    """
+    spec = forest.spec[process_name]
+    counts = filter_counts(
+        forest.rna,
+        min_genes=spec["min_genes"],
+        max_genes=spec["max_genes"],
+        min_cells=spec["min_cells"],
+        perc_mito_cutoff=spec["perc_mito_cutoff"],
+        qc=_get_qc(forest),
+    )
+    path_map = forest[process_name].path_map
+    corrected, model = sctransform(
+        counts, path_map["pearson_residual_npy"], nfeatures=spec["nfeatures"], n_workers=spec.get("n_workers")
+    )
+    write_mtx(path_map["corrected_umi"], corrected._matrix)
+    data = np.log1p(corrected.data, dtype=np.float64)
+    matrix = csr_matrix((data, corrected.indices, corrected.indptr), shape=corrected.shape, copy=False)
+    Counts(matrix, corrected.cell_ids, corrected.features).save(path_map["rna"])
+    corrected.cell_ids.to_csv(path_map["cell_ids"], sep="\t", header=False, index=False)
+    model.to_csv(path_map["variable_features"], sep="\t", index=False)
+
+
+def _get_qc(forest: "CellForest"):
+    """Per cell QC metrics computed on ingestion, if `meta` has them"""
+    meta = forest.meta
+    return meta[MtxQC.CELL_COLUMNS] if set(MtxQC.CELL_COLUMNS).issubset(meta.columns) else None
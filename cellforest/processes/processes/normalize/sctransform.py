@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix, hstack
+from scipy.special import digamma, polygamma
+
+from cellforest.structures.Counts import Counts
+
+N_GENES = 2000
+N_CELLS = 5000
+MIN_CELLS = 5
+BW_ADJUST = 3
+THETA_RANGE = (1e-3, 1e7)
+_CHUNK_ELEMENTS = 2**22
+_POISSON_ITER = 25
+_THETA_ITER = 10
+_OUTLIER_BINS = 20
+_OUTLIER_THRESHOLD = 10
+
+
+def sctransform(
+    counts: Counts,
+    residuals_path: Union[str, Path],
+    nfeatures: int = 3000,
+    n_genes: int = N_GENES,
+    n_cells: int = N_CELLS,
+    bw_adjust: float = BW_ADJUST,
+    n_workers: Optional[int] = None,
+    seed: int = 1448145,
+) -> Tuple[Counts, pd.DataFrame]:
+    """
+    Variance stabilizing transformation of `sctransform::vst`, as run by
+    Seurat's `SCTransform`, on sparse `Counts`:
+        1. negative binomial regressions of each gene's counts on log10 total
+           counts per cell, fit on a sample of `n_cells` cells and `n_genes`
+           genes (sampled evenly over the log10 geometric mean of genes)
+        2. parameters regularized by kernel regression on the log10 geometric
+           mean of genes, and predicted for all genes
+        3. Pearson residuals and corrected counts (every cell at the median
+           total counts) in chunks of genes, over `n_workers` threads
+    Residuals of the `nfeatures` genes of highest residual variance are
+    written to `residuals_path` as a float32, Fortran-ordered (cells x
+    nfeatures) `.npy`, in the order of the genes. Genes detected in fewer
+    than `MIN_CELLS` cells are dropped
+    Returns:
+        corrected: corrected counts, sparse
+        model: regularized parameters of each gene, residual mean and variance,
+            and a `variable` column marking the `nfeatures` genes
+    """
+    counts = counts[:, np.flatnonzero(np.bincount(counts.indices, minlength=counts.shape[1]) >= MIN_CELLS)]
+    matrix = counts._matrix
+    log_umi = np.log10(np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel())
+    log_gmean = get_log_gmean(matrix)
+    rng = np.random.default_rng(seed)
+    cells = np.sort(rng.choice(matrix.shape[0], min(n_cells, matrix.shape[0]), replace=False))
+    sampled_cells = matrix[cells]
+    # genes detected in too few of the sampled cells have no stable fit
+    detected = np.flatnonzero(np.bincount(sampled_cells.indices, minlength=matrix.shape[1]) >= MIN_CELLS)
+    genes = np.sort(detected[_sample_by_density(log_gmean[detected], n_genes, rng)])
+    y = sampled_cells[:, genes].toarray().astype(np.float64)
+    params = fit_nb(y, log_umi[cells])
+    params = regularize(params, log_gmean[genes], log_gmean, bw_adjust)
+    model = pd.DataFrame(params, columns=["intercept", "log_umi", "theta"])
+    model.insert(0, "log_gmean", log_gmean)
+    model.insert(0, "genes", counts.genes.to_numpy())
+    model.insert(0, "ensgs", counts.ensgs.to_numpy())
+    columns = matrix.tocsc()
+    chunks = _get_chunks(np.arange(matrix.shape[1]), matrix.shape[0])
+    with ThreadPoolExecutor(n_workers or 1) as executor:
+        results = list(executor.map(lambda x: _correct_chunk(columns, x, log_umi, params), chunks))
+        model["residual_mean"] = np.concatenate([r[0] for r in results])
+        model["residual_variance"] = np.concatenate([r[1] for r in results])
+        corrected = csr_matrix(hstack([r[2] for r in results], format="csc"))
+        variable = np.sort(np.argsort(-model["residual_variance"].to_numpy(), kind="stable")[:nfeatures])
+        # Fortran order, so that each chunk of genes is a contiguous range of the file
+        residuals = np.lib.format.open_memmap(
+            residuals_path, mode="w+", dtype=np.float32, shape=(matrix.shape[0], len(variable)), fortran_order=True
+        )
+        variable_chunks = _get_chunks(variable, matrix.shape[0])
+        offsets = np.cumsum([0] + [len(x) for x in variable_chunks])
+        tasks = zip(variable_chunks, offsets)
+        list(executor.map(lambda x: _write_residuals(residuals, columns, *x, log_umi, params), tasks))
+        residuals.flush()
+        del residuals
+    model["variable"] = False
+    model.loc[variable, "variable"] = True
+    return Counts(corrected, counts.cell_ids, counts.features), model
+
+
+def get_log_gmean(matrix: csr_matrix) -> np.ndarray:
+    """log10 of the geometric mean (with a pseudocount of 1) of each gene"""
+    log_sum = np.bincount(matrix.indices, weights=np.log1p(matrix.data), minlength=matrix.shape[1])
+    return np.log10(np.expm1(log_sum / matrix.shape[0]))
+
+
+def fit_nb(y: np.ndarray, log_umi: np.ndarray) -> np.ndarray:
+    """
+    (intercept, log_umi coefficient, theta) of each column of `y`: a Poisson
+    regression on `log_umi` by IRLS, then the maximum likelihood theta of the
+    negative binomial with those means (`MASS::theta.ml`), vectorized over genes
+    """
+    x = log_umi[:, None]
+    mean = y.mean(axis=0)
+    b0, b1 = np.log(mean) - np.log(10) * log_umi.mean(), np.full(y.shape[1], np.log(10))
+    for _ in range(_POISSON_ITER):
+        mu = np.exp(b0 + x * b1)
+        wz = mu * np.log(mu) + y - mu
+        s0, s1, s2 = mu.sum(axis=0), (mu * x).sum(axis=0), (mu * x**2).sum(axis=0)
+        t0, t1 = wz.sum(axis=0), (wz * x).sum(axis=0)
+        det = s0 * s2 - s1**2
+        b0_new, b1_new = (s2 * t0 - s1 * t1) / det, (s0 * t1 - s1 * t0) / det
+        converged = np.allclose(b0_new, b0, rtol=1e-8, atol=1e-8) and np.allclose(b1_new, b1, rtol=1e-8, atol=1e-8)
+        b0, b1 = b0_new, b1_new
+        if converged:
+            break
+    mu = np.exp(b0 + x * b1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        theta = len(y) / ((y / mu - 1) ** 2).sum(axis=0)
+        for _ in range(_THETA_ITER):
+            theta = np.clip(theta, *THETA_RANGE)
+            score = (digamma(y + theta) - digamma(theta) + np.log(theta) + 1 - np.log(theta + mu)).sum(axis=0)
+            score -= ((y + theta) / (mu + theta)).sum(axis=0)
+            info = (polygamma(1, theta) - polygamma(1, y + theta) - 1 / theta + 2 / (mu + theta)).sum(axis=0)
+            info -= ((y + theta) / (mu + theta) ** 2).sum(axis=0)
+            theta = theta + score / info
+    theta = np.clip(np.where(np.isfinite(theta), theta, THETA_RANGE[1]), *THETA_RANGE)
+    return np.column_stack([b0, b1, theta])
+
+
+def regularize(params: np.ndarray, log_gmean: np.ndarray, log_gmean_all: np.ndarray, bw_adjust: float) -> np.ndarray:
+    """
+    Parameters for genes at `log_gmean_all` by Nadaraya-Watson regression
+    with a normal kernel (R's `ksmooth`) of the parameters fit for genes at
+    `log_gmean`, with theta regularized on the log10 scale. Outlier fits are
+    excluded first. The bandwidth is `bw_adjust` times Silverman's rule
+    (`bw.nrd0`), rather than the Sheather-Jones bandwidth of `sctransform`
+    """
+    params = np.column_stack([params[:, :2], np.log10(params[:, 2])])
+    keep = np.isfinite(params).all(axis=1) & ~_is_outlier(params, log_gmean)
+    params, log_gmean = params[keep], log_gmean[keep]
+    iqr = np.subtract(*np.percentile(log_gmean, [75, 25]))
+    spread = min(log_gmean.std(ddof=1), iqr / 1.34) or log_gmean.std(ddof=1) or 1.0
+    bandwidth = bw_adjust * 0.9 * spread * len(log_gmean) ** -0.2
+    # `ksmooth` scales the normal kernel so that its quartiles are at +/- 0.25 * bandwidth
+    sd = 0.25 * bandwidth / 0.6744897501960817
+    regularized = np.empty((len(log_gmean_all), params.shape[1]))
+    step = max(1, _CHUNK_ELEMENTS // len(log_gmean))
+    for lo in range(0, len(log_gmean_all), step):
+        dist = (log_gmean_all[lo : lo + step, None] - log_gmean) / sd
+        # relative to the nearest fit gene, so that genes far outside the range aren't underflowed
+        weights = np.exp(-0.5 * (dist**2 - (dist**2).min(axis=1, keepdims=True)))
+        regularized[lo : lo + step] = weights @ params / weights.sum(axis=1, keepdims=True)
+    regularized[:, 2] = 10 ** regularized[:, 2]
+    return regularized
+
+
+def _is_outlier(params: np.ndarray, log_gmean: np.ndarray) -> np.ndarray:
+    """Fits over `_OUTLIER_THRESHOLD` robust standard deviations from the median of genes of similar mean"""
+    bins = np.digitize(log_gmean, np.linspace(log_gmean.min(), log_gmean.max(), _OUTLIER_BINS + 1)[1:-1])
+    outlier = np.zeros(len(log_gmean), dtype=bool)
+    for b in np.unique(bins):
+        rows = bins == b
+        median = np.median(params[rows], axis=0)
+        mad = 1.4826 * np.median(np.abs(params[rows] - median), axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = np.abs(params[rows] - median) / mad
+        outlier[rows] = (np.nan_to_num(score, nan=0) > _OUTLIER_THRESHOLD).any(axis=1)
+    return outlier
+
+
+def _sample_by_density(values: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+    """`n` indices of `values` sampled with probability inverse to their density"""
+    if n >= len(values):
+        return np.arange(len(values))
+    hist, edges = np.histogram(values, bins=512, density=True)
+    density = hist[np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(hist) - 1)]
+    weights = 1 / density
+    return rng.choice(len(values), n, replace=False, p=weights / weights.sum())
+
+
+def _get_chunks(genes: np.ndarray, n_cells: int) -> list:
+    step = max(1, _CHUNK_ELEMENTS // max(n_cells, 1))
+    return [genes[lo : lo + step] for lo in range(0, len(genes), step)]
+
+
+def _get_moments(params: np.ndarray, log_umi: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Expected counts and their variance in each cell, for genes with `params`"""
+    mu = np.exp(params[:, 0] + log_umi[:, None] * params[:, 1])
+    return mu, mu + mu**2 / params[:, 2]
+
+
+def _get_residuals(
+    columns: csc_matrix, genes: np.ndarray, log_umi: np.ndarray, params: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Unclipped Pearson residuals (cells x `genes`), dense"""
+    y = columns[:, genes].toarray().astype(np.float64)
+    mu, variance = _get_moments(params[genes], log_umi)
+    return (y - mu) / np.sqrt(variance)
+
+
+def _correct_chunk(
+    columns: csc_matrix, genes: np.ndarray, log_umi: np.ndarray, params: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, csc_matrix]:
+    """Residual mean and variance (of residuals clipped at sqrt(n_cells)), and corrected counts of `genes`"""
+    residuals = _get_residuals(columns, genes, log_umi, params)
+    mu_median, variance_median = _get_moments(params[genes], np.array([np.median(log_umi)]))
+    corrected = np.maximum(np.round(mu_median + residuals * np.sqrt(variance_median)), 0)
+    clip = np.sqrt(len(log_umi))
+    np.clip(residuals, -clip, clip, out=residuals)
+    return residuals.mean(axis=0), residuals.var(axis=0, ddof=1), csc_matrix(corrected.astype(np.int32))
+
+
+def _write_residuals(
+    out: np.ndarray, columns: csc_matrix, genes: np.ndarray, offset: int, log_umi: np.ndarray, params: np.ndarray
+):
+    clip = np.sqrt(len(log_umi))
+    residuals = _get_residuals(columns, genes, log_umi, params)
+    out[:, offset : offset + len(genes)] = np.clip(residuals, -clip, clip)
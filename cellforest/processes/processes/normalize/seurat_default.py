@@ -0,0 +1,256 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from cellforest.structures.Counts import Counts
+from cellforest.utils.cellranger.MtxQC import MITO_PATTERN
+
+SCALE_FACTOR = 1e4
+LOESS_SPAN = 0.3
+LOESS_CELL = 0.2
+_LOESS_CHUNK_SIZE = 256
+
+
+def seurat_default_normalize(
+    counts: Counts,
+    min_genes: int,
+    max_genes: int,
+    perc_mito_cutoff: float,
+    nfeatures: int,
+    qc: Optional[pd.DataFrame] = None,
+) -> Tuple[Counts, pd.DataFrame]:
+    """
+    In-process equivalent of `seurat_default_normalize.R` operating directly
+    on sparse `Counts`: cell filtering, `NormalizeData` (LogNormalize), and
+    `FindVariableFeatures` (vst).
+    All features are kept, since the R script doesn't apply `min_cells` to
+    `rna.rds`, which is created without `min.cells`.
+    If `qc` (`n_genes` and `percent_mito` of each cell, from ingestion by
+    `MtxQC`) is given, cells are filtered on it rather than recounted
+    Returns:
+        normalized: log-normalized `Counts` of the cells and features kept
+        hvf: variable feature statistics (as in Seurat's `HVFInfo`), with a
+            `variable` column marking the top `nfeatures`
+    """
+    counts = filter_counts(counts, min_genes, max_genes, perc_mito_cutoff, qc)
+    hvf = find_variable_features(counts, nfeatures)
+    return log_normalize(counts), hvf
+
+
+def filter_counts(
+    counts: Counts,
+    min_genes: int,
+    max_genes: int,
+    perc_mito_cutoff: float,
+    qc: Optional[pd.DataFrame] = None,
+    min_cells: Optional[int] = None,
+) -> Counts:
+    """
+    Cells passing the QC thresholds of `get_qc_mask`, and if `min_cells` is
+    given, features detected in at least `min_cells` of the input cells.
+    Detected genes are counted over all features, on `qc` (indexed by
+    `cell_id`) if given, or on `counts`
+    """
+    if qc is None:
+        n_genes, percent_mito = get_n_genes(counts), get_percent_mito(counts)
+    else:
+        qc = qc.reindex(counts.cell_ids)
+        if qc["n_genes"].isna().any():
+            raise ValueError(f"{qc['n_genes'].isna().sum()} cells of `counts` are missing from `qc`")
+        n_genes, percent_mito = qc["n_genes"].to_numpy(), qc["percent_mito"].to_numpy()
+    keep = get_qc_mask(n_genes, percent_mito, min_genes, max_genes, perc_mito_cutoff)
+    if min_cells is None:
+        return counts[np.flatnonzero(keep)]
+    return counts[np.flatnonzero(keep)][:, np.flatnonzero(get_n_cells(counts) >= min_cells)]
+
+
+def get_percent_mito(counts: Counts) -> np.ndarray:
+    """Fraction of counts per cell from mitochondrial genes, as `percent.mito` in R"""
+    mito = counts.genes.str.contains(MITO_PATTERN).to_numpy()
+    total = np.asarray(counts.sum(axis=1)).ravel()
+    mito_total = np.asarray(counts._matrix[:, mito].sum(axis=1)).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return mito_total / total
+
+
+def get_n_genes(counts: Counts) -> np.ndarray:
+    """Number of detected genes per cell (`nFeature_RNA`)"""
+    return np.diff(counts.indptr) - np.bincount(_row_ids(counts)[counts.data == 0], minlength=counts.shape[0])
+
+
+def get_n_cells(counts: Counts) -> np.ndarray:
+    """Number of cells in which each gene is detected"""
+    return np.bincount(counts.indices[counts.data != 0], minlength=counts.shape[1])
+
+
+def get_qc_mask(
+    n_genes: np.ndarray, percent_mito: np.ndarray, min_genes: int, max_genes: int, perc_mito_cutoff: float
+) -> np.ndarray:
+    """Cells with `min_genes` < `n_genes` < `max_genes` and `percent_mito` < `perc_mito_cutoff`"""
+    return (n_genes > min_genes) & (n_genes < max_genes) & (percent_mito < perc_mito_cutoff)
+
+
+def log_normalize(counts: Counts, scale_factor: float = SCALE_FACTOR) -> Counts:
+    """`log1p(count / total_counts * scale_factor)` per cell, computed on the nonzero entries only"""
+    total = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+    data = counts.data / total[_row_ids(counts)]
+    np.log1p(data * scale_factor, out=data)
+    matrix = csr_matrix((data, counts.indices, counts.indptr), shape=counts.shape, copy=False)
+    return Counts(matrix, counts.cell_ids, counts.features)
+
+
+def find_variable_features(counts: Counts, nfeatures: int, span: float = LOESS_SPAN) -> pd.DataFrame:
+    """
+    Seurat's vst selection: a loess fit of log10(variance) on log10(mean)
+    gives the expected variance of each gene, and the variance of the
+    standardized counts (clipped at sqrt(n_cells)) ranks the genes. Sparse
+    throughout, since the zeros of each gene contribute a closed-form term
+    """
+    n_cells, n_features = counts.shape
+    data = counts.data.astype(np.float64)
+    mean = np.bincount(counts.indices, weights=data, minlength=n_features) / n_cells
+    sum_sq = np.bincount(counts.indices, weights=data**2, minlength=n_features)
+    variance = (sum_sq - n_cells * mean**2) / (n_cells - 1)
+    not_const = variance > 0
+    variance_expected = np.zeros(n_features)
+    fitted = loess(np.log10(mean[not_const]), np.log10(variance[not_const]), span=span)
+    variance_expected[not_const] = 10**fitted
+    sd = np.sqrt(variance_expected)
+    clip_max = np.sqrt(n_cells)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.minimum((data - mean[counts.indices]) / sd[counts.indices], clip_max)
+        n_zero = n_cells - np.bincount(counts.indices, minlength=n_features)
+        sum_sq_std = np.bincount(counts.indices, weights=z**2, minlength=n_features) + n_zero * (mean / sd) ** 2
+    variance_standardized = np.where(sd > 0, sum_sq_std / (n_cells - 1), 0)
+    hvf = pd.DataFrame(
+        {
+            "ensgs": counts.ensgs.to_numpy(),
+            "genes": counts.genes.to_numpy(),
+            "mean": mean,
+            "variance": variance,
+            "variance_expected": variance_expected,
+            "variance_standardized": variance_standardized,
+        }
+    )
+    top = np.argsort(-variance_standardized, kind="stable")[:nfeatures]
+    hvf["variable"] = False
+    hvf.loc[top, "variable"] = True
+    return hvf
+
+
+def loess(
+    x: np.ndarray, y: np.ndarray, span: float = LOESS_SPAN, degree: int = 2, surface: str = "interpolate"
+) -> np.ndarray:
+    """
+    Fitted values of R's `loess(y ~ x, span=span, degree=degree)` for a
+    single predictor: local polynomial regressions with tricube weights over
+    the `floor(n * span)` nearest neighbors.
+    With `surface="interpolate"` (R's default), local fits are only computed
+    at the vertices of R's kd tree, and fitted values are cubic Hermite
+    interpolations of the vertex values and slopes. With `surface="direct"`,
+    a local fit is computed at every point
+    """
+    if surface not in ["interpolate", "direct"]:
+        raise ValueError(f"surface must be one of ['interpolate', 'direct']. Got: {surface}")
+    n = len(x)
+    q = min(max(int(np.floor(n * span + 1e-5)), degree + 1), n)
+    xs, ys = np.sort(x), y[np.argsort(x, kind="stable")]
+    if surface == "direct":
+        return _local_fit(xs, ys, x, q, degree)[:, 0]
+    vertices = _kd_vertices(xs, fc=int(np.floor(n * span * LOESS_CELL)))
+    vertex_fits = _local_fit(xs, ys, vertices, q, degree)
+    cell = np.clip(np.searchsorted(vertices, x, side="right") - 1, 0, len(vertices) - 2)
+    width = vertices[cell + 1] - vertices[cell]
+    h = (x - vertices[cell]) / width
+    value_0, slope_0 = vertex_fits[cell, 0], vertex_fits[cell, 1] * width
+    value_1, slope_1 = vertex_fits[cell + 1, 0], vertex_fits[cell + 1, 1] * width
+    hermite = (1 - h) ** 2 * (1 + 2 * h) * value_0 + h**2 * (3 - 2 * h) * value_1
+    return hermite + h * (1 - h) ** 2 * slope_0 + h**2 * (h - 1) * slope_1
+
+
+def _local_fit(xs: np.ndarray, ys: np.ndarray, points: np.ndarray, q: int, degree: int) -> np.ndarray:
+    """
+    Value and slope at each of `points` of the local polynomial fit to the
+    `q` nearest neighbors in sorted `xs`. Neighborhoods are contiguous in
+    sorted order, so the weighted least squares problems are solved in
+    vectorized chunks
+    """
+    starts = _nearest_windows(xs, points, q)
+    fits = np.empty((len(points), 2))
+    for lo in range(0, len(points), _LOESS_CHUNK_SIZE):
+        rows = np.arange(lo, min(lo + _LOESS_CHUNK_SIZE, len(points)))
+        window = starts[rows, None] + np.arange(q)
+        dx = xs[window] - points[rows, None]
+        dist = np.abs(dx)
+        max_dist = dist.max(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weights = np.where(max_dist > 0, np.clip(1 - (dist / max_dist) ** 3, 0, None) ** 3, 1)
+        # polynomial terms in `dx`, so the first two coefficients are the value and slope at the point
+        moments = np.empty((len(rows), 2 * degree + 1))
+        targets = np.empty((len(rows), degree + 1))
+        term = weights
+        for power in range(2 * degree + 1):
+            moments[:, power] = term.sum(axis=1)
+            if power <= degree:
+                targets[:, power] = np.einsum("rq,rq->r", term, ys[window])
+            term = term * dx
+        powers = np.arange(degree + 1)
+        gram = moments[:, powers[:, None] + powers]
+        coefs = np.linalg.pinv(gram, rcond=100 * np.finfo(float).eps) @ targets[..., None]
+        fits[rows] = coefs[:, :2, 0]
+    return fits
+
+
+def _nearest_windows(xs: np.ndarray, points: np.ndarray, q: int) -> np.ndarray:
+    """
+    Start of the window of the `q` nearest neighbors in sorted `xs` of each
+    of `points`, found by a vectorized binary search, since the window
+    slides right whenever the value past its end is closer than its start
+    """
+    n = len(xs)
+    position = np.searchsorted(xs, points)
+    low = np.clip(position - q, 0, n - q)
+    high = np.clip(position, 0, n - q)
+    while np.any(low < high):
+        mid = (low + high) // 2
+        slide = xs[np.minimum(mid + q, n - 1)] - points < points - xs[mid]
+        slide &= mid + q < n
+        low = np.where(slide, mid + 1, low)
+        high = np.where(slide, high, mid)
+    return low
+
+
+def _kd_vertices(xs: np.ndarray, fc: int) -> np.ndarray:
+    """
+    Sorted vertices of R's loess kd tree for a single predictor: the data
+    range expanded by 0.5%, recursively split at the median of cells with
+    more than `fc` points (moving off ties, as `ehg124` does)
+    """
+    n = len(xs)
+    margin = 0.005 * max(xs[-1] - xs[0], 1e-10 * max(abs(xs[0]), abs(xs[-1])) + 1e-30)
+    vertices = [xs[0] - margin, xs[-1] + margin]
+    cells = [(0, n - 1, vertices[0], vertices[1])]
+    while cells:
+        l, u, v_low, v_high = cells.pop()
+        if u - l + 1 <= fc:
+            continue
+        m = (l + u) // 2
+        offset = 0
+        while l <= m + offset < u:
+            if xs[m + offset] != xs[m + offset + 1]:
+                m += offset
+                break
+            offset = -offset + (1 if offset <= 0 else 0)
+        split = xs[m]
+        if split == v_low or split == v_high:
+            continue
+        vertices.append(split)
+        cells += [(l, m, v_low, split), (m + 1, u, split, v_high)]
+    return np.sort(vertices)
+
+
+def _row_ids(counts: Counts) -> np.ndarray:
+    """Row of each stored entry"""
+    return np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
@@ -0,0 +1,124 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, load_npz, save_npz
+from scipy.spatial.distance import cdist
+
+_KNN_CHUNK_SIZE = 1024
+logger = logging.getLogger(__name__)
+
+
+def knn_graph(embeddings: np.ndarray, k: int, metric: str = "euclidean", exact: bool = False) -> csr_matrix:
+    """
+    k nearest neighbors of each row of `embeddings` (including itself), as a
+    CSR matrix with `k` entries per row in order of distance: column indices
+    are the neighbors and values the distances. The first neighbor of each
+    cell is itself, with an explicit zero distance, as expected by UMAP's
+    `precomputed_knn`. Neighbors are approximate (NN-descent, as UMAP does)
+    unless `exact`, which is a brute force search, quadratic in the number
+    of cells, so only suited to small datasets. The exact search is also
+    used, with a warning, if `pynndescent` isn't installed
+    """
+    n_cells = embeddings.shape[0]
+    k = min(k, n_cells)
+    if exact:
+        indices, distances = _exact_knn(embeddings, k, metric)
+    else:
+        indices, distances = _approximate_knn(embeddings, k, metric)
+    indptr = np.arange(0, n_cells * k + 1, k, dtype=np.int64)
+    return csr_matrix((distances.ravel(), indices.ravel(), indptr), shape=(n_cells, n_cells))
+
+
+def _exact_knn(embeddings: np.ndarray, k: int, metric: str) -> Tuple[np.ndarray, np.ndarray]:
+    n_cells = embeddings.shape[0]
+    indices = np.empty((n_cells, k), dtype=np.int32)
+    distances = np.empty((n_cells, k), dtype=np.float64)
+    for lo in range(0, n_cells, _KNN_CHUNK_SIZE):
+        rows = np.arange(lo, min(lo + _KNN_CHUNK_SIZE, n_cells))
+        dist = cdist(embeddings[rows], embeddings, metric=metric)
+        # each cell is its own first neighbor, even among duplicates
+        dist[np.arange(len(rows)), rows] = -1
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        nearest_dist = np.take_along_axis(dist, nearest, axis=1)
+        order = np.argsort(nearest_dist, axis=1, kind="stable")
+        indices[rows] = np.take_along_axis(nearest, order, axis=1)
+        distances[rows] = np.maximum(np.take_along_axis(nearest_dist, order, axis=1), 0)
+    return indices, distances
+
+
+def _approximate_knn(embeddings: np.ndarray, k: int, metric: str, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    try:
+        from pynndescent import NNDescent
+    except ImportError:
+        logger.warning("`pynndescent` isn't installed, so kNN search is exact, which is slow for large datasets")
+        return _exact_knn(embeddings, k, metric)
+
+    index = NNDescent(embeddings, n_neighbors=k, metric=metric, random_state=seed)
+    indices, distances = index.neighbor_graph
+    return _self_first(indices.astype(np.int32), distances.astype(np.float64))
+
+
+def _self_first(indices: np.ndarray, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Move each cell to the front of its own neighbors, with zero distance.
+    NN-descent may rank an identical cell first, or miss the cell itself, in
+    which case its farthest neighbor is dropped
+    """
+    n_cells, k = indices.shape
+    rows = np.arange(n_cells)
+    is_self = indices == rows[:, None]
+    # position of the cell in its row, or the last position if missing
+    position = np.where(is_self.any(axis=1), is_self.argmax(axis=1), k - 1)
+    columns = np.broadcast_to(np.arange(k), (n_cells, k))
+    # shift the neighbors before that position one place back
+    source = np.where(columns <= position[:, None], columns - 1, columns)
+    source[:, 0] = position
+    indices = np.take_along_axis(indices, source, axis=1)
+    distances = np.take_along_axis(distances, source, axis=1)
+    indices[:, 0] = rows
+    distances[:, 0] = 0
+    return indices, distances
+
+
+def knn_arrays(graph: csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """(cells x k) neighbor indices and distances of a `knn_graph`"""
+    k = graph.indptr[1] - graph.indptr[0]
+    return graph.indices.reshape(-1, k), graph.data.reshape(-1, k)
+
+
+def load_knn_graph(
+    forest: "CellForest", k: int, metric: str = "euclidean", num_pcs: Optional[int] = None, exact: bool = False
+):
+    """
+    kNN graph of the first `num_pcs` PCs (all if `None`) of the `dim_reduce`
+    run of `forest`, cached in the `dim_reduce` directory keyed by `num_pcs`,
+    `k`, `metric` and `exact`. The cache is rebuilt if the PCA embeddings are
+    newer
+    """
+    embeddings_path = get_pca_embeddings_path(forest)
+    num_pcs_key = num_pcs or "all"
+    exact_key = "_exact" if exact else ""
+    cache_path = Path(forest.paths["dim_reduce"]) / f"knn_pcs-{num_pcs_key}_k-{k}_{metric}{exact_key}.npz"
+    if cache_path.exists() and os.path.getmtime(cache_path) >= os.path.getmtime(embeddings_path):
+        return load_npz(cache_path)
+    embeddings = load_pca_embeddings(embeddings_path)[:, :num_pcs]
+    graph = knn_graph(np.ascontiguousarray(embeddings), k, metric, exact=exact)
+    save_npz(cache_path, graph, compressed=False)
+    return graph
+
+
+def get_pca_embeddings_path(forest: "CellForest") -> Path:
+    """PCA embeddings of the `dim_reduce` run, preferring the binary output"""
+    path_map = forest["dim_reduce"].path_map
+    npy_path = Path(path_map["pca_embeddings_npy"])
+    return npy_path if npy_path.exists() else Path(path_map["pca_embeddings"])
+
+
+def load_pca_embeddings(embeddings_path: Path) -> np.ndarray:
+    if embeddings_path.suffix == ".npy":
+        return np.load(embeddings_path)
+    return pd.read_csv(embeddings_path, sep="\t").values
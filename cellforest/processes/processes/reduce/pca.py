@@ -0,0 +1,77 @@
+from typing import Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
+
+
+def scaled_pca(
+    matrix: csr_matrix, n_components: int, n_oversamples: int = 10, n_iter: int = 7, seed: int = 42
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    PCA of the standardized (centered, unit variance) columns of a sparse
+    (cells x features) matrix, as Seurat's `ScaleData` + `RunPCA`. Centering
+    and scaling are applied implicitly within the matrix products, so the
+    matrix is never densified, and the decomposition is a randomized
+    truncated SVD (Halko et al.) with `n_iter` power iterations. Unlike
+    `ScaleData`, standardized values aren't clipped at 10, since clipping
+    can't be applied implicitly
+    Returns:
+        embeddings: (cells x n_components) cell embeddings (`u * s`)
+        loadings: (features x n_components) feature loadings
+        stdev: standard deviation of each component
+    """
+    matrix = csr_matrix(matrix, dtype=np.float64)
+    n_cells = matrix.shape[0]
+    operator = standardized_operator(matrix)
+    u, s, vt = randomized_svd(operator, n_components, n_oversamples, n_iter, seed)
+    return u * s, vt.T, s / np.sqrt(n_cells - 1)
+
+
+def standardized_operator(matrix: csr_matrix) -> LinearOperator:
+    """
+    `LinearOperator` for `(matrix - mean) / sd` (per column, with `n - 1`
+    degrees of freedom), which only requires sparse products with `matrix`
+    """
+    n_cells, n_features = matrix.shape
+    mean = np.asarray(matrix.mean(axis=0)).ravel()
+    mean_sq = np.asarray(matrix.multiply(matrix).mean(axis=0)).ravel()
+    sd = np.sqrt(np.maximum(mean_sq - mean**2, 0) * n_cells / (n_cells - 1))
+    sd[sd == 0] = 1
+    scaled_mean = mean / sd
+    matrix_t = matrix.T.tocsr()
+
+    def matmat(v):
+        v = v.reshape(n_features, -1)
+        return matrix @ (v / sd[:, None]) - scaled_mean @ v
+
+    def rmatmat(u):
+        u = u.reshape(n_cells, -1)
+        return (matrix_t @ u) / sd[:, None] - np.outer(scaled_mean, u.sum(axis=0))
+
+    return LinearOperator(
+        (n_cells, n_features), matvec=matmat, rmatvec=rmatmat, matmat=matmat, rmatmat=rmatmat, dtype=np.float64
+    )
+
+
+def randomized_svd(
+    operator: LinearOperator, n_components: int, n_oversamples: int = 10, n_iter: int = 7, seed: int = 42
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Truncated SVD of `operator` from a randomized range finder with power
+    iterations, re-orthonormalized by QR at each step for stability. Signs
+    are flipped so that the largest loading of each component is positive,
+    for deterministic output
+    """
+    n_rows, n_cols = operator.shape
+    rank = min(n_components + n_oversamples, n_rows, n_cols)
+    rng = np.random.default_rng(seed)
+    q, _ = np.linalg.qr(operator.matmat(rng.standard_normal((n_cols, rank))))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(operator.rmatmat(q))
+        q, _ = np.linalg.qr(operator.matmat(q))
+    u_small, s, vt = np.linalg.svd(operator.rmatmat(q).T, full_matrices=False)
+    u = q @ u_small[:, :n_components]
+    s, vt = s[:n_components], vt[:n_components]
+    signs = np.sign(vt[np.arange(len(vt)), np.abs(vt).argmax(axis=1)])
+    return u * signs, s, vt * signs[:, None]
@@ -1,9 +1,43 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
 from dataforest.hooks import dataprocess
 
+from cellforest.processes.processes.normalize.process import PY_NORMALIZE_METHODS
+from cellforest.processes.processes.reduce.knn import knn_arrays, load_knn_graph
+from cellforest.processes.processes.reduce.pca import scaled_pca
+from cellforest.structures.Counts import Counts
+from cellforest.utils.cache import process_cache
+from cellforest.utils.r.run_r_script import run_process_r_script
+
 
 @dataprocess(requires="normalize")
+@process_cache("dim_reduce")
 def dim_reduce(forest: "CellForest"):
     process_name = "dim_reduce"
+    if forest.spec[process_name].get("method") == "pca_py":
+        embeddings = _run_pca_py(forest, process_name)
+    else:
+        embeddings = _run_pca_r(forest, process_name)
+    n_neighbors = forest.spec[process_name]["umap_n_neighbors"]
+    metric = forest.spec[process_name]["umap_metric"]
+    exact = forest.spec[process_name].get("knn_exact", False)
+    knn = knn_arrays(load_knn_graph(forest, n_neighbors, metric, exact=exact))
+    umap_df = _run_umap(
+        embeddings,
+        n_neighbors=n_neighbors,
+        min_dist=forest.spec[process_name]["umap_min_dist"],
+        n_components=forest.spec[process_name]["umap_n_components"],
+        metric=metric,
+        knn=knn,
+    )
+    umap_df.index = forest.f["normalize"]["cell_ids"][0]
+    output_umap_embeddings_path = forest[process_name].path_map["umap_embeddings"]
+    forest.write_umap_embeddings(output_umap_embeddings_path, umap_df, index=True, header=True)
+
+
+def _run_pca_r(forest: "CellForest", process_name: str) -> np.ndarray:
     input_metadata_path = forest.get_temp_metadata_path(forest, process_name)
     input_rds_path = forest["normalize"].path_map["matrix_r"]
     print(input_rds_path)
@@ -22,40 +56,68 @@ def dim_reduce(forest: "CellForest"):
         r_functions_filepath,
     ]
     r_pca_filepath = str(forest.schema.R_FILEPATHS["PCA_SCRIPT"])
-    working_dir = str(forest.paths[process_name])
-    arg_list = list(map(str, arg_list))
-    command_string = f"Rscript {r_pca_filepath} {' '.join(arg_list)}"
-    process_shell_command(command_string=command_string, working_dir=working_dir, process_name="pca")
-    umap_df = ProcessMethodsSC._run_umap(
-        output_embeddings_path,
-        n_neighbors=forest.spec[process_name]["umap_n_neighbors"],
-        min_dist=forest.spec[process_name]["umap_min_dist"],
-        n_components=forest.spec[process_name]["umap_n_components"],
-        metric=forest.spec[process_name]["umap_metric"],
-    )
-    umap_df.index = forest.f["normalize"]["cell_ids"][0]
-    output_umap_embeddings_path = forest[process_name].path_map["umap_embeddings"]
-    forest.write_umap_embeddings(output_umap_embeddings_path, umap_df, index=True, header=True)
+    run_process_r_script(forest, r_pca_filepath, arg_list, process_name, log_name="pca")
+    return pd.read_csv(output_embeddings_path, sep="\t").values
+
+
+def _run_pca_py(forest: "CellForest", process_name: str) -> np.ndarray:
+    """
+    PCA of the variable features of the normalized `Counts`, written as
+    binary `.npy` arrays. TSVs are only written if `pca_export_tsv` is set
+    """
+    method = forest.spec["normalize"]["method"]
+    if method not in PY_NORMALIZE_METHODS:
+        raise ValueError(
+            f"`pca_py` requires normalize method in {PY_NORMALIZE_METHODS}, which save normalized `Counts` and "
+            f"mark variable features in `variable_features`. Got: {method}"
+        )
+    hvf = forest.f["normalize"]["variable_features"]
+    if "variable" not in hvf.columns:
+        raise ValueError(f"`variable_features` of normalize ({method}) has no `variable` column. Rerun normalize")
+    rna = Counts.load(forest["normalize"].path_map["rna"])
+    variable = np.flatnonzero(hvf["variable"].to_numpy())
+    embeddings, loadings, stdev = scaled_pca(rna[:, variable], forest.spec[process_name]["pca_npcs"])
+    path_map = forest[process_name].path_map
+    np.save(path_map["pca_embeddings_npy"], embeddings)
+    np.save(path_map["pca_loadings_npy"], loadings)
+    np.save(path_map["pca_stdev"], stdev)
+    if forest.spec[process_name].get("pca_export_tsv", False):
+        columns = [f"PC_{i + 1}" for i in range(embeddings.shape[1])]
+        embeddings_df = pd.DataFrame(embeddings, index=rna.cell_ids, columns=columns)
+        loadings_df = pd.DataFrame(loadings, index=hvf["genes"].iloc[variable], columns=columns)
+        embeddings_df.to_csv(path_map["pca_embeddings"], sep="\t")
+        loadings_df.to_csv(path_map["pca_loadings"], sep="\t")
+    return embeddings
 
 
 def _run_umap(
-    input_file_path: str,
+    embeddings: np.ndarray,
     n_neighbors: int = 10,
     min_dist: float = 0.5,
     n_components: int = 2,
     metric: str = "euclidean",
     seed: int = 42,
+    knn: Optional[Tuple[np.ndarray, np.ndarray]] = None,
 ):
+    """
+    If `knn` (neighbor indices and distances, each cell first) is given, it
+    is used as UMAP's nearest-neighbor graph instead of recomputing it
+    """
     import umap
     import warnings
     from numba.errors import NumbaPerformanceWarning
 
     warnings.filterwarnings("ignore", category=NumbaPerformanceWarning)
 
-    pca_df = pd.read_csv(input_file_path, sep="\t")
+    precomputed_knn = (*knn, None) if knn is not None else (None, None, None)
     umap_handle = umap.UMAP(
-        n_neighbors=n_neighbors, min_dist=min_dist, random_state=seed, n_components=n_components, metric=metric,
+        n_neighbors=n_neighbors,
+        min_dist=min_dist,
+        random_state=seed,
+        n_components=n_components,
+        metric=metric,
+        precomputed_knn=precomputed_knn,
     )
-    umap_matrix = umap_handle.fit(pca_df).embedding_
+    umap_matrix = umap_handle.fit(embeddings).embedding_
     umap_df = pd.DataFrame(umap_matrix, columns=[f"UMAP_{idx + 1}" for idx in range(umap_matrix.shape[1])],)
     return umap_df
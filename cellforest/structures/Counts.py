@@ -2,17 +2,20 @@ import os
 import pickle
 from functools import wraps
 from pathlib import Path
-from typing import Union, Iterable
+from typing import Iterable, Optional, Union
 
 import numpy as np
 import pandas as pd
-from scipy.sparse import csr_matrix, hstack, vstack
+from scipy.sparse import csr_matrix, hstack
 
 from cellforest.structures import const
 from cellforest.structures.build_counts_store import build_counts_store
+from cellforest.structures.CountsStore import CountsStore
 from cellforest.structures.exceptions import CellsNotFound, GenesNotFound
-from cellforest.utils.cellranger import CellRangerIO
+from cellforest.structures.LabelIndex import LabelIndex
+from cellforest.utils.cellranger import CellRangerIO, MtxQC
 from cellforest.utils.r.Convert import Convert
+from cellforest.utils.sparse import take, take_rows
 
 
 class Counts(csr_matrix):
@@ -24,12 +27,16 @@ class Counts(csr_matrix):
     def __init__(self, matrix, cell_ids, features, **kwargs):
         # TODO: make a get_counts function that just takes the directory
         super().__init__(matrix, **kwargs)
-        self._matrix = matrix
         self.chemistry = "v3" if "mode" in features.columns else "v2"
-        self.features = features.iloc[:, :2].copy()
-        self.features.columns = self.FEATURES_COLUMNS
+        # shared rather than copied if already normalized (e.g. from slicing)
+        self.features = self._normalize_features(features)
         self._idx = self._convert_to_series(cell_ids)
-        self._ids = self._index_col_swap(cell_ids)
+        self._label_indices = dict()
+
+    @property
+    def _matrix(self) -> csr_matrix:
+        """Plain `csr_matrix` which shares `data`, `indices`, and `indptr` with `self`"""
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape, copy=False)
 
     @property
     def genes(self):
@@ -52,10 +59,40 @@ class Counts(csr_matrix):
         return self.index
 
     @classmethod
-    def concatenate(cls, counts_list: Union["Counts", Iterable["Counts"]], axis: int = 0) -> "Counts":
-        counts_list = counts_list.copy()
-        orig = counts_list.pop(0)
-        return orig.append(counts_list, axis=axis)
+    def concatenate(
+        cls, counts_list: Union["Counts", Iterable["Counts"]], axis: int = 0, join: str = "outer"
+    ) -> "Counts":
+        """
+        Concatenate along cells (`axis=0`) or genes (`axis=1`).
+        Cells are concatenated in a single pass into `data`, `indices`, and
+        `indptr` arrays preallocated from the total `nnz`. If the feature
+        tables differ, features are aligned on ensgs, keeping either the union
+        (`join="outer"`) or the intersection (`join="inner"`) of the features,
+        in order of first appearance
+        """
+        counts_list = [counts_list] if isinstance(counts_list, Counts) else list(counts_list)
+        if axis == 1:
+            return counts_list[0].hstack(counts_list[1:])
+        features, col_maps = cls._join_features([counts.features for counts in counts_list], join)
+        blocks = [cls._remap_block(counts, col_map) for counts, col_map in zip(counts_list, col_maps)]
+        n_rows = sum(len(indptr) - 1 for _, _, indptr in blocks)
+        nnz = sum(len(data) for data, _, _ in blocks)
+        idx_dtype = np.int32 if max(nnz, len(features)) <= np.iinfo(np.int32).max else np.int64
+        data = np.empty(nnz, dtype=np.result_type(*[counts.dtype for counts in counts_list]))
+        indices = np.empty(nnz, dtype=idx_dtype)
+        indptr = np.empty(n_rows + 1, dtype=idx_dtype)
+        indptr[0] = 0
+        row = offset = 0
+        for block_data, block_indices, block_indptr in blocks:
+            end = offset + len(block_data)
+            data[offset:end] = block_data
+            indices[offset:end] = block_indices
+            np.add(block_indptr[1:], offset, out=indptr[row + 1 : row + len(block_indptr)], casting="unsafe")
+            row += len(block_indptr) - 1
+            offset = end
+        matrix = csr_matrix((data, indices, indptr), shape=(n_rows, len(features)), copy=False)
+        cell_ids = pd.concat([counts.cell_ids for counts in counts_list], ignore_index=True)
+        return cls(matrix, cell_ids, features)
 
     def append(self, others: Union["Counts", Iterable["Counts"]], axis: int = 0) -> "Counts":
         if axis == 0:
@@ -63,12 +100,26 @@ class Counts(csr_matrix):
         elif axis == 1:
             return self.hstack(others)
 
-    def vstack(self, others: Union["Counts", Iterable["Counts"]]):
+    def reindex_features(self, features: pd.DataFrame) -> "Counts":
+        """
+        Conform columns to `features` (e.g. a reference across lanes), matched
+        on ensgs. Columns are permuted by rewriting `indices` through a single
+        permutation array, so lanes with different features or feature order
+        (e.g. v2 `genes.tsv` and v3 `features.tsv`) can be stacked directly.
+        Features missing from `self` are empty, and those missing from
+        `features` are dropped
+        """
+        features = self._normalize_features(features)
+        col_map = self._column_map(self.features, features)
+        if col_map is None:
+            return self.__class__(self._matrix, self.cell_ids, features)
+        data, indices, indptr = self._remap_block(self, col_map)
+        matrix = csr_matrix((data, indices, indptr), shape=(self.shape[0], len(features)), copy=False)
+        return self.__class__(matrix, self.cell_ids, features)
+
+    def vstack(self, others: Union["Counts", Iterable["Counts"]], join: str = "outer"):
         others = others if isinstance(others, (list, tuple)) else [others]
-        matrix = vstack([self._matrix, *[x._matrix for x in others]])
-        cell_ids = pd.concat([self.cell_ids, *[x.cell_ids for x in others]]).reset_index(drop=True)
-        features = self.features
-        return self.__class__(matrix, cell_ids, features)
+        return self.concatenate([self, *others], join=join)
 
     def hstack(self, others: Union["Counts", Iterable["Counts"]]):
         others = others if isinstance(others, (list, tuple)) else [others]
@@ -128,53 +179,72 @@ class Counts(csr_matrix):
         return pd.DataFrame(self.todense(), columns=self.columns, index=self.index)
 
     @classmethod
-    def from_cellranger(cls, cellranger_dir):
-        """Load from 10X Cellranger output format"""
+    def from_cellranger(cls, cellranger_dir, n_workers: Optional[int] = None, qc: Optional[MtxQC] = None):
+        """
+        Load from 10X Cellranger output format, parsing the matrix with
+        `n_workers` threads. If `qc` is specified, QC metrics are accumulated
+        in it while the matrix is parsed, with mitochondrial features matched
+        on gene names unless `qc.mito` is set
+        """
         crio = CellRangerIO(cellranger_dir)
-        matrix = crio.read_matrix()
-        cell_ids = crio.read_barcodes()
         features = crio.read_features()
+        if qc is not None and qc.mito is None:
+            qc.mito = MtxQC.from_genes(cls._normalize_features(features)["genes"]).mito
+        matrix = crio.read_matrix(n_workers=n_workers, qc=qc)
+        cell_ids = crio.read_barcodes()
         return cls(matrix, cell_ids, features)
 
-    def to_cellranger(self, output_dir, gz=True, chemistry="v3"):
-        """Save in 10X Cellranger output format"""
+    def to_cellranger(self, output_dir, gz=True, chemistry="v3", n_workers: Optional[int] = None):
+        """Save in 10X Cellranger output format, formatting and compressing the matrix with `n_workers` threads"""
         output_dir = Path(output_dir)
         crio = CellRangerIO
-        # TODO: memory duplication
         counts = self.as_chemistry_version(chemistry)
         features_filename = "features.tsv" if chemistry == "v3" else "genes.tsv"
-        crio.write_matrix(output_dir / "matrix.mtx", counts._matrix, gz)
+        crio.write_matrix(output_dir / "matrix.mtx", counts._matrix, gz, n_workers=n_workers)
         crio.write_features(output_dir / features_filename, counts.features, gz)
         crio.write_barcodes(output_dir / "barcodes.tsv", counts.cell_ids, gz)
 
     @classmethod
     def from_rds(cls, path):
-        """Convert rds to pickle, then load pickle"""
-        # TODO: QUEUE - test (Convert.rds_to_pickle_dir may overwrite any existing metadata)
+        """Convert rds to columnar store, then load store"""
+        # TODO: QUEUE - test (Convert.rds_to_store_dir may overwrite any existing metadata)
         raise NotImplementedError()
         parent = Path(path).parent
-        Convert.rds_to_pickle_dir(parent)
-        return cls.load(parent / "rna.pickle")
+        Convert.rds_to_store_dir(parent)
+        return cls.load(parent / "rna.counts")
 
     def to_rds(self, path):
-        """Save pickle, then convert pickle to rds"""
-        # TODO: QUEUE - test (Convert.pickle_to_rds_dir may overwrite any existing metadata)
+        """Save columnar store, then convert store to rds"""
+        # TODO: QUEUE - test (Convert.store_to_rds_dir may overwrite any existing metadata)
         raise NotImplementedError()
         path = Path(path)
         stem = path.stem
-        self.save(path.parent / f"{stem}.pickle")
-        Convert.pickle_to_rds_dir(path.parent)
+        self.save(path.parent / f"{stem}.counts")
+        Convert.store_to_rds_dir(path.parent)
 
     @classmethod
-    def load(cls, filepath):
-        """Load from pickle"""
+    def load(cls, filepath, mmap=False, cells=None):
+        """
+        Load from columnar store directory or pickle. If `mmap`, a columnar
+        store is memory-mapped, so that only the rows which are sliced are read
+        from disk. If `cells` are specified, only those rows are loaded from a
+        columnar store, while a pickle is loaded in full and then sliced
+        """
+        if CountsStore.is_store(filepath):
+            store = CountsStore.load(filepath, mmap=mmap, cells=cells)
+            return cls(store.matrix, store.cell_ids, store.features)
         with open(filepath, "rb") as f:
             store = pickle.load(f)
-        return cls(store.matrix, store.cell_ids, store.features)
+        counts = cls(store.matrix, store.cell_ids, store.features)
+        if cells is not None:
+            counts = counts[cells]
+        return counts
 
     def save(self, filepath, create_rds=False):
         """
-        Save as pickle.
+        Save as pickle if `filepath` ends with `.pickle`, otherwise, as a
+        columnar store directory, which is also the format read by R to
+        create an rds.
         Intermediate data store used to maintain future compatibility
         """
         self._save(filepath, self._matrix, self.cell_ids, self.features, create_rds)
@@ -183,16 +253,16 @@ class Counts(csr_matrix):
         return self.__class__(self._matrix.copy(), self.cell_ids.copy(), self.features.copy())
 
     def as_chemistry_version(self, chemistry):
-        """Duplicate with a different chemistry version"""
+        """Duplicate with a different chemistry version. Only features are copied, the matrix is shared"""
         if chemistry not in self._SUPPORTED_CHEMISTRIES:
             raise ValueError(f"supported chemistries: {self._SUPPORTED_CHEMISTRIES}")
-        counts = self.copy()
+        counts = self.__class__(self._matrix, self.cell_ids, self.features.copy())
         counts.chemistry = chemistry
         if chemistry == "v3":
             counts.features["mode"] = "Gene Expression"
         else:
             if "mode" in counts.features.columns:
-                counts.features.drop("mode", inplace=True)
+                counts.features.drop(columns="mode", inplace=True)
         return counts
 
     def __getitem__(self, key):
@@ -202,57 +272,64 @@ class Counts(csr_matrix):
             return self._cell_slice(key)
 
     def _2d_slice(self, key):
-        """Slice rows and columns (cells and genes)"""
-        gene_sliced = self._gene_slice(key[1])
-        cell_sliced = gene_sliced[key[0]]
-        return cell_sliced
+        """Slice rows and columns (cells and genes) in a single pass"""
+        cells_key = self._cells_convert_key(key[0])
+        genes_key = self._genes_convert_key(key[1])
+        mat = take(self._matrix, cells_key, genes_key)
+        cell_ids = self._idx.iloc[cells_key].reset_index(drop=True)
+        features = self.features.iloc[genes_key].reset_index(drop=True)
+        return self.__class__(mat, cell_ids, features)
 
     def _cell_slice(self, key):
         """Slice rows (cells)"""
-        try:
-            key = self._convert_key(key, self._ids)
-        except KeyError:
-            raise CellsNotFound(self._ids, key)
-        if isinstance(key, slice):
-            cell_ids = pd.DataFrame(self._idx[key]).reset_index(drop=True)
-        else:
-            cell_ids = pd.DataFrame(self._idx.reindex(key)).reset_index(drop=True)
-        mat = csr_matrix(self._matrix)[key]
-        return self.__class__(mat, cell_ids, self.features)
+        key = self._cells_convert_key(key)
+        cell_ids = self._idx.iloc[key].reset_index(drop=True)
+        mat = take_rows(self._matrix, key)
+        counts = self.__class__(mat, cell_ids, self.features)
+        counts._share_label_indices(self, ["genes", "ensgs"])
+        return counts
 
     def _gene_slice(self, key):
         """Slice columns (genes) with either gene names or ensemble names"""
         key = self._genes_convert_key(key)
-        mat = csr_matrix(self._matrix)[:, key]
-        if isinstance(key, slice):
-            features = self.features[key]
-        else:
-            genes = pd.DataFrame(self.genes.reindex(key)).reset_index(drop=True)
-            ensgs = pd.DataFrame(self.ensgs.reindex(key)).reset_index(drop=True)
-            if len(ensgs) > len(genes):
-                features = self.features[self.features.ensgs.isin(key)]
-            else:
-                features = self.features[self.features.genes.isin(key)]
-        return self.__class__(mat, self._idx, features)
-
-    @property
-    def _genes_names(self):
-        return self._index_col_swap(self.genes.copy(), "genes")
+        mat = take(self._matrix, slice(None), key)
+        features = self.features.iloc[key].reset_index(drop=True)
+        counts = self.__class__(mat, self._idx, features)
+        counts._share_label_indices(self, ["cell_ids"])
+        return counts
 
-    @property
-    def _ensgs_names(self):
-        return self._index_col_swap(self.ensgs.copy(), "ensgs")
+    def _get_label_index(self, name: str) -> LabelIndex:
+        """
+        Hashed `LabelIndex` for `name` in {"cell_ids", "genes", "ensgs"}, which
+        is built on first use and then kept for the lifetime of the object
+        """
+        if name not in self._label_indices:
+            self._label_indices[name] = LabelIndex(getattr(self, name))
+        return self._label_indices[name]
+
+    def _share_label_indices(self, other: "Counts", names: Iterable[str]):
+        """Reuse `LabelIndex`s already built by `other` for axes which weren't sliced"""
+        for name in names:
+            if name in other._label_indices:
+                self._label_indices[name] = other._label_indices[name]
+
+    def _cells_convert_key(self, key):
+        """Convert `cell_id`s to integer indices"""
+        try:
+            return self._convert_key(key, self._get_label_index("cell_ids"))
+        except KeyError:
+            raise CellsNotFound(self._idx, key)
 
     def _genes_convert_key(self, key):
-        """"""
+        """Convert gene names, or, if none are found, ensgs, to integer indices"""
         try:
-            key = self._convert_key(key, self._genes_names)
+            key = self._convert_key(key, self._get_label_index("genes"))
         except KeyError:
             try:
-                key = self._convert_key(key, self._ensgs_names)
+                key = self._convert_key(key, self._get_label_index("ensgs"))
             except KeyError:
-                genes_err = GenesNotFound(self._genes_names, key)
-                ensgs_err = GenesNotFound(self._ensgs_names, key)
+                genes_err = GenesNotFound(self.genes, key)
+                ensgs_err = GenesNotFound(self.ensgs, key)
                 if len(ensgs_err.missing) < len(genes_err.missing):
                     raise ensgs_err
                 else:
@@ -260,22 +337,16 @@ class Counts(csr_matrix):
         return key
 
     @staticmethod
-    def _convert_key(key, df):
-        """Slice index dataframe with key and convert to integer indices"""
-        if isinstance(key, (pd.Series, pd.Index, np.ndarray)):
-            key = key.tolist()
-        if isinstance(key, list):
-            if isinstance(key[0], str):
-                # gene names are duplicated, ensgs aren't
-                if df.index.duplicated().any():
-                    df_temp = df.reset_index()
-                    key_rows = df_temp[df_temp[df_temp.columns[0]].isin(key)]
-                else:
-                    key_rows = df.reindex(key)
-                key = key_rows.dropna()["i"].astype(int).tolist()
+    def _convert_key(key, label_index: LabelIndex):
+        """Convert labels in key to integer indices with `label_index`"""
+        if isinstance(key, (pd.Series, pd.Index, list)):
+            key = np.asarray(key)
+        if isinstance(key, np.ndarray):
+            if key.dtype.kind in "OUS":
+                key = label_index.get_positions(key)
         elif isinstance(key, str):
-            key = [df.loc[key]["i"].tolist()]
-        elif isinstance(key, int):
+            key = label_index.get_positions([key])
+        elif isinstance(key, (int, np.integer)):
             key = [key]
         else:
             return key
@@ -295,26 +366,85 @@ class Counts(csr_matrix):
             ipdb.set_trace()
             raise KeyError(f"some of provided keys missing from counts matrix. Intersection: {intersection}")
 
-    @staticmethod
-    def _index_col_swap(df, col: Union[str, int] = 0, new_index_colname="i"):
-        """Swaps column with index of DataFrame"""
-        df = df.copy()
-        if isinstance(df, pd.Series):
-            df = pd.DataFrame(df)
-        if isinstance(col, int):
-            col = df.columns[col]
-        df[new_index_colname] = df.index
-        df.index = df[col]
-        df.index.name = "cell_id"
-        df.drop(columns=col, inplace=True)
-        return df
-
     @staticmethod
     def _save(filepath, matrix, cell_ids, features, create_rds=False):
+        """
+        If `create_rds`, the rds is converted from the columnar store, which R
+        reads directly, so a store is written alongside a pickle
+        """
         filepath = Path(filepath)
-        build_counts_store(matrix, cell_ids, features, save_path=filepath)
+        if filepath.suffix == ".pickle":
+            build_counts_store(matrix, cell_ids, features, save_path=filepath)
+            store_path = filepath.with_suffix(".counts") if create_rds else None
+        else:
+            store_path = filepath
+        if store_path is not None:
+            CountsStore(matrix, cell_ids, features).save(store_path)
         if create_rds:
-            Convert.pickle_to_rds_dir(filepath.parent)
+            rds_path = store_path.with_suffix(".rds")
+            Convert.store_to_rds(store_path, rds_path)
+
+    @classmethod
+    def _join_features(cls, features_list, join="outer"):
+        """
+        Joined features table, and for each table, either an array mapping its
+        columns to those of the joined table (-1 for dropped columns), or None
+        if the table is identical to the joined table
+        """
+        if join not in ["outer", "inner"]:
+            raise ValueError(f"join must be one of ['outer', 'inner']. Got: {join}")
+        features_list = [cls._normalize_features(features) for features in features_list]
+        reference = features_list[0]
+        if all(np.array_equal(features.values, reference.values) for features in features_list[1:]):
+            return reference, [None] * len(features_list)
+        if join == "outer":
+            features = pd.concat(features_list, ignore_index=True).drop_duplicates(subset="ensgs")
+        else:
+            shared = np.ones(len(reference), dtype=bool)
+            for other in features_list[1:]:
+                shared &= reference["ensgs"].isin(other["ensgs"]).to_numpy()
+            features = reference[shared]
+        features = features.reset_index(drop=True)
+        col_maps = [cls._column_map(other, features) for other in features_list]
+        return features, col_maps
+
+    @staticmethod
+    def _column_map(features: pd.DataFrame, target: pd.DataFrame) -> Optional[np.ndarray]:
+        """
+        Permutation array from the rows of `features` to those of `target`,
+        matched on ensgs (-1 if missing from `target`), or None if identical
+        """
+        if np.array_equal(features.values, target.values):
+            return None
+        target_ensgs = LabelIndex(target["ensgs"])
+        if not target_ensgs.is_unique:
+            raise ValueError("Cannot map features onto a table with duplicated ensgs")
+        col_map = target_ensgs.labels.get_indexer(features["ensgs"])
+        dtype = np.int32 if len(target) <= np.iinfo(np.int32).max else np.int64
+        return col_map.astype(dtype, copy=False)
+
+    @staticmethod
+    def _remap_block(counts, col_map=None):
+        """
+        `data`, `indices`, and `indptr` of `counts` with columns mapped by
+        `col_map`, by rewriting `indices` in a single vectorized pass
+        """
+        if col_map is None:
+            return counts.data, counts.indices, counts.indptr
+        indices = np.take(col_map, counts.indices)
+        keep = indices >= 0
+        if keep.all():
+            return counts.data, indices, counts.indptr
+        kept_cumsum = np.concatenate([[0], np.cumsum(keep)])
+        return counts.data[keep], indices[keep], kept_cumsum[counts.indptr]
+
+    @classmethod
+    def _normalize_features(cls, features):
+        if list(features.columns) == cls.FEATURES_COLUMNS:
+            return features
+        features = features.iloc[:, :2].copy()
+        features.columns = cls.FEATURES_COLUMNS
+        return features
 
     @staticmethod
     def _convert_to_series(df):
@@ -338,7 +468,7 @@ class Counts(csr_matrix):
         @wraps(func)
         def wrapper(counts, *args, **kwargs):
             matrix = func(counts._matrix, *args, **kwargs)
-            return counts.__class__(matrix, counts.cell_ids, counts.genes)
+            return counts.__class__(matrix, counts.cell_ids, counts.features)
 
         return wrapper
 
@@ -1,2 +1,80 @@
+import os
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from cellforest.structures.LabelIndex import LabelIndex
+from cellforest.utils.sparse import take_rows
+
+
 class CountsStore:
-    pass
+    """
+    Intermediate data store for `Counts`. It is either pickled as a whole
+    (legacy `rna.pickle` format) or written as a columnar directory, where the
+    CSR arrays are stored as `.npy` files, which can be memory-mapped, and the
+    cell ids and features are stored as parquet.
+    """
+
+    ARRAY_NAMES = ["data", "indices", "indptr"]
+    CELL_IDS_FILENAME = "cell_ids.parquet"
+    FEATURES_FILENAME = "features.parquet"
+    _CELL_IDS_COLUMN = "cell_id"
+
+    def __init__(self, matrix=None, cell_ids=None, features=None):
+        self.matrix = matrix
+        self.cell_ids = cell_ids
+        self.features = features
+
+    def save(self, dirpath: Union[str, Path]):
+        """Write columnar store to `dirpath`"""
+        dirpath = Path(dirpath)
+        os.makedirs(dirpath, exist_ok=True)
+        matrix = csr_matrix(self.matrix)
+        for name in self.ARRAY_NAMES:
+            np.save(dirpath / f"{name}.npy", getattr(matrix, name))
+        self.save_metadata(dirpath)
+
+    def save_metadata(self, dirpath: Union[str, Path]):
+        """Write `cell_ids` and `features` parquet files to `dirpath`"""
+        dirpath = Path(dirpath)
+        cell_ids = self.cell_ids.iloc[:, 0] if isinstance(self.cell_ids, pd.DataFrame) else self.cell_ids
+        cell_ids = pd.DataFrame({self._CELL_IDS_COLUMN: np.asarray(cell_ids, dtype=str)})
+        cell_ids.to_parquet(dirpath / self.CELL_IDS_FILENAME, index=False)
+        features = self.features.copy()
+        features.columns = features.columns.astype(str)
+        features.to_parquet(dirpath / self.FEATURES_FILENAME, index=False)
+
+    @classmethod
+    def load(
+        cls, dirpath: Union[str, Path], mmap: bool = False, cells: Optional[Iterable[str]] = None
+    ) -> "CountsStore":
+        """
+        Read columnar store from `dirpath`. If `mmap`, the CSR arrays are
+        memory-mapped rather than read, so only the pages which are accessed
+        (e.g. by slicing) are read from disk.
+        If `cells` are specified, only the rows for those `cell_id`s are read,
+        in the order given. `cell_id`s missing from the store are dropped, as
+        in `Counts` slicing
+        """
+        dirpath = Path(dirpath)
+        mmap_mode = "r" if (mmap or cells is not None) else None
+        data, indices, indptr = [np.load(dirpath / f"{name}.npy", mmap_mode=mmap_mode) for name in cls.ARRAY_NAMES]
+        features = pd.read_parquet(dirpath / cls.FEATURES_FILENAME)
+        cell_ids = pd.read_parquet(dirpath / cls.CELL_IDS_FILENAME)
+        shape = (len(indptr) - 1, len(features))
+        matrix = csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        if cells is not None:
+            rows = LabelIndex(cell_ids[cls._CELL_IDS_COLUMN]).get_positions(cells)
+            # only the `indptr` ranges of `rows` are read from the memory-mapped arrays
+            matrix = take_rows(matrix, rows)
+            cell_ids = cell_ids.iloc[rows].reset_index(drop=True)
+        return cls(matrix, cell_ids, features)
+
+    @staticmethod
+    def is_store(path: Union[str, Path]) -> bool:
+        """Whether `path` is a columnar store directory"""
+        path = Path(path)
+        return path.is_dir() and (path / CountsStore.FEATURES_FILENAME).exists()
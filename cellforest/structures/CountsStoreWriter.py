@@ -0,0 +1,141 @@
+import os
+import shutil
+import struct
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from cellforest.structures.CountsStore import CountsStore
+
+
+class CountsStoreWriter:
+    """
+    Incrementally writes a `CountsStore` directory by appending blocks of rows
+    (e.g. 10X lanes), so that no more than one block needs to be held in
+    memory. `data` and `indices` are streamed straight into their `.npy` files
+    behind a fixed-size header, which is rewritten with the final length on
+    `close`. `indptr` and `cell_ids`, which are small, are kept in memory until
+    `close`. `indices` are streamed as int32 and widened on `close`, along
+    with `indptr`, to int64 only if the number of entries or the shape needs
+    it, so that both are in the index dtype scipy expects and load without a
+    copy. If the block loop raises, the partial store is removed
+    Example:
+        with CountsStoreWriter(save_dir / "rna.counts") as writer:
+            for path in paths:
+                writer.append(Counts.from_cellranger(path))
+    """
+
+    _NPY_MAGIC = b"\x93NUMPY\x01\x00"
+    _NPY_HEADER_SIZE = 128
+    _INDICES_DTYPE = np.dtype(np.int32)
+    _WIDEN_CHUNK_SIZE = 2**26
+
+    def __init__(self, dirpath: Union[str, Path]):
+        self.dirpath = Path(dirpath)
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.features = None
+        self.rows_per_block = []
+        self._data_dtype = None
+        self._nnz = 0
+        self._indptr_blocks: List[np.ndarray] = [np.zeros(1, dtype=np.int64)]
+        self._cell_ids_blocks: List[pd.Series] = []
+        self._data_file = open(self.dirpath / "data.npy", "wb")
+        self._indices_file = open(self.dirpath / "indices.npy", "wb")
+        self._data_file.write(b"\x00" * self._NPY_HEADER_SIZE)
+        self._indices_file.write(b"\x00" * self._NPY_HEADER_SIZE)
+
+    @property
+    def n_rows(self) -> int:
+        return sum(self.rows_per_block)
+
+    def append(self, counts, cell_ids: Optional[pd.Series] = None, features: Optional[pd.DataFrame] = None):
+        """
+        Append the rows of `counts`, which is either `Counts` or a CSR matrix
+        with its `cell_ids` and `features` specified separately. Every block
+        must have the same features as the first
+        """
+        cell_ids = counts.cell_ids if cell_ids is None else cell_ids
+        features = counts.features if features is None else features
+        self._check_features(features)
+        matrix = csr_matrix(counts)
+        matrix.sort_indices()
+        if self._data_dtype is None:
+            self._data_dtype = matrix.data.dtype
+        self._data_file.write(np.ascontiguousarray(matrix.data, dtype=self._data_dtype).tobytes())
+        self._indices_file.write(np.ascontiguousarray(matrix.indices, dtype=self._INDICES_DTYPE).tobytes())
+        self._indptr_blocks.append(matrix.indptr[1:].astype(np.int64) + self._nnz)
+        self._nnz += matrix.nnz
+        self._cell_ids_blocks.append(pd.Series(np.asarray(cell_ids).ravel()))
+        self.rows_per_block.append(matrix.shape[0])
+
+    def close(self):
+        """Finalize `.npy` headers and write `indptr`, `cell_ids`, and `features`"""
+        if self._data_file.closed:
+            return
+        data_dtype = self._data_dtype or np.dtype(np.float64)
+        self._close_npy(self._data_file, data_dtype)
+        self._close_npy(self._indices_file, self._INDICES_DTYPE)
+        n_features = len(self.features) if self.features is not None else 0
+        index_dtype = self._get_index_dtype(self._nnz, self.n_rows, n_features)
+        if index_dtype != self._INDICES_DTYPE:
+            self._widen_indices(index_dtype)
+        np.save(self.dirpath / "indptr.npy", np.concatenate(self._indptr_blocks).astype(index_dtype, copy=False))
+        cell_ids = pd.concat(self._cell_ids_blocks, ignore_index=True) if self._cell_ids_blocks else pd.Series([])
+        features = self.features if self.features is not None else pd.DataFrame(columns=["ensgs", "genes"])
+        store = CountsStore(cell_ids=cell_ids, features=features)
+        store.save_metadata(self.dirpath)
+
+    def discard(self):
+        """Close without finalizing, and remove the partial store"""
+        self._data_file.close()
+        self._indices_file.close()
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    @staticmethod
+    def _get_index_dtype(nnz: int, n_rows: int, n_features: int) -> np.dtype:
+        """int32 unless a value could overflow it, as in `scipy.sparse` index dtype selection"""
+        fits_int32 = max(nnz, n_rows, n_features) <= np.iinfo(np.int32).max
+        return np.dtype(np.int32) if fits_int32 else np.dtype(np.int64)
+
+    def _widen_indices(self, dtype: np.dtype):
+        """Rewrite the streamed `indices` in `dtype`, a chunk at a time"""
+        path = self.dirpath / "indices.npy"
+        tmp_path = self.dirpath / "indices.tmp.npy"
+        indices = np.load(path, mmap_mode="r")
+        widened = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=indices.shape)
+        for lo in range(0, len(indices), self._WIDEN_CHUNK_SIZE):
+            widened[lo : lo + self._WIDEN_CHUNK_SIZE] = indices[lo : lo + self._WIDEN_CHUNK_SIZE]
+        widened.flush()
+        del indices, widened
+        os.replace(tmp_path, path)
+
+    def _check_features(self, features: pd.DataFrame):
+        if self.features is None:
+            self.features = features
+        elif not np.array_equal(features.values, self.features.values):
+            raise ValueError(f"Features of block {len(self.rows_per_block)} differ from those of the first block")
+
+    def _close_npy(self, f, dtype: np.dtype):
+        f.seek(0)
+        f.write(self._npy_header(dtype, self._nnz))
+        f.close()
+
+    @classmethod
+    def _npy_header(cls, dtype: np.dtype, length: int) -> bytes:
+        """`.npy` (v1.0) header for a 1D array, padded to a fixed size"""
+        header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (length,)})
+        header_len = cls._NPY_HEADER_SIZE - len(cls._NPY_MAGIC) - 2
+        header = header.ljust(header_len - 1).encode("latin1") + b"\n"
+        return cls._NPY_MAGIC + struct.pack("<H", header_len) + header
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
@@ -0,0 +1,35 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+
+class LabelIndex:
+    """
+    Hashed lookup from labels (`cell_id`s, gene names, or ensgs) to integer
+    positions along one axis of `Counts`. The hash table is built by pandas on
+    the first lookup and cached on the underlying `pd.Index`, so it is reused
+    by every subsequent lookup, and by any slice which doesn't change the axis
+    """
+
+    def __init__(self, labels: Iterable[str]):
+        self.labels = pd.Index(labels)
+
+    @property
+    def is_unique(self) -> bool:
+        return self.labels.is_unique
+
+    def get_positions(self, keys: Iterable[str]) -> np.ndarray:
+        """
+        Integer positions of `keys` in key order. Keys which are not found are
+        dropped, and duplicated labels (e.g. gene names) return all of their
+        positions
+        """
+        if self.is_unique:
+            positions = self.labels.get_indexer(keys)
+        else:
+            positions = self.labels.get_indexer_non_unique(keys)[0]
+        return positions[positions >= 0]
+
+    def __len__(self):
+        return len(self.labels)
@@ -0,0 +1,92 @@
+from typing import Any, Dict, Hashable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+
+class SelectionIndex:
+    """
+    Equality selection and grouping over columns of cell metadata. Each
+    column is encoded to integer codes once, on first use, along with the
+    sorted row positions of each of its values. A selection starts from the
+    rows of the rarest value and narrows them with the codes of the other
+    columns, so that its cost scales with the selected rows rather than all
+    rows, and a group-by over several columns partitions rows in one pass
+    over their combined codes
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._codes = {}
+        self._uniques = {}
+        self._value_rows = {}
+
+    def select(self, selection: Dict[str, Any]) -> np.ndarray:
+        """Sorted row positions where every column in `selection` equals its value"""
+        if not selection:
+            return np.arange(len(self.df))
+        candidates = [(col, self._get_code(col, value)) for col, value in selection.items()]
+        if any(code < 0 for _, code in candidates):
+            return np.array([], dtype=np.intp)
+        candidates.sort(key=lambda x: len(self._get_value_rows(x[0])[x[1]]))
+        (col, code), others = candidates[0], candidates[1:]
+        rows = self._get_value_rows(col)[code]
+        for col, code in others:
+            rows = rows[self._get_codes(col)[rows] == code]
+        return rows
+
+    def groups(self, by: Union[str, List[str]]) -> Dict[Hashable, np.ndarray]:
+        """
+        Row positions of each group of `by` in sorted order of group names,
+        as in `pd.DataFrame.groupby(by).indices`. Rows with missing values in
+        any of `by` are dropped
+        """
+        keys = by if isinstance(by, list) else [by]
+        codes = [self._get_codes(col) for col in keys]
+        valid = np.flatnonzero(np.logical_and.reduce([c >= 0 for c in codes]))
+        if not len(valid):
+            return {}
+        sizes = [len(self._uniques[col]) for col in keys]
+        group_codes = np.ravel_multi_index(tuple(c[valid] for c in codes), sizes)
+        order = np.argsort(group_codes, kind="stable")
+        sorted_codes = group_codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        groups = {}
+        for start, rows in zip(starts, np.split(valid[order], starts[1:])):
+            value_codes = np.unravel_index(sorted_codes[start], sizes)
+            names = tuple(self._uniques[col][code] for col, code in zip(keys, value_codes))
+            groups[names if isinstance(by, list) else names[0]] = rows
+        return groups
+
+    def take(self, rows: np.ndarray, df: Optional[pd.DataFrame] = None) -> "SelectionIndex":
+        """
+        Index of the selection of `rows` (e.g. `df = self.df.iloc[rows]`),
+        which reuses the encodings of this index rather than encoding again
+        """
+        index = self.__class__(self.df.iloc[rows] if df is None else df)
+        for col, codes in self._codes.items():
+            if col not in index.df.columns:
+                continue
+            index._codes[col] = codes[rows]
+            index._uniques[col] = self._uniques[col]
+        return index
+
+    def _get_code(self, col: str, value: Any) -> int:
+        self._get_codes(col)
+        return int(self._uniques[col].get_indexer([value])[0])
+
+    def _get_codes(self, col: str) -> np.ndarray:
+        if col not in self._codes:
+            codes, uniques = pd.factorize(self.df[col], sort=True)
+            self._codes[col] = codes
+            self._uniques[col] = pd.Index(uniques)
+        return self._codes[col]
+
+    def _get_value_rows(self, col: str) -> List[np.ndarray]:
+        """Sorted row positions of each value of `col`, by code"""
+        if col not in self._value_rows:
+            codes = self._get_codes(col)
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(self._uniques[col]) + 1))
+            self._value_rows[col] = [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+        return self._value_rows[col]
@@ -1,17 +1,24 @@
-from typing import List, Union
+import multiprocessing
+from typing import Callable, List, Optional, Sequence, Union
 
 from dataforest.processes.core.BatchMethods import BatchMethods
 
-# from scgsea.GSEAGroup import GSEAGroup
 import pandas as pd
 
 from cellforest.templates.CellForest import CellForest
 
+# state inherited by forked workers, so that forests and matrices aren't pickled
+_FORK_STATE = {}
+
 
 class BatchMethodsSC(BatchMethods):
     @staticmethod
     def gsea_bulk(
-        forest: CellForest, batch_vars: Union[str, list, set, tuple], overwrite: bool = False, **kwargs,
+        forest: CellForest,
+        batch_vars: Union[str, list, set, tuple],
+        overwrite: bool = False,
+        n_workers: Optional[int] = None,
+        **kwargs,
     ) -> pd.DataFrame:
         """
         Run multiple GSEAs over a set of varying conditions as specified by
@@ -27,16 +34,29 @@ class BatchMethodsSC(BatchMethods):
             forest:
             batch_vars:
             overwrite:
+            n_workers: number of forked worker processes to run groups in
+                parallel, which share the parent's `rna` read-only rather
+                than receiving pickled copies. Groups are run sequentially
+                if `None` or 1
             **kwargs:
 
         Returns:
             gsea_grp:
         """
+        from scgsea.GSEAGroup import GSEAGroup
+
         gsea_grp = GSEAGroup(forest, batch_vars, "gsea")
-        for grp_vals in gsea_grp.groups:
-            BatchMethodsSC.logger.info(f"Running GSEA for {grp_vals}")
-            gsea_grp.run_grp(grp_vals, **kwargs)
-        return gsea_grp.group_results_df
+        if not n_workers or n_workers == 1:
+            for grp_vals in gsea_grp.groups:
+                BatchMethodsSC.logger.info(f"Running GSEA for {grp_vals}")
+                gsea_grp.run_grp(grp_vals, **kwargs)
+            return gsea_grp.group_results_df
+        # loaded before forking, so that workers share it
+        forest.rna
+        tasks = list(gsea_grp.groups)
+        state = {"gsea_grp": gsea_grp, "kwargs": kwargs}
+        results = BatchMethodsSC._fork_map(BatchMethodsSC._run_gsea_grp, tasks, state, n_workers)
+        return pd.concat(results) if results else pd.DataFrame()
 
     @staticmethod
     def gsea_bulk_repeat(
@@ -44,11 +64,36 @@ class BatchMethodsSC(BatchMethods):
         batch_vars: Union[str, list, set, tuple],
         overwrite: bool = True,
         n_repeat: int = 20,
+        n_workers: Optional[int] = None,
         **kwargs,
     ) -> List[pd.DataFrame]:
+        """`gsea_bulk` `n_repeat` times, plotting only the first run unless `shuffling`"""
         group_results_df_list = []
         for i in range(n_repeat):
             if kwargs.get("shuffling", False) or i > 0:
-                kwargs["no_plot"] = True
-            group_results_df_list.append(BatchMethodsSC.gsea_bulk(forest, batch_vars, overwrite, **kwargs))
+                kwargs = {**kwargs, "no_plot": True}
+            group_results_df_list.append(BatchMethodsSC.gsea_bulk(forest, batch_vars, overwrite, n_workers, **kwargs))
         return group_results_df_list
+
+    @staticmethod
+    def _run_gsea_grp(grp_vals: tuple) -> pd.DataFrame:
+        """Run one group in a forked worker, and return its results"""
+        gsea_grp = _FORK_STATE["gsea_grp"]
+        BatchMethodsSC.logger.info(f"Running GSEA for {grp_vals}")
+        gsea_grp.run_grp(grp_vals, **_FORK_STATE["kwargs"])
+        return gsea_grp.group_results_df
+
+    @staticmethod
+    def _fork_map(func: Callable, tasks: Sequence, state: dict, n_workers: int) -> list:
+        """
+        `func` over `tasks` in a pool of `n_workers` forked processes, in order.
+        `state` is visible to workers in `_FORK_STATE` through fork, without
+        pickling. Each worker runs a single task, so that it starts from the
+        parent's state, rather than from the state left by a previous task
+        """
+        _FORK_STATE.update(state)
+        try:
+            with multiprocessing.get_context("fork").Pool(n_workers, maxtasksperchild=1) as pool:
+                return pool.map(func, tasks, chunksize=1)
+        finally:
+            _FORK_STATE.clear()
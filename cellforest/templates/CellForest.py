@@ -5,14 +5,17 @@ from typing import Optional, Union, List
 
 from dataforest.core.DataForest import DataForest
 from dataforest.utils.utils import label_df_partitions, update_recursive
+import numpy as np
 import pandas as pd
 
 from cellforest.structures.Counts import Counts
+from cellforest.structures.SelectionIndex import SelectionIndex
 from cellforest.templates.PlotMethodsSC import PlotMethodsSC
 from cellforest.templates.ReaderMethodsSC import ReaderMethodsSC
 from cellforest.templates.SpecSC import SpecSC
 from cellforest.templates.WriterMethodsSC import WriterMethodsSC
 from cellforest.utils.cellranger.DataMerge import DataMerge
+from cellforest.utils.metadata import read_meta
 
 
 class CellForest(DataForest):
@@ -42,24 +45,42 @@ class CellForest(DataForest):
             "umap_embeddings": {"header": "infer", "index_col": 0},
         },
         "combine": {"cell_metadata": {"header": 0}},
-        # 'normalize': {
-        #     'cell_ids': {'index_col': 0}},
-        "cluster": {"clusters": {"index_col": 0}},
+        "normalize": {"variable_features": {"header": 0}},
+        "cluster": {"clusters": {"index_col": 0}, "clusters_sweep": {"header": 0, "index_col": 0}},
         "diffexp": {"diffexp_result": {"header": 0}},
     }
     _METADATA_NAME = "meta"
-    _COPY_KWARGS = {**DataForest._COPY_KWARGS, "unversioned": "unversioned"}
+    _COPY_KWARGS = {**DataForest._COPY_KWARGS, "unversioned": "unversioned", "meta_columns": "_meta_columns"}
+    _SPEC_COLUMN_KEYS = {"subset", "filter", "partition"}
+    # downstream outputs attached to `meta`: process -> (file alias, columns added)
+    _DOWNSTREAM_META = {
+        "normalize": ("cell_ids", ()),
+        "dim_reduce": ("umap_embeddings", ("UMAP_1", "UMAP_2")),
+        "cluster": ("clusters", ("cluster_id",)),
+    }
     _ASSAY_OPTIONS = ["rna", "vdj", "surface", "antigen", "cnv", "atac", "spatial", "crispr"]
     _DEFAULT_CONFIG = Path(__file__).parent.parent / "config/process_schema.yaml"
 
-    def __init__(self, root_dir, spec_dict=None, verbose=False, meta=None, config=None, unversioned=None):
+    def __init__(
+        self, root_dir, spec_dict=None, verbose=False, meta=None, config=None, unversioned=None, meta_columns=None
+    ):
         super().__init__(root_dir, spec_dict, verbose, config)
+        # columns of `meta.parquet` to read, in addition to those used by `spec_dict` (all if `None`)
+        self._meta_columns = list(meta_columns) if meta_columns is not None else None
+        self._spec_columns = self._get_spec_columns(spec_dict)
         self.assays = set()
         self._rna = None
+        self._parent_rna = None
+        self._selection_index = None
         self._meta_unfiltered = None
-        if meta is not None:
-            meta = meta.copy()
-        self._meta = self.get_cell_meta(meta)
+        # base metadata, parsed once, and modification times of the downstream outputs attached to `_meta`
+        self._meta_base = None
+        self._meta_versions = {}
+        # whether downstream outputs may have changed since they were last checked, see `refresh_meta`
+        self._meta_stale = True
+        # `meta` is shared rather than copied, and only filtered on first access
+        self._meta_input = meta
+        self._meta = None
         # TODO: use this to augment strings of output directories so manual tinkers don't
         #   affect downstream processing
         if meta is not None and unversioned is None:
@@ -90,15 +111,31 @@ class CellForest(DataForest):
         Primarily for this reason, this is the preferred interface to metadata
         over direct file access.
         """
-        # TODO: add embeddings and cluster ids
         if self._meta is None:
-            self._meta = self.get_cell_meta()
-        elif "dim_reduce" in self.spec and "UMAP_1" not in self._meta.columns:
-            if self["dim_reduce"].done:
+            meta_input, self._meta_input = self._meta_input, None
+            if meta_input is not None:
+                # a shallow copy, so that added columns aren't added to a parent's `meta`
+                self._meta = self.get_cell_meta(meta_input.copy(deep=False))
+                # the versions of the columns it already has are found with the next check
+                self._meta_versions = None
+            else:
                 self._meta = self.get_cell_meta()
-        elif "cluster" in self.spec and "cluster_id" not in self._meta.columns:
-            if self["cluster"].done:
+                self._meta_stale = False
+        if not self._meta_stale:
+            return self._meta
+        self._meta_stale = False
+        versions = self._get_downstream_versions()
+        if self._meta_versions is None:
+            self._meta_versions = self._get_attached_versions(self._meta, versions)
+        changed = [k for k, version in versions.items() if self._meta_versions.get(k) != version]
+        if changed:
+            added_columns = {col for process_name in changed for col in self._DOWNSTREAM_META[process_name][1]}
+            if set(changed) & set(self._meta_versions) or added_columns & self._spec_columns:
+                # outputs replaced, or needed for `subset`/`filter`, so reassemble from the cached base metadata
                 self._meta = self.get_cell_meta()
+            else:
+                self._meta = self._meta_add_downstream_data(self._meta, changed)
+                self._meta_versions.update({process_name: versions[process_name] for process_name in changed})
         return self._meta
 
     @property
@@ -108,17 +145,22 @@ class CellForest(DataForest):
         around `scipy.sparse.csr_matrix`, which allows for slicing with
         `cell_id`s and `gene_name`s.
         """
+        if self._rna is None and self._parent_rna is not None:
+            # child forests slice the rows of their parent's counts rather than reading them again
+            self._rna, self._parent_rna = self._parent_rna[self.meta.index], None
         if self._rna is None:
             # TODO: set to use normalized if exists by default -- see old version
             # TODO: soft code filenames
-            counts_path = self.root_dir / "rna.pickle"
+            counts_path = self.root_dir / "rna.counts"
+            if not counts_path.exists():
+                counts_path = self.root_dir / "rna.pickle"
             if not counts_path.exists():
                 raise FileNotFoundError(
                     f"Ensure that you initialized the root directory with CellForest.from_metadata or "
                     f"CellForest.from_input_dirs. Not found: {counts_path}"
                 )
-            self._rna = Counts.load(counts_path)
-            self._rna = self._rna[self.meta.index]
+            # only rows in `meta` are read from a columnar store
+            self._rna = Counts.load(counts_path, cells=self.meta.index)
         return self._rna
 
     @property
@@ -167,7 +209,12 @@ class CellForest(DataForest):
         """
         if isinstance(by, (tuple, set)):
             by = list(by)
-        for (name, df) in self.meta.groupby(by, **kwargs):
+        # row positions of all groups in a single pass, which children select from `self.meta`
+        if kwargs:
+            groups = self.meta.groupby(by, **kwargs).indices
+        else:
+            groups = self.selection_index.groups(by)
+        for name, rows in groups.items():
             if isinstance(by, list):
                 if isinstance(name, (list, tuple)):
                     subset_dict = dict(zip(by, name))
@@ -175,9 +222,15 @@ class CellForest(DataForest):
                     subset_dict = {by[0]: name}
             else:
                 subset_dict = {by: name}
-            forest = self.get_subset(subset_dict)
-            # forest._meta = df
-            yield name, forest
+            yield name, self._get_child(self._get_compartment_spec("subset", subset_dict), rows)
+
+    @property
+    def selection_index(self) -> SelectionIndex:
+        """`SelectionIndex` over `self.meta`, rebuilt when `meta` is replaced"""
+        meta = self.meta
+        if self._selection_index is None or self._selection_index.df is not meta:
+            self._selection_index = SelectionIndex(meta)
+        return self._selection_index
 
     @property
     def unversioned(self):
@@ -187,14 +240,24 @@ class CellForest(DataForest):
         if kwargs.get("meta", None) is not None:
             kwargs["unversioned"] = True
         if not kwargs:
-            kwargs["meta"] = self._meta  # save compute if no modifications
+            # save compute if no modifications
+            kwargs["meta"] = self._meta if self._meta is not None else self._meta_input
         base_kwargs = self._get_copy_base_kwargs()
         kwargs = {**base_kwargs, **kwargs}
-        kwargs = {k: deepcopy(v) for k, v in kwargs.items()}
+        # `meta` is shared copy-on-write, rather than deep copied
+        kwargs = {k: v if k == "meta" else deepcopy(v) for k, v in kwargs.items()}
         if reset:
             kwargs = base_kwargs
         return self.__class__(**kwargs)
 
+    def refresh_meta(self):
+        """
+        Check for downstream outputs (e.g. UMAP, clusters) added or replaced
+        since `meta` was built on its next access. Called after each process
+        run, so it's only needed for outputs changed outside of this forest
+        """
+        self._meta_stale = True
+
     @property
     def meta_unfiltered(self) -> pd.DataFrame:
         # TODO: not used anywhere, figure out use and add docstring or delete
@@ -203,81 +266,165 @@ class CellForest(DataForest):
     def set_partition(self, process_name: Optional[str] = None, encodings=True):
         """Add columns to metadata to indicate partition from spec"""
         columns = self.spec[process_name]["partition"]
-        self._meta = label_df_partitions(self.meta, columns, encodings)
+        self._meta = label_df_partitions(self.meta.copy(deep=False), columns, encodings)
 
     def get_cell_meta(self, df=None):
-        # TODO: MEMORY DUPLICATION - we want to keep file access pure?
+        """
+        `df`, or the base metadata with the available downstream outputs
+        attached if `None`, subset, filtered and partitioned according to
+        `self.spec`
+        """
         if df is None:
+            versions = self._get_downstream_versions()
+            df = self._meta_add_downstream_data(self._get_meta_base(), list(versions))
+            self._meta_versions = versions
+        df = self._subset_filter(df, self.spec, self.schema)
+        if self.spec.partition_set:
+            df = label_df_partitions(df, self.spec.partition_set, encodings=True)
+        return df
+
+    def _get_meta_base(self) -> pd.DataFrame:
+        """Metadata from the root, before downstream outputs are attached, parsed once per forest"""
+        if self._meta_base is None:
             # TODO: fix this
-            try:
-                # df = self.f["cell_metadata"].copy()
-                df = pd.read_csv(self.root_dir / "meta.tsv", sep="\t", index_col=0)
-            except FileNotFoundError:
-                df = pd.DataFrame(self.rna.cell_ids.copy())
-                df.columns = ["cell_id"]
-                df.index = df["cell_id"]
-                df.drop(columns=["cell_id"], inplace=True)
-            df.replace(" ", "_", regex=True, inplace=True)
+            meta_path = self.root_dir / "meta.parquet"
+            if meta_path.exists():
+                # string columns are stored as categoricals with spaces already replaced
+                df = read_meta(meta_path, columns=self._get_meta_columns())
+            else:
+                try:
+                    # df = self.f["cell_metadata"].copy()
+                    df = pd.read_csv(self.root_dir / "meta.tsv", sep="\t", index_col=0)
+                except FileNotFoundError:
+                    df = pd.DataFrame(self.rna.cell_ids.copy())
+                    df.columns = ["cell_id"]
+                    df.index = df["cell_id"]
+                    df.drop(columns=["cell_id"], inplace=True)
+                df.replace(" ", "_", regex=True, inplace=True)
             if "to_bucket_var" in df and "bucketed_var" not in df:
                 df["bucketed_var"] = pd.cut(df["to_bucket_var"], bins=(0, 20, 40, 60, 80), labels=(10, 30, 50, 70),)
             if "str_var_preprocessed" in df and "str_var_processed" not in df:
                 df["str_var_processed"] = df["str_var_preprocessed"].str.extract(r"([A-Z]\d)")
-            # TODO: fill in once `process_run.done` feature is ready
-            df = self._meta_add_downstream_data(df)
-        df = self._subset_filter(df, self.spec, self.schema)
-        if self.spec.partition_set:
-            df = label_df_partitions(df, self.spec.partition_set, encodings=True)
-        return df
+            self._meta_base = df
+        # shallow, so that attached columns don't reach the cached base
+        return self._meta_base.copy(deep=False)
+
+    def _get_meta_columns(self) -> Optional[List[str]]:
+        """Columns to read from `meta.parquet`, or `None` for all of them"""
+        if self._meta_columns is None:
+            return None
+        columns = self._meta_columns + sorted(self._spec_columns - set(self._meta_columns))
+        if "bucketed_var" in columns:
+            columns.append("to_bucket_var")
+        if "str_var_processed" in columns:
+            columns.append("str_var_preprocessed")
+        return columns
+
+    @classmethod
+    def _get_spec_columns(cls, spec) -> set:
+        """Metadata columns referenced by a `subset`, `filter` or `partition` anywhere in `spec`"""
+        columns = set()
+        if isinstance(spec, dict):
+            for key, val in spec.items():
+                if key in cls._SPEC_COLUMN_KEYS:
+                    columns.update(cls._get_compartment_columns(val))
+                else:
+                    columns.update(cls._get_spec_columns(val))
+        elif isinstance(spec, (list, tuple)):
+            for val in spec:
+                columns.update(cls._get_spec_columns(val))
+        return columns
+
+    @classmethod
+    def _get_compartment_columns(cls, compartment) -> set:
+        if isinstance(compartment, str):
+            return {compartment}
+        if isinstance(compartment, dict):
+            return set(compartment)
+        if isinstance(compartment, (list, tuple, set)):
+            return set().union(*[cls._get_compartment_columns(x) for x in compartment])
+        return set()
+
+    def _get_downstream_versions(self) -> dict:
+        """Modification time of each available downstream output attached to `meta`, by process"""
+        versions = {}
+        for process_name, (file_alias, _) in self._DOWNSTREAM_META.items():
+            if process_name in self.spec and self[process_name].done:
+                path = Path(self[process_name].path_map[file_alias])
+                if path.exists():
+                    versions[process_name] = path.stat().st_mtime_ns
+        return versions
 
-    def _meta_add_downstream_data(self, df):
-        done = set()
-        if "cluster" in self.spec:
-            if self["cluster"].done:
-                done.update({"normalize", "dim_reduce", "cluster"})
-        if not done and "dim_reduce" in self.spec:
-            if self["dim_reduce"].done:
-                done.update({"normalize", "dim_reduce"})
-        if not done and "normalize" in self.spec:
-            if self["normalize"].done:
-                done.update({"normalize"})
-        if "cluster" in done:
-            clusters = self.f["cluster"]["clusters"].copy()
-            clusters.rename(columns={1: "cluster_id"}, inplace=True)
-            df = df.merge(clusters, how="left", left_index=True, right_index=True)
+    def _get_attached_versions(self, df: pd.DataFrame, versions: dict) -> dict:
+        """Of `versions`, those of the downstream outputs whose columns `df` already has, e.g. from a parent forest"""
+        return {k: v for k, v in versions.items() if set(self._DOWNSTREAM_META[k][1]).issubset(df.columns)}
+
+    def _meta_add_downstream_data(self, df: pd.DataFrame, process_names: List[str]) -> pd.DataFrame:
+        """
+        Attach the outputs of `process_names` to `df` by position, replacing
+        any previous version of their columns. `normalize` keeps only its
+        filtered cells
+        """
+        if "cluster" in process_names:
+            clusters = self.f["cluster"]["clusters"].rename(columns={1: "cluster_id"})
+            df = self._join_by_position(df, clusters)
             df["cluster_id"] = df["cluster_id"].astype(pd.Int16Dtype())
-        if "dim_reduce" in done:
-            df = df.merge(self.f["dim_reduce"]["umap_embeddings"], how="left", left_index=True, right_index=True)
-        if "normalize" in done:
-            pass
-            # df = df[df.index.isin(self.f["normalize"]["cell_ids"][0])]
-        # TODO: temp during param mismatch
-        try:
-            df = df[df.index.isin(self.f["normalize"]["cell_ids"][0])]
-        except Exception:
-            self.logger.info("Could not find filtered cell ids. Using all cells in metadata")
+        if "dim_reduce" in process_names:
+            df = self._join_by_position(df, self.f["dim_reduce"]["umap_embeddings"])
+        if "normalize" in process_names:
+            rows = np.flatnonzero(pd.Index(self.f["normalize"]["cell_ids"][0]).get_indexer(df.index) >= 0)
+            if len(rows) < len(df):
+                df = df.iloc[rows]
+        return df
+
+    @staticmethod
+    def _join_by_position(df: pd.DataFrame, other: pd.DataFrame) -> pd.DataFrame:
+        """Columns of `other` aligned to the rows of `df` with `get_indexer`, NA where missing"""
+        indexer = other.index.get_indexer(df.index)
+        df = df.copy(deep=False)
+        for col in other.columns:
+            df[col] = pd.api.extensions.take(other[col].to_numpy(), indexer, allow_fill=True)
         return df
 
     def _get_compartment_updated(self, compartment_name: str, update: dict) -> "CellForest":
         """
 
         """
+        spec = self._get_compartment_spec(compartment_name, update)
+        rows = self.selection_index.select(update)
+        if not len(rows):
+            raise ValueError(f"No cells match {compartment_name} {update}")
+        if compartment_name == "filter":
+            keep = np.ones(len(self.meta), dtype=bool)
+            keep[rows] = False
+            rows = np.flatnonzero(keep)
+        elif compartment_name != "subset":
+            raise ValueError(f"compartment_name must be one of ['subset', 'filter']. Got: {compartment_name}")
+        return self._get_child(spec, rows)
+
+    def _get_compartment_spec(self, compartment_name: str, update: dict) -> dict:
         if compartment_name in self.ROOT_LEVEL_COMPARTMENTS:
-            spec = update_recursive(self.spec, update, inplace=False)
-        else:
-            spec = update_recursive(self.spec, {compartment_name: update}, inplace=False)
+            return update_recursive(self.spec, update, inplace=False)
+        return update_recursive(self.spec, {compartment_name: update}, inplace=False)
+
+    def _get_child(self, spec: dict, rows: np.ndarray) -> "CellForest":
+        """
+        Forest with `spec` whose `meta` is the selection of `rows` (integer
+        positions) from `self.meta`, so that it isn't re-read and re-filtered.
+        Downstream columns (e.g. UMAP, clusters) are dropped, since the child's
+        process runs differ from the parent's, and are attached from the
+        child's own runs. If `self.rna` is loaded, the child's `rna` is sliced
+        from it on access
+        """
         forest = self.copy(spec_dict=spec)
-        bool_selector = pd.concat([forest.meta[key] == value for key, value in update.items()], axis=1).all(axis=1)
-        if sum(bool_selector) == 0:
-            import ipdb
-
-            ipdb.set_trace()
-        if compartment_name == "subset":
-            forest._meta = forest.meta[bool_selector]
-        elif compartment_name == "filter":
-            forest._meta = forest.meta[~bool_selector]
-        else:
-            raise ValueError()
-        forest._rna = forest.counts[forest.meta.index]
+        downstream_columns = [col for _, columns in self._DOWNSTREAM_META.values() for col in columns]
+        forest._meta = self.meta.iloc[rows].drop(columns=downstream_columns, errors="ignore")
+        forest._meta_input = None
+        forest._meta_versions = {}
+        if self._selection_index is not None and self._selection_index.df is self._meta:
+            # the child's columns are encoded by selecting from the parent's codes
+            forest._selection_index = self._selection_index.take(rows, forest._meta)
+        forest._parent_rna = self._rna if self._rna is not None else self._parent_rna
         return forest
 
     @staticmethod
@@ -319,5 +466,5 @@ class CellForest(DataForest):
     @staticmethod
     def _get_assays(path):
         # TODO: will have to change once decoupled from pickle (e.g. rds, anndata)
-        files = list(filter(lambda x: x.endswith(".pickle"), os.listdir(path)))
+        files = list(filter(lambda x: x.endswith((".pickle", ".counts")), os.listdir(path)))
         return set(map(lambda x: x.split(".")[0], files))
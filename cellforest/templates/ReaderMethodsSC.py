@@ -1,9 +1,12 @@
 import pickle
 
 from dataforest.utils.decorators import default_kwargs
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from scipy import io
+
+from cellforest.utils.cellranger.matrix_market import read_mtx
+from cellforest.utils.metadata import read_meta
 
 
 class ReaderMethodsSC:
@@ -34,10 +37,18 @@ class ReaderMethodsSC:
             mat = pickle.load(f, **kwargs)
         return mat
 
+    @staticmethod
+    def npy(filepath, **kwargs):
+        return np.load(filepath, **kwargs)
+
+    @staticmethod
+    def parquet(filepath, columns=None):
+        return read_meta(filepath, columns=columns)
+
     @staticmethod
     def rds(filepath):
         raise NotImplementedError()
 
     @staticmethod
     def mtx_gz(filepath):
-        return io.mmread(str(filepath)).T
+        return read_mtx(filepath)
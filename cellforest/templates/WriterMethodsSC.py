@@ -1,6 +1,8 @@
 from dataforest.utils.decorators import default_kwargs
 import pandas as pd
 
+from cellforest.utils.metadata import write_meta
+
 
 class WriterMethodsSC:
     TSV_DEFAULTS = {"sep": "\t", "header": None}
@@ -16,6 +18,10 @@ class WriterMethodsSC:
     def tsv_gz(filepath, obj, **kwargs):
         WriterMethodsSC.tsv(filepath, obj, **kwargs)
 
+    @staticmethod
+    def parquet(filepath: str, obj: pd.DataFrame, **kwargs):
+        write_meta(obj, filepath, **kwargs)
+
     @staticmethod
     def pickle(filepath, obj, **kwargs):
         raise NotImplementedError()
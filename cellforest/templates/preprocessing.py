@@ -1,13 +1,16 @@
 import datetime
-import gzip
 import logging
 import os
 import sys
-from subprocess import check_call, check_output
 
 import pandas as pd
 from pathlib import Path
 
+from cellforest.structures.Counts import Counts
+from cellforest.structures.CountsStoreWriter import CountsStoreWriter
+from cellforest.utils.cellranger import CellRangerIO
+from cellforest.utils.cellranger.matrix_market import read_mtx
+
 RESULTS_ROOT_DIRECTORY_PATH = "<RESULTS_ROOT_DIRECTORY_PATH>"
 TENX_RELATIVE_DIRECTORY_PATH = "<TENX_RELATIVE_DIRECTORY_PATH>"
 BD_DEMUX_DIRECTORY_NAME = "bd_demux"
@@ -26,8 +29,8 @@ def load_10x_lane(analysis_output_directory_path):
 
     :param analysis_output_directory_path: Local path to the top level directory of a run of the scrnaseq pipeline
     For example, the folder referred to in the `analysis_output_path` column of the `scrnaseq_analyis_run` table
-    :return: Dataframes of the three file types generated by the Cellranger pipeline
-    (features.tsv, barcodes.tsv, matrix.mtx)
+    :return: Dataframes of the features.tsv and barcodes.tsv files generated by the Cellranger pipeline, and the
+    matrix.mtx as a (cells x features) CSR matrix
     """
     analysis_output_directory_path = Path(analysis_output_directory_path)
     tenx_dir = analysis_output_directory_path / TENX_RELATIVE_DIRECTORY_PATH
@@ -40,21 +43,11 @@ def load_10x_lane(analysis_output_directory_path):
         columns={0: "barcode"}
     )
 
-    mat = pd.read_csv(
-        tenx_dir / MATRIX_FILE_NAME, skiprows=3, header=None, sep=" ", names=["feature_idx", "barcode_idx", "count"],
-    )
+    mat = read_mtx(tenx_dir / MATRIX_FILE_NAME)
 
     return features_df, barcodes_df, mat
 
 
-# def load_10x_lane_scipy(analysis_output_directory_path):
-#     analysis_output_directory_path = Path(analysis_output_directory_path)
-#     tenx_dir = analysis_output_directory_path / TENX_RELATIVE_DIRECTORY_PATH
-#     features_df, barcodes_df, _ = load_10x_lane(analysis_output_directory_path)
-#     mat = mmread(str(tenx_dir / MATRIX_FILE_NAME))
-#     return features_df, barcodes_df, mat
-
-
 def load_bd_demux(analysis_output_directory_path):
     """
     Loads the output file from bd_demux into a dataframe. Only keeps rows that describe singlets and creates
@@ -130,6 +123,11 @@ def combine_10x_outputs(
     cellranger runs and will combine those runs into a single set of files as though they were all run together.
     This allows us to keep all of our data in one "dataset"
 
+    Each lane is read as a sparse matrix, good cells are selected by their integer barcode positions, and features are
+    remapped onto those of the first lane through an integer permutation of the column indices. Lanes are appended
+    directly to a columnar `Counts` store (`rna.counts`) in a single pass. Lanes without good cells are skipped.
+    Once the store is complete, the combined matrix.mtx.gz and barcodes.tsv.gz are written from it as before
+
     output_dir - output directory, no existing 10x output files
     metadata_df - pandas dataframe of metadata for the samples that make up the 10x data that will be combined.
     """
@@ -138,76 +136,72 @@ def combine_10x_outputs(
     output_dir = Path(output_dir)
     os.makedirs(output_dir, exist_ok=True)
     curr_good_cell_count = 0
-    reference_feature_map = None
+    reference_features = None
     all_metadata = []
 
-    # We append to tmp_matrix.mtx.gz and barcodes.tsv.gz below, so if it already exists, this can mess things up.
+    # Lanes are appended to the store below, so if it already exists, this can mess things up.
     # Make the user confirm they really want to do this so we don't blow up existing data.
-    tmp_matrix_file_path = output_dir / "tmp_matrix.mtx.gz"
-    if os.path.exists(tmp_matrix_file_path):
-        sys.exit(f"{tmp_matrix_file_path} already exists. If you really want to regenerate this file, delete it first.")
-    barcodes_file_path = output_dir / BARCODES_FILE_NAME
-    if os.path.exists(barcodes_file_path):
-        sys.exit(f"{barcodes_file_path} already exists. If you really want to regenerate this file, delete it first.")
+    store_path = output_dir / "rna.counts"
+    if os.path.exists(store_path):
+        sys.exit(f"{store_path} already exists. If you really want to regenerate it, delete it first.")
     # keep only newest run for each sample
     #
     if len(sample_metadata_df) == 0:
         raise ValueError("empty metadata provided")
     grp = sample_metadata_df.groupby(["<grouping_vars>"])
     grouping_vars = None
-    for idx, ((grouping_vars), lane_label_df) in enumerate(grp):
-        print(f"Loading {grouping_vars}")
-        print(datetime.datetime.now())
-
-        #
-
-        features_df, barcodes_df, mat = load_10x_lane(analysis_output_path)
-        n_cells_init = len(barcodes_df)
-        # because the barcodes and features are 1-indexed in the matrix file
-        # Confirmation that MEX files are 1-indexed: https://math.nist.gov/MatrixMarket/formats.html
-        barcodes_df["barcode_idx"] = barcodes_df.index + 1
-        features_df["feature_idx"] = features_df.index + 1
-        if reference_feature_map is None:
-            reference_feature_map = features_df.rename(columns={"feature_idx": "reference_feature_idx"})
-        print(analysis_output_path)
-        if is_bd:
-            good_cells_df = load_bd_demux(analysis_output_path)
-        elif scrnaseq_demux:
-            good_cells_df = load_scrnaseq_demux(analysis_output_path, prob_thresh)
-        else:
-            good_cells_df = load_demuxlet_demux(analysis_output_path)
-        good_cells_df = barcodes_df.merge(good_cells_df, on="barcode")
-        if is_bd:
-            good_cells_df = good_cells_df.rename(columns={"bd_id": "bd_antibody_id"}).merge(
-                lane_label_df, on="bd_antibody_id"
-            )
-            print("USING BD LANE")
-        else:
+    # a partial store is removed if a lane fails
+    with CountsStoreWriter(store_path) as writer:
+        for idx, ((grouping_vars), lane_label_df) in enumerate(grp):
+            print(f"Loading {grouping_vars}")
+            print(datetime.datetime.now())
+
             #
-            good_cells_df = good_cells_df.merge(lane_label_df, on=merge_column_name)
-        good_cells_df.loc[:, "barcode"] = (
-            good_cells_df.loc[:, "barcode"]
-            + "_"
-            + good_cells_df.loc[:, "entity_id"].map(str)
-            + "_"
-            + good_cells_df.loc[:, "lane_label"]
-        )
-
-        good_cells_df["new_barcode_idx"] = good_cells_df.index + 1 + curr_good_cell_count
-        filtered_mat = mat.merge(good_cells_df, on="barcode_idx").merge(features_df, on="feature_idx")
-        curr_good_cell_count += len(good_cells_df)  # set global index for combined matrix
-        filtered_mat = filtered_mat.merge(
-            reference_feature_map[["reference_feature_idx", "ensembl_id"]], on="ensembl_id",
-        )
-        with gzip.open(str(tmp_matrix_file_path), mode="at") as f:
-            filtered_mat[["reference_feature_idx", "new_barcode_idx", "count"]].to_csv(
-                f, index=False, sep=" ", header=None
+
+            features_df, barcodes_df, mat = load_10x_lane(analysis_output_path)
+            n_cells_init = len(barcodes_df)
+            # row positions of the barcodes in the (cells x features) matrix
+            barcodes_df["barcode_idx"] = barcodes_df.index
+            features_df["ensembl_id"] = features_df["ensembl_id"].str.replace("GRCh38_______", "")
+            features_df["gene_name"] = features_df["gene_name"].str.replace("GRCh38_______", "")
+            if reference_features is None:
+                reference_features = features_df[["ensembl_id", "gene_name"]]
+            print(analysis_output_path)
+            if is_bd:
+                good_cells_df = load_bd_demux(analysis_output_path)
+            elif scrnaseq_demux:
+                good_cells_df = load_scrnaseq_demux(analysis_output_path, prob_thresh)
+            else:
+                good_cells_df = load_demuxlet_demux(analysis_output_path)
+            good_cells_df = barcodes_df.merge(good_cells_df, on="barcode")
+            if is_bd:
+                good_cells_df = good_cells_df.rename(columns={"bd_id": "bd_antibody_id"}).merge(
+                    lane_label_df, on="bd_antibody_id"
+                )
+                print("USING BD LANE")
+            else:
+                #
+                good_cells_df = good_cells_df.merge(lane_label_df, on=merge_column_name)
+            if good_cells_df.empty:
+                logger.warning(f"no good cells in {grouping_vars} ({n_cells_init} barcodes), skipping lane")
+                continue
+            good_cells_df.loc[:, "barcode"] = (
+                good_cells_df.loc[:, "barcode"]
+                + "_"
+                + good_cells_df.loc[:, "entity_id"].map(str)
+                + "_"
+                + good_cells_df.loc[:, "lane_label"]
             )
 
-        with gzip.open(str(barcodes_file_path), mode="at") as f:
-            good_cells_df["barcode"].to_csv(f, index=False, header=False)
-        all_metadata.append(good_cells_df)
-        logger.info(f"keeping {len(good_cells_df)} / {n_cells_init} cells")
+            good_cells_df["new_barcode_idx"] = good_cells_df.index + 1 + curr_good_cell_count
+            curr_good_cell_count += len(good_cells_df)  # set global index for combined matrix
+            lane = Counts(mat, barcodes_df["barcode"], features_df[["ensembl_id", "gene_name"]])
+            lane = lane[good_cells_df["barcode_idx"].to_numpy()].reindex_features(reference_features)
+            writer.append(lane, cell_ids=good_cells_df["barcode"])
+            all_metadata.append(good_cells_df)
+            logger.info(f"keeping {len(good_cells_df)} / {n_cells_init} cells")
+        if not all_metadata:
+            raise ValueError("No good cells in any lane")
     # Remove "best" column that is unique to demuxlet cell dataframes
     to_merge = [df.drop("best", axis=1) if "best" in df.columns else df for df in all_metadata]
     # Reorder all dataframes to have columns in the same order (as the first lane_label_df)
@@ -218,25 +212,11 @@ def combine_10x_outputs(
     merged_metadata = merged_metadata.rename(columns={"barcode": "cell_id"})
     merged_metadata.to_csv(output_dir / "cell_metadata.tsv", index=False, sep="\t")
 
-    feature_map_out = reference_feature_map[["ensembl_id", "gene_name"]].applymap(
-        lambda x: x.replace("GRCh38_______", "")
-    )
-    feature_map_out.to_csv(
+    combined = Counts.load(store_path)
+    CellRangerIO.write_matrix(output_dir / "matrix.mtx", combined._matrix)
+    CellRangerIO.write_barcodes(output_dir / "barcodes.tsv", combined.cell_ids)
+
+    reference_features.to_csv(
         output_dir / FEATURES_FILE_NAME, compression="gzip", index=False, header=None, sep="\t",
     )
-
-    final_matrix_path = output_dir / MATRIX_FILE_NAME
-
-    num_entries = int(check_output(f"gunzip -c {tmp_matrix_file_path} | wc -l", shell=True).decode("utf-8").strip())
-
-    header = "%%MatrixMarket matrix coordinate integer general\n"
-    header += """%metadata_json: {"format_version": 2, "software_version": "3.0.2"}\n"""
-    header += "\t".join(map(str, [len(reference_feature_map), len(merged_metadata), num_entries]))
-    header += "\n"
-
-    with gzip.open(final_matrix_path, "wb") as f:
-        f.write(header.encode())
-
-    failed = check_call(f"cat {tmp_matrix_file_path} >> {final_matrix_path}", shell=True)
-    if not failed:
-        os.remove(tmp_matrix_file_path)
+    logger.info(f"combined counts written to {store_path}, {MATRIX_FILE_NAME} and {BARCODES_FILE_NAME}")
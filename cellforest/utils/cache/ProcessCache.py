@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Union
+
+import pandas as pd
+
+_CACHED_PROCESSES = set()
+
+
+class ProcessCache:
+    """
+    Content-addressed cache of process outputs, shared by all forests with the
+    same root. Outputs are keyed by a hash of
+        - the process and the parameters of it and its precursors (the
+          process path relative to the root, which encodes them)
+        - the set of input cells (the `meta` index) and their partition
+          labels (`partition_code` and the partition columns of the spec)
+        - the input matrix store (name, size and modification time of each
+          of its files)
+    so that identical runs reached through `groupby`, `get_subset` or an
+    explicit `meta` (which makes the forest unversioned, so that its outputs
+    are removed after each run) reuse the cached outputs. Only the runs of
+    unversioned forests are stored, since versioned runs keep their outputs
+    in their own process directories. Files are copied
+    rather than hard-linked, since outputs may be rewritten in place. Entries
+    are evicted in least recently used order once the cache exceeds
+    `max_bytes`
+    """
+
+    DIRNAME = ".process_cache"
+    MAX_BYTES = 50 * 2**30
+    _EXCLUDE_FILENAMES = {"temp_cell_metadata.parquet", "temp_cell_metadata.tsv"}
+    _LAST_USED_FILENAME = ".last_used"
+    _PARTITION_COLUMN = "partition_code"
+
+    def __init__(self, root_dir: Union[str, Path], max_bytes: Optional[int] = None):
+        self.cache_dir = Path(root_dir) / self.DIRNAME
+        self.max_bytes = self.MAX_BYTES if max_bytes is None else max_bytes
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_forest(cls, forest: "CellForest") -> "ProcessCache":
+        return cls(forest.root_dir)
+
+    @staticmethod
+    def is_cached_process(process_name: str) -> bool:
+        """Whether `process_name` is decorated with `process_cache`"""
+        return process_name in _CACHED_PROCESSES
+
+    @staticmethod
+    def is_stored_forest(forest: "CellForest") -> bool:
+        """Whether the runs of `forest` are added to the cache, which is only if it's unversioned"""
+        return bool(forest.unversioned)
+
+    @staticmethod
+    def get_key(forest: "CellForest", process_name: str) -> str:
+        """Hash of the process lineage and parameters, input cells and their partitions, and input matrix store"""
+        root_dir = Path(forest.root_dir)
+        process_path = Path(forest[process_name].path)
+        try:
+            process_path = process_path.relative_to(root_dir)
+        except ValueError:
+            pass
+        process_forest = forest[process_name].forest
+        meta = process_forest.meta
+        meta = meta.set_axis(pd.Index(meta.index).astype(str), axis=0).sort_index()
+        columns = sorted(ProcessCache._get_partition_columns(process_forest.spec) & set(meta.columns))
+        digest = hashlib.sha256()
+        digest.update(json.dumps([process_name, str(process_path), columns]).encode())
+        digest.update(pd.util.hash_pandas_object(meta.index.to_series(), index=False).to_numpy().tobytes())
+        for column in columns:
+            values = meta[column].astype(str)
+            digest.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+        for path in ProcessCache._input_store_files(root_dir):
+            stat = path.stat()
+            digest.update(f"{path.relative_to(root_dir)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def restore(self, key: str, output_dir: Union[str, Path]) -> bool:
+        """Populate `output_dir` from the cache entry for `key`, if there is one"""
+        entry = self.cache_dir / key
+        if not entry.is_dir():
+            return False
+        self._copy_tree(entry, Path(output_dir))
+        self._touch(entry)
+        return True
+
+    def store(self, key: str, output_dir: Union[str, Path]):
+        """Add the outputs in `output_dir` under `key`, then evict entries over the size cap"""
+        entry = self.cache_dir / key
+        if entry.is_dir():
+            self._touch(entry)
+            return
+        tmp_entry = self.cache_dir / f".tmp_{key}_{os.getpid()}"
+        os.makedirs(tmp_entry, exist_ok=True)
+        self._copy_tree(Path(output_dir), tmp_entry)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # stored concurrently by another process
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._touch(entry)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_bytes`"""
+        entries = [path for path in self.cache_dir.iterdir() if path.is_dir() and not path.name.startswith(".")]
+        sizes = {entry: self._dir_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=self._last_used):
+            if total <= self.max_bytes:
+                break
+            self.logger.info(f"Evicting process cache entry {entry.name}")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+
+    def _copy_tree(self, src: Path, dst: Path):
+        for path in src.rglob("*"):
+            if path.name in self._EXCLUDE_FILENAMES or path.name == self._LAST_USED_FILENAME or path.is_dir():
+                continue
+            target = dst / path.relative_to(src)
+            os.makedirs(target.parent, exist_ok=True)
+            shutil.copy2(path, target)
+
+    def _touch(self, entry: Path):
+        (entry / self._LAST_USED_FILENAME).write_text(str(time.time()))
+
+    def _last_used(self, entry: Path) -> float:
+        try:
+            return float((entry / self._LAST_USED_FILENAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def _dir_size(path: Path) -> int:
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+    @staticmethod
+    def _get_partition_columns(spec) -> set:
+        """`partition_code` and the metadata columns of the partitions in `spec`"""
+        columns = {ProcessCache._PARTITION_COLUMN}
+        stack = list(getattr(spec, "partition_set", None) or [])
+        while stack:
+            partition = stack.pop()
+            if isinstance(partition, str):
+                columns.add(partition)
+            elif isinstance(partition, dict):
+                columns.update(partition)
+            elif isinstance(partition, (list, tuple, set, frozenset)):
+                stack.extend(partition)
+        return columns
+
+    @staticmethod
+    def _input_store_files(root_dir: Path) -> Iterable[Path]:
+        for name in ["rna.counts", "rna.pickle"]:
+            path = root_dir / name
+            if path.is_dir():
+                return sorted(p for p in path.iterdir() if p.is_file())
+            if path.is_file():
+                return [path]
+        return []
+
+
+def process_cache(process_name: str) -> Callable:
+    """
+    Decorator for process functions (beneath `dataprocess`) which restores
+    the outputs of `process_name` from the `ProcessCache` instead of running
+    the process when an identical run is cached. The key is computed by
+    `hook_process_cache_key` before the run, and outputs of runs are added to
+    the cache by `hook_store_process_cache`
+    """
+    _CACHED_PROCESSES.add(process_name)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(forest: "CellForest", *args, **kwargs):
+            cache = ProcessCache.from_forest(forest)
+            key = getattr(forest, "_process_cache_keys", {}).get(process_name)
+            if key is None:
+                key = ProcessCache.get_key(forest, process_name)
+            if cache.restore(key, forest[process_name].path):
+                cache.logger.info(f"Restored {process_name} outputs from process cache {key}")
+                return
+            return func(forest, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
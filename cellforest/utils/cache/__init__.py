@@ -0,0 +1 @@
+from .ProcessCache import ProcessCache, process_cache
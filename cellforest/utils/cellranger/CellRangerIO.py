@@ -3,10 +3,8 @@ import logging
 from pathlib import Path
 
 import pandas as pd
-from scipy import io
-from scipy.io import mmwrite
 
-from cellforest.utils import compress
+from cellforest.utils.cellranger.matrix_market import read_mtx, write_mtx
 
 
 class CellRangerIO:
@@ -54,23 +52,32 @@ class CellRangerIO:
         return df
 
     @staticmethod
-    def read_matrix(filepath):
-        return io.mmread(str(filepath)).T
+    def read_matrix(filepath, **kwargs):
+        """Read (cells x features) CSR matrix. kwargs passed to `read_mtx`"""
+        return read_mtx(filepath, **kwargs)
 
     @staticmethod
     def write_barcodes(filepath, df, gz=True):
-        df.to_csv(filepath, **CellRangerIO._WRITE_TSV_KWARGS)
-        CellRangerIO._gzip_if_needed(filepath, gz)
+        CellRangerIO._write_tsv(filepath, df, gz)
 
     @staticmethod
     def write_features(filepath, df, gz=True):
-        df.to_csv(filepath, **CellRangerIO._WRITE_TSV_KWARGS)
-        CellRangerIO._gzip_if_needed(filepath, gz)
+        CellRangerIO._write_tsv(filepath, df, gz)
 
     @staticmethod
-    def write_matrix(filepath, matrix, gz=True):
-        mmwrite(str(filepath), matrix.T)
-        CellRangerIO._gzip_if_needed(filepath, gz)
+    def write_matrix(filepath, matrix, gz=True, **kwargs):
+        """Write (cells x features) matrix. kwargs passed to `write_mtx`"""
+        write_mtx(CellRangerIO._gz_path(filepath, gz), matrix, gz=gz, **kwargs)
+
+    @staticmethod
+    def _write_tsv(filepath, df, gz):
+        compression = "gzip" if gz else None
+        df.to_csv(CellRangerIO._gz_path(filepath, gz), compression=compression, **CellRangerIO._WRITE_TSV_KWARGS)
+
+    @staticmethod
+    def _gz_path(filepath, gz):
+        """Compressed files are written directly to `filepath` with a `.gz` suffix"""
+        return Path(f"{filepath}.gz") if gz else Path(filepath)
 
     @staticmethod
     def _get_filename(files, basename):
@@ -80,11 +87,6 @@ class CellRangerIO:
     def _is_gz(filepath):
         return filepath.endswith(".gz")
 
-    @staticmethod
-    def _gzip_if_needed(path, gzip):
-        if gzip:
-            compress(path, keep_orig=False)
-
     @staticmethod
     def _tether(method, tether_arg):
         def tethered_method(*args, **kwargs):
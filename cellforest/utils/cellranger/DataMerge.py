@@ -1,36 +1,101 @@
 import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
 
 from cellforest import Counts
+from cellforest.structures.CountsStoreWriter import CountsStoreWriter
+from cellforest.utils.cellranger.CellRangerIO import CellRangerIO
+from cellforest.utils.cellranger.MtxQC import MtxQC
+from cellforest.utils.metadata import write_meta
+from cellforest.utils.r.Convert import Convert
 
 
 class DataMerge:
     @staticmethod
-    def merge_assay(paths, mode, metadata=None, save_dir=None):
+    def merge_assay(paths, mode, metadata=None, save_dir=None, **kwargs):
         method = getattr(DataMerge, f"_merge_{mode}")
-        return method(paths, metadata, save_dir)
+        return method(paths, metadata, save_dir, **kwargs)
 
     @staticmethod
-    def _merge_rna(paths, metadata, save_dir):
-        """"""
-        rna_list = [Counts.from_cellranger(dir_) for dir_ in paths]
-        meta = None
+    def _merge_rna(paths, metadata, save_dir, n_workers=None, join="outer"):
+        """
+        Parse lanes concurrently in `n_workers` processes and append each lane
+        to an on-disk store as soon as it is parsed, in order. At most
+        `n_workers` lanes are in flight, so peak memory is bounded by the lane
+        sizes rather than their total. Lanes with differing features (e.g. v2
+        and v3 chemistries) are conformed to the `join` of all lane features.
+        QC metrics (`MtxQC`) are computed while each lane is parsed, and are
+        added to `meta` per cell and to `feature_meta.parquet` per feature
+        """
+        features = DataMerge._join_lane_features(paths, join)
+        cell_qc = []
+        n_cells = np.zeros(len(features), dtype=np.int64)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_path = Path(save_dir or tmp_dir) / "rna.counts"
+            with CountsStoreWriter(store_path) as writer:
+                for counts, lane_cell_qc, lane_n_cells in DataMerge._iter_lanes(paths, features, n_workers):
+                    writer.append(counts)
+                    cell_qc.append(lane_cell_qc)
+                    n_cells += lane_n_cells
+            # without a `save_dir`, the store is temporary, so it is read into memory
+            rna = Counts.load(store_path, mmap=bool(save_dir))
+        cells_per_matrix = writer.rows_per_block
+        meta = pd.concat(cell_qc, ignore_index=True)
         if metadata is not None:
             metadata_cols = [col for col in metadata.columns if not col.startswith("path_")]
             metadata = metadata[metadata_cols]
-            cells_per_matrix = [counts.shape[0] for counts in rna_list]
-            meta = metadata.loc[metadata.index.repeat(cells_per_matrix)].reset_index(drop=True)
-        rna = Counts.concatenate(rna_list)
-        if meta is not None:
-            meta.index = rna.cell_ids
-        else:
-            meta = rna.cell_ids
+            metadata = metadata.loc[metadata.index.repeat(cells_per_matrix)].reset_index(drop=True)
+            meta = pd.concat([metadata, meta], axis=1)
+        meta.index = rna.cell_ids
         if save_dir:
             os.makedirs(save_dir, exist_ok=True)
-            meta.to_csv(save_dir / "meta.tsv", sep="\t")
+            # typed and categorical, so that forests read only the columns they use
+            write_meta(meta, save_dir / "meta.parquet")
+            features.assign(n_cells=n_cells).to_parquet(save_dir / "feature_meta.parquet", index=False)
+            # the store written above is read by R directly
             # TODO: move create_rds val to config
-            rna.save(save_dir / "rna.pickle", create_rds=True)
+            Convert.store_to_rds_dir(save_dir)
         return rna, meta
 
+    @staticmethod
+    def _join_lane_features(paths, join="outer"):
+        """Join of the features of all lanes, read from the (small) feature files only"""
+        features_list = [CellRangerIO(path).read_features() for path in paths]
+        features, _ = Counts._join_features(features_list, join)
+        return features
+
+    @staticmethod
+    def _read_lane(path, features):
+        """Lane conformed to `features`, with its per cell QC metrics and the number of cells per feature"""
+        qc = MtxQC()
+        counts = Counts.from_cellranger(path, qc=qc)
+        col_map = Counts._column_map(counts.features, features)
+        n_cells = qc.n_cells
+        if col_map is not None:
+            kept = col_map >= 0
+            n_cells = np.bincount(col_map[kept], weights=n_cells[kept], minlength=len(features)).astype(np.int64)
+        return counts.reindex_features(features), qc.cell_metrics, n_cells
+
+    @staticmethod
+    def _iter_lanes(paths, features, n_workers=None):
+        """Yield `_read_lane` for each 10X directory in `paths`, in order"""
+        if not n_workers or n_workers == 1:
+            yield from (DataMerge._read_lane(path, features) for path in paths)
+            return
+        with ProcessPoolExecutor(n_workers) as executor:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(DataMerge._read_lane, path, features))
+                if len(pending) >= n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     @staticmethod
     def _merge_vdj(paths, metadata, save_dir):
         raise NotImplementedError()
@@ -0,0 +1,67 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+MITO_PATTERN = "^MT-"
+
+
+class MtxQC:
+    """
+    QC metrics accumulated by `read_mtx` block by block as the entries are
+    parsed, so that they don't take another pass over the matrix
+        per cell:
+            n_counts: total counts (`nCount_RNA`)
+            n_genes: number of detected features (`nFeature_RNA`)
+            percent_mito: fraction of counts from `mito` features (`percent.mito`)
+        per feature:
+            n_cells: number of cells in which it is detected
+    Example:
+        qc = MtxQC.from_genes(features["genes"])
+        matrix = read_mtx(filepath, qc=qc)
+        meta = qc.cell_metrics
+    """
+
+    CELL_COLUMNS = ["n_counts", "n_genes", "percent_mito"]
+
+    def __init__(self, mito: Optional[np.ndarray] = None):
+        self.mito = None if mito is None else np.asarray(mito, dtype=bool)
+        self.n_counts = None
+        self.n_genes = None
+        self.n_cells = None
+        self._mito_counts = None
+
+    @classmethod
+    def from_genes(cls, genes: pd.Series, mito_pattern: str = MITO_PATTERN) -> "MtxQC":
+        return cls(genes.str.contains(mito_pattern).to_numpy())
+
+    @property
+    def percent_mito(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._mito_counts / self.n_counts
+
+    @property
+    def cell_metrics(self) -> pd.DataFrame:
+        """Per cell metrics, in the order of the cells in the matrix"""
+        return pd.DataFrame(dict(zip(self.CELL_COLUMNS, [self.n_counts, self.n_genes, self.percent_mito])))
+
+    def start(self, n_features: int, n_cells: int):
+        """Reset the metrics for a matrix of (`n_cells` x `n_features`)"""
+        if self.mito is None:
+            self.mito = np.zeros(n_features, dtype=bool)
+        elif len(self.mito) != n_features:
+            raise ValueError(f"`mito` has {len(self.mito)} features, but the matrix has {n_features}")
+        self.n_counts = np.zeros(n_cells)
+        self.n_genes = np.zeros(n_cells, dtype=np.int64)
+        self.n_cells = np.zeros(n_features, dtype=np.int64)
+        self._mito_counts = np.zeros(n_cells)
+
+    def update(self, feature_idx: np.ndarray, cell_idx: np.ndarray, values: np.ndarray):
+        """Add a block of (0-indexed) entries"""
+        n_cells = len(self.n_counts)
+        detected = values != 0
+        mito = self.mito[feature_idx]
+        self.n_counts += np.bincount(cell_idx, weights=values, minlength=n_cells)
+        self.n_genes += np.bincount(cell_idx[detected], minlength=n_cells)
+        self.n_cells += np.bincount(feature_idx[detected], minlength=len(self.n_cells))
+        self._mito_counts += np.bincount(cell_idx[mito], weights=values[mito], minlength=n_cells)
@@ -1 +1,2 @@
 from .CellRangerIO import CellRangerIO
+from .MtxQC import MtxQC
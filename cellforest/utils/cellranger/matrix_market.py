@@ -0,0 +1,213 @@
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Iterator, Optional, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv
+from scipy.sparse import csr_matrix
+
+from cellforest.utils.cellranger.MtxQC import MtxQC
+
+_BANNER = b"%%MatrixMarket"
+_FIELD_DTYPES = {"integer": np.int64, "real": np.float64}
+_COLUMN_NAMES = ["feature", "cell", "value"]
+_READ_OPTIONS = csv.ReadOptions(column_names=_COLUMN_NAMES)
+_PARSE_OPTIONS = csv.ParseOptions(delimiter=" ")
+_WRITE_OPTIONS = csv.WriteOptions(include_header=False, delimiter=" ")
+DEFAULT_BLOCK_SIZE = 2**24
+DEFAULT_ROWS_PER_CHUNK = 10_000
+
+
+def read_mtx(
+    filepath: Union[str, Path],
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    n_workers: Optional[int] = None,
+    qc: Optional[MtxQC] = None,
+) -> csr_matrix:
+    """
+    Read a 10X MatrixMarket file (features x cells, optionally gzipped) as a
+    (cells x features) CSR matrix.
+    The file is streamed in blocks of `block_size` bytes, and each block of
+    coordinate triplets is parsed in a vectorized manner by the pyarrow CSV
+    reader, which releases the GIL. The CSR arrays are preallocated from the
+    `nnz` in the header and filled directly, without an intermediate COO
+    matrix or transpose, since 10X writes the entries sorted by cell. Unsorted
+    files are supported by falling back to a stable sort by cell.
+    Args:
+        filepath: path to `matrix.mtx` or `matrix.mtx.gz`
+        block_size: number of bytes of text parsed at a time
+        n_workers: if specified, blocks are parsed by a pool of threads while
+            the main thread decompresses the next blocks
+        qc: if specified, per cell and per feature QC metrics are accumulated
+            in it from each parsed block
+    """
+    with _open(filepath) as f:
+        field, (n_features, n_cells, nnz) = _read_header(f)
+        data = np.empty(nnz, dtype=_FIELD_DTYPES[field])
+        indices = np.empty(nnz, dtype=np.int32)
+        cell_counts = np.zeros(n_cells, dtype=np.int64)
+        cells = None  # only materialized if the entries aren't sorted by cell
+        if qc is not None:
+            qc.start(n_features, n_cells)
+        offset = 0
+        last_cell = 0
+        parse = partial(_parse_block, dtype=data.dtype)
+        executor = ThreadPoolExecutor(n_workers) if n_workers else None
+        try:
+            blocks = _iter_blocks(f, block_size)
+            parsed = _bounded_map(executor, parse, blocks, 2 * n_workers) if executor else map(parse, blocks)
+            for feature_idx, cell_idx, values in parsed:
+                end = offset + len(values)
+                if end > nnz:
+                    raise ValueError(f"{filepath} contains more entries than the {nnz} specified in its header")
+                indices[offset:end] = feature_idx - 1
+                data[offset:end] = values
+                cell_idx = cell_idx - 1
+                if cells is None and (cell_idx[0] < last_cell or (np.diff(cell_idx) < 0).any()):
+                    cells = np.empty(nnz, dtype=np.int32)
+                    cells[:offset] = np.repeat(np.arange(n_cells, dtype=np.int32), cell_counts)
+                if cells is not None:
+                    cells[offset:end] = cell_idx
+                cell_counts += np.bincount(cell_idx, minlength=n_cells)
+                if qc is not None:
+                    qc.update(indices[offset:end], cell_idx, values)
+                last_cell = cell_idx[-1]
+                offset = end
+        finally:
+            if executor:
+                executor.shutdown()
+    if offset != nnz:
+        raise ValueError(f"{filepath} contains {offset} entries, but {nnz} are specified in its header")
+    if cells is not None:
+        order = np.argsort(cells, kind="stable")
+        data = data[order]
+        indices = indices[order]
+    indptr = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(cell_counts, out=indptr[1:])
+    return csr_matrix((data, indices, indptr), shape=(n_cells, n_features))
+
+
+def write_mtx(
+    filepath: Union[str, Path],
+    matrix: csr_matrix,
+    gz: Optional[bool] = None,
+    rows_per_chunk: int = DEFAULT_ROWS_PER_CHUNK,
+    n_workers: Optional[int] = None,
+    compresslevel: int = 6,
+):
+    """
+    Write a (cells x features) CSR matrix as a 10X MatrixMarket file
+    (features x cells, sorted by cell) in a single pass.
+    Since the `nnz` is known, the header is written up front, and the
+    entries are formatted in chunks of `rows_per_chunk` cells straight from
+    the CSR arrays, without a transposed copy of the matrix. If `gz`, each
+    chunk is compressed as a separate gzip member (a multi-member gzip file
+    is read as one stream by gzip readers), so that chunks can be formatted
+    and compressed by a pool of `n_workers` threads
+    Args:
+        filepath: output path. If `gz` is None, it is inferred from a `.gz`
+            suffix
+        matrix: (cells x features) CSR matrix
+        gz: whether to gzip the output
+        rows_per_chunk: number of cells formatted at a time
+        n_workers: if specified, chunks are formatted and compressed in
+            parallel threads
+        compresslevel: gzip compression level
+    """
+    gz = str(filepath).endswith(".gz") if gz is None else gz
+    matrix = csr_matrix(matrix)
+    n_cells, n_features = matrix.shape
+    field = "integer" if matrix.dtype.kind in "iu" else "real"
+    header = f"{_BANNER.decode()} matrix coordinate {field} general\n{n_features} {n_cells} {matrix.nnz}\n".encode()
+    encode = partial(_encode_chunk, matrix, gz=gz, compresslevel=compresslevel)
+    chunks = range(0, n_cells, rows_per_chunk)
+    chunks = [(start, min(start + rows_per_chunk, n_cells)) for start in chunks]
+    executor = ThreadPoolExecutor(n_workers) if n_workers else None
+    try:
+        encoded = _bounded_map(executor, encode, chunks, 2 * n_workers) if executor else map(encode, chunks)
+        with open(filepath, "wb") as f:
+            f.write(gzip.compress(header, compresslevel) if gz else header)
+            for chunk in encoded:
+                f.write(chunk)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _encode_chunk(matrix: csr_matrix, rows: Tuple[int, int], gz: bool, compresslevel: int) -> bytes:
+    """Format rows `start:stop` of `matrix` as (1-indexed) "feature cell value" lines"""
+    start, stop = rows
+    lo, hi = matrix.indptr[start], matrix.indptr[stop]
+    cells = np.repeat(np.arange(start + 1, stop + 1, dtype=np.int64), np.diff(matrix.indptr[start : stop + 1]))
+    table = pa.table(
+        {"feature": matrix.indices[lo:hi].astype(np.int64) + 1, "cell": cells, "value": matrix.data[lo:hi]}
+    )
+    sink = pa.BufferOutputStream()
+    csv.write_csv(table, sink, _WRITE_OPTIONS)
+    text = sink.getvalue().to_pybytes()
+    return gzip.compress(text, compresslevel) if gz else text
+
+
+def _open(filepath: Union[str, Path]):
+    if str(filepath).endswith(".gz"):
+        return gzip.open(filepath, "rb")
+    return open(filepath, "rb")
+
+
+def _read_header(f) -> Tuple[str, Tuple[int, int, int]]:
+    """Parse the banner and size line, leaving `f` at the first entry"""
+    banner = f.readline()
+    if not banner.startswith(_BANNER):
+        raise ValueError(f"Not a MatrixMarket file. Banner: {banner}")
+    _, obj, fmt, field, symmetry = banner.decode().lower().split()
+    if (obj, fmt, symmetry) != ("matrix", "coordinate", "general") or field not in _FIELD_DTYPES:
+        raise ValueError(f"Only general coordinate matrices of {list(_FIELD_DTYPES)} are supported. Got: {banner}")
+    line = f.readline()
+    while line.startswith(b"%"):
+        line = f.readline()
+    n_rows, n_cols, nnz = map(int, line.split())
+    return field, (n_rows, n_cols, nnz)
+
+
+def _iter_blocks(f, block_size: int) -> Iterator[bytes]:
+    """Yield blocks of approximately `block_size` bytes, which end on line breaks"""
+    remainder = b""
+    while True:
+        chunk = f.read(block_size)
+        if not chunk:
+            break
+        chunk = remainder + chunk
+        cut = chunk.rfind(b"\n") + 1
+        if cut == 0:
+            remainder = chunk
+            continue
+        remainder = chunk[cut:]
+        yield chunk[:cut]
+    if remainder.strip():
+        yield remainder
+
+
+def _parse_block(block: bytes, dtype: np.dtype) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parse a block of "feature cell value" lines into (1-indexed) arrays"""
+    column_types = dict(zip(_COLUMN_NAMES, [pa.int32(), pa.int32(), pa.from_numpy_dtype(dtype)]))
+    convert_options = csv.ConvertOptions(column_types=column_types)
+    table = csv.read_csv(pa.py_buffer(block), _READ_OPTIONS, _PARSE_OPTIONS, convert_options)
+    return tuple(table.column(name).to_numpy() for name in _COLUMN_NAMES)
+
+
+def _bounded_map(executor, func, iterable, max_pending: int):
+    """
+    Like `executor.map`, but only `max_pending` items are submitted at once,
+    so blocks aren't all read into memory before being parsed
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
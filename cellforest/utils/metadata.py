@@ -0,0 +1,62 @@
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+INDEX_COLUMN = "cell_id"
+
+
+def write_meta(df: pd.DataFrame, filepath: Union[str, Path], categorical: bool = True):
+    """
+    Write cell metadata as parquet, with the index as a `cell_id` column, so
+    that R (`arrow::read_parquet`) reads it as an ordinary column. If
+    `categorical`, string columns are stored as categoricals
+    """
+    if categorical:
+        df = categorize(df)
+    df.rename_axis(INDEX_COLUMN).reset_index().to_parquet(filepath, index=False)
+
+
+def read_meta(filepath: Union[str, Path], columns: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    """
+    Read cell metadata written by `write_meta`, indexed by `cell_id`. Only
+    `columns` (all if `None`) are read from disk; any not in the file are
+    ignored
+    """
+    if columns is not None:
+        available = set(pq.read_schema(filepath).names)
+        columns = [INDEX_COLUMN] + [col for col in columns if col in available and col != INDEX_COLUMN]
+    df = pd.read_parquet(filepath, columns=columns)
+    return df.set_index(INDEX_COLUMN)
+
+
+def categorize(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    String columns as categoricals with spaces replaced by underscores, as
+    `get_cell_meta` does for text metadata. Values which become equal (e.g.
+    "a b" and "a_b") share a category. Columns of mixed types are stored as
+    strings, with missing values kept
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col].dtype):
+            values = df[col]
+            inferred = pd.api.types.infer_dtype(values, skipna=True)
+            if inferred.startswith("mixed"):
+                values = values.astype(str).where(values.notna())
+            elif inferred != "string":
+                df[col] = values.astype("category")
+                continue
+            df[col] = _underscore_categorical(values)
+    return df
+
+
+def _underscore_categorical(values: pd.Series) -> pd.Categorical:
+    """Spaces are replaced in the unique values only, which are then mapped onto the codes"""
+    codes, uniques = pd.factorize(values)
+    renamed = pd.Index(uniques, dtype=object).str.replace(" ", "_")
+    categories = renamed.unique().sort_values()
+    codes = np.where(codes >= 0, categories.get_indexer(renamed)[codes], -1)
+    return pd.Categorical.from_codes(codes, categories=categories)
@@ -1,48 +1,50 @@
-import sys
-
 from pathlib import Path
 
 from cellforest.utils import r
-from cellforest.utils.shell.shell_command import shell_command
+from cellforest.utils.r.run_r_script import run_r_script
 
-_PYTHON_EXECUTABLE = sys.executable
 _R_UTILS_DIR = Path(r.__file__).parent
-_PICKLE_TO_RDS_SCRIPT = _R_UTILS_DIR / "pickle_to_rds.R"
-_RDS_TO_PICKLE_SCRIPT = _R_UTILS_DIR / "rds_to_pickle.R"
-_COUNTS_STORE_MODULE = _R_UTILS_DIR.parent.parent / "structures/build_counts_store.py"
+_STORE_TO_RDS_SCRIPT = _R_UTILS_DIR / "store_to_rds.R"
+_RDS_TO_STORE_SCRIPT = _R_UTILS_DIR / "rds_to_store.R"
+_COUNTS_STORE_R = _R_UTILS_DIR / "counts_store.R"
 
 
 class Convert:
+    """
+    Conversion between `CountsStore` directories and Seurat RDS files. R reads
+    and writes the store's `.npy` and parquet files directly (`counts_store.R`),
+    so no Python interpreter is needed on the R side
+    """
+
     # TODO: rewrite using stem rather than hard-coding filenames (used in Counts, too)
     @staticmethod
-    def pickle_to_rds(pickle_path, meta_path, output_rds_path):
-        arg_list = [pickle_path, meta_path, output_rds_path, _PYTHON_EXECUTABLE]
-        Convert._run_r_script(_PICKLE_TO_RDS_SCRIPT, arg_list)
+    def store_to_rds(store_path, output_rds_path):
+        arg_list = [store_path, output_rds_path, _COUNTS_STORE_R]
+        Convert._run_r_script(_STORE_TO_RDS_SCRIPT, arg_list)
 
     @staticmethod
-    def pickle_to_rds_dir(file_dir):
-        pickle_path, meta_path, output_rds_path = Convert._get_std_paths(file_dir)
-        Convert.pickle_to_rds(pickle_path, meta_path, output_rds_path)
+    def store_to_rds_dir(file_dir):
+        store_path, _, output_rds_path = Convert._get_std_paths(file_dir)
+        Convert.store_to_rds(store_path, output_rds_path)
 
     @staticmethod
-    def rds_to_pickle(rds_path, output_meta_path, output_pickle_path):
-        arg_list = [rds_path, output_meta_path, output_pickle_path, _COUNTS_STORE_MODULE, _PYTHON_EXECUTABLE]
-        Convert._run_r_script(_RDS_TO_PICKLE_SCRIPT, arg_list)
+    def rds_to_store(rds_path, output_meta_path, output_store_path):
+        arg_list = [rds_path, output_meta_path, output_store_path, _COUNTS_STORE_R]
+        Convert._run_r_script(_RDS_TO_STORE_SCRIPT, arg_list)
 
     @staticmethod
-    def rds_to_pickle_dir(file_dir):
-        output_pickle_path, output_meta_path, rds_path = Convert._get_std_paths(file_dir)
-        Convert.rds_to_pickle(rds_path, output_meta_path, output_pickle_path)
+    def rds_to_store_dir(file_dir):
+        output_store_path, output_meta_path, rds_path = Convert._get_std_paths(file_dir)
+        Convert.rds_to_store(rds_path, output_meta_path, output_store_path)
 
     @staticmethod
     def _run_r_script(script_path: str, arg_list: list):
-        command_string = f"Rscript {str(script_path)} {' '.join(map(str, arg_list))}"
-        shell_command(command_string=command_string)
+        run_r_script(script_path, arg_list)
 
     @staticmethod
     def _get_std_paths(file_dir):
         file_dir = Path(file_dir)
-        pickle_path = file_dir / "rna.pickle"
-        meta_path = file_dir / "meta.tsv"
+        store_path = file_dir / "rna.counts"
+        meta_path = file_dir / "meta.parquet"
         rds_path = file_dir / "rna.rds"
-        return pickle_path, meta_path, rds_path
+        return store_path, meta_path, rds_path
@@ -0,0 +1,135 @@
+import logging
+import os
+import secrets
+import socket
+import subprocess
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from cellforest.utils import r
+
+_R_UTILS_DIR = Path(r.__file__).parent
+_R_WORKER_SCRIPT = _R_UTILS_DIR / "r_worker.R"
+_R_FUNCTIONS_SCRIPT = _R_UTILS_DIR.parent.parent / "processes/functions.R"
+_TOKEN_ENV_VAR = "CELLFOREST_R_WORKER_TOKEN"
+
+
+class RWorker:
+    """
+    Long-lived `Rscript` process which runs the R scripts of consecutive
+    processes, so that Seurat and the other libraries in `functions.R` are
+    loaded once, and Seurat objects saved by one step are still in memory
+    when the next step reads them (up to `max_cached_objects`). Requests are
+    sent over a loopback socket, and the worker only serves connections which
+    open with a random token, passed to it through the environment rather
+    than the command line, so that other local users can't run scripts in it.
+    While a worker is active (as a context manager), `run_process_r_script`
+    and `run_r_script` send scripts to it, and otherwise fall back to a fresh
+    `Rscript` subprocess per script:
+        with RWorker():
+            cf.process.normalize()
+            cf.process.dim_reduce()
+    """
+
+    _active: Optional["RWorker"] = None
+
+    def __init__(self, startup_timeout: float = 300, max_cached_objects: int = 2):
+        self.startup_timeout = startup_timeout
+        self.max_cached_objects = max_cached_objects
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._process = None
+        self._conn = None
+        self._reader = None
+        self._previous = None
+
+    @classmethod
+    def get_active(cls) -> Optional["RWorker"]:
+        """Active worker, if one is running"""
+        if cls._active is not None and cls._active.alive:
+            return cls._active
+        return None
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None and self._conn is not None
+
+    def start(self):
+        port = self._get_free_port()
+        command = ["Rscript", str(_R_WORKER_SCRIPT), str(port), str(_R_FUNCTIONS_SCRIPT), str(self.max_cached_objects)]
+        token = secrets.token_hex(32)
+        self.logger.info(f"Starting R worker on port {port}")
+        self._process = subprocess.Popen(command, env={**os.environ, _TOKEN_ENV_VAR: token})
+        deadline = time.time() + self.startup_timeout
+        while self._conn is None:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"R worker exited during startup with code {self._process.returncode}")
+            try:
+                self._conn = socket.create_connection(("127.0.0.1", port))
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    self.stop()
+                    raise TimeoutError(f"R worker didn't start within {self.startup_timeout}s")
+                time.sleep(0.2)
+        self._conn.sendall(f"{token}\n".encode("utf-8"))
+        self._reader = self._conn.makefile("r", encoding="utf-8")
+        return self
+
+    def stop(self):
+        if self._conn is not None:
+            try:
+                self._conn.sendall(b"QUIT\n")
+            except OSError:
+                pass
+            self._reader.close()
+            self._conn.close()
+            self._conn = None
+        if self._process is not None:
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+
+    def run(
+        self,
+        r_script_filepath: Union[str, Path],
+        arg_list: list,
+        working_dir: Union[str, Path, None] = None,
+        log_name: str = "r_worker",
+    ):
+        """
+        Run `r_script_filepath` with `arg_list` as its `commandArgs`, with
+        stdout and stderr logged to `<log_name>.out` and `<log_name>.err` in
+        `working_dir`, as `process_shell_command` does
+        """
+        working_dir = str(working_dir or os.getcwd())
+        out_path = os.path.join(working_dir, f"{log_name}.out")
+        err_path = os.path.join(working_dir, f"{log_name}.err")
+        fields = [str(r_script_filepath), working_dir, out_path, err_path, *map(str, arg_list)]
+        if any("\t" in field or "\n" in field for field in fields):
+            raise ValueError(f"R worker arguments can't contain tabs or newlines: {fields}")
+        self.logger.info(f"Running in R worker: {r_script_filepath} {' '.join(fields[4:])}")
+        self._conn.sendall(("\t".join(fields) + "\n").encode("utf-8"))
+        response = self._reader.readline().rstrip("\n")
+        if not response:
+            raise RuntimeError(f"R worker exited while running {r_script_filepath}")
+        if response != "OK":
+            message = response.split("\t", 1)[-1]
+            raise RuntimeError(f"R worker failed running {r_script_filepath}: {message}")
+
+    def __enter__(self):
+        if not self.alive:
+            self.start()
+        self._previous, RWorker._active = RWorker._active, self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        RWorker._active = self._previous
+        self.stop()
+
+    @staticmethod
+    def _get_free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
@@ -1,18 +1,31 @@
+from cellforest.utils.r.RWorker import RWorker
 from cellforest.utils.shell.shell_command import process_shell_command, shell_command
 
 
-def run_process_r_script(forest: "CellForest", r_script_filepath: str, arg_list: list, process_name: str):
+def run_process_r_script(
+    forest: "CellForest", r_script_filepath: str, arg_list: list, process_name: str, log_name: str = None
+):
     """
     Runs an R script for a process, which additionally entails outputting log
-    files
+    files. Runs in the active `RWorker`, if any, and otherwise in a new
+    `Rscript` process
     """
-    command_string = f"Rscript {r_script_filepath} {' '.join(map(str, arg_list))}"
     working_dir = str(forest[process_name].path)
+    log_name = log_name or process_name
+    worker = RWorker.get_active()
+    if worker is not None:
+        worker.run(r_script_filepath, arg_list, working_dir=working_dir, log_name=log_name)
+        return
+    command_string = f"Rscript {r_script_filepath} {' '.join(map(str, arg_list))}"
     process_shell_command(
-        command_string=command_string, working_dir=working_dir, process_name=process_name,
+        command_string=command_string, working_dir=working_dir, process_name=log_name,
     )
 
 
 def run_r_script(script_path: str, arg_list: list):
+    worker = RWorker.get_active()
+    if worker is not None:
+        worker.run(script_path, arg_list)
+        return
     command_string = f"Rscript {str(script_path)} {' '.join(map(str, arg_list))}"
     shell_command(command_string=command_string)
@@ -0,0 +1 @@
+from .csr import take, take_rows
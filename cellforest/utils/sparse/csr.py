@@ -0,0 +1,33 @@
+from typing import Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+_Key = Union[slice, np.ndarray, list]
+
+
+def take_rows(matrix: csr_matrix, rows: _Key) -> csr_matrix:
+    """
+    Select `rows` of a CSR matrix. A contiguous slice is taken from `data` and
+    `indices` as views (which scipy only copies if they are small relative to
+    the parent), while other keys gather only the `indptr` ranges of the
+    selected rows, so a memory-mapped matrix only reads those rows from disk
+    """
+    return take(matrix, rows, slice(None))
+
+
+def take(matrix: csr_matrix, rows: _Key, cols: _Key) -> csr_matrix:
+    """
+    Select `rows` and `cols` of a CSR matrix. Rows are selected first, so the
+    column selection only passes over the nonzeros of the selected rows, and
+    allocation is bounded by the selected rows rather than the full matrix
+    """
+    if not _is_full_slice(rows):
+        matrix = matrix[rows]
+    if not _is_full_slice(cols):
+        matrix = matrix[:, cols]
+    return matrix
+
+
+def _is_full_slice(key: _Key) -> bool:
+    return isinstance(key, slice) and key == slice(None)
@@ -57,3 +57,8 @@ def metadata(metadata_path):
 @pytest.fixture
 def counts_path(root_path):
     return root_path / "rna.pickle"
+
+
+@pytest.fixture
+def counts_store_path(root_path):
+    return root_path / "rna.counts"
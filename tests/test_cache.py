@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pandas as pd
+
+from cellforest.utils.cache import ProcessCache, process_cache
+
+
+class _Forest(dict):
+    def __init__(self, root_dir, process_path, cell_ids, partition_set=(), **columns):
+        meta = pd.DataFrame(columns, index=cell_ids)
+        forest = SimpleNamespace(meta=meta, spec=SimpleNamespace(partition_set=set(partition_set)))
+        super().__init__({"normalize": SimpleNamespace(path=process_path, forest=forest)})
+        self.root_dir = root_dir
+
+
+def test_process_cache_key(tmp_path):
+    process_path = tmp_path / "normalize_min_genes:5"
+    key = ProcessCache.get_key(_Forest(tmp_path, process_path, ["a", "b", "c"]), "normalize")
+    assert key == ProcessCache.get_key(_Forest(tmp_path, process_path, ["c", "a", "b"]), "normalize")
+    assert key != ProcessCache.get_key(_Forest(tmp_path, process_path, ["a", "b"]), "normalize")
+    assert key != ProcessCache.get_key(
+        _Forest(tmp_path, tmp_path / "normalize_min_genes:6", ["a", "b", "c"]), "normalize"
+    )
+    key_partitioned = ProcessCache.get_key(
+        _Forest(tmp_path, process_path, ["a", "b", "c"], {"sample"}, sample=["x", "x", "y"]), "normalize"
+    )
+    assert key_partitioned != key
+    assert key_partitioned == ProcessCache.get_key(
+        _Forest(tmp_path, process_path, ["c", "a", "b"], {"sample"}, sample=["y", "x", "x"]), "normalize"
+    )
+    assert key_partitioned != ProcessCache.get_key(
+        _Forest(tmp_path, process_path, ["a", "b", "c"], {"sample"}, sample=["x", "y", "y"]), "normalize"
+    )
+    assert key == ProcessCache.get_key(
+        _Forest(tmp_path, process_path, ["a", "b", "c"], sample=["x", "y", "y"]), "normalize"
+    )
+    assert key != ProcessCache.get_key(
+        _Forest(tmp_path, process_path, ["a", "b", "c"], partition_code=[0, 0, 1]), "normalize"
+    )
+    (tmp_path / "rna.counts").mkdir()
+    (tmp_path / "rna.counts" / "data.npy").write_bytes(b"0")
+    assert key != ProcessCache.get_key(_Forest(tmp_path, process_path, ["a", "b", "c"]), "normalize")
+    assert ProcessCache.is_stored_forest(SimpleNamespace(unversioned=True))
+    assert not ProcessCache.is_stored_forest(SimpleNamespace(unversioned=False))
+
+
+def test_process_cache_store_restore_evict(tmp_path):
+    cache = ProcessCache(tmp_path, max_bytes=250)
+    for i in range(3):
+        output_dir = tmp_path / f"run_{i}"
+        output_dir.mkdir()
+        (output_dir / "clusters.tsv").write_text(str(i) * 100)
+        (output_dir / "temp_cell_metadata.tsv").write_text("x")
+        cache.store(f"key_{i}", output_dir)
+        assert cache.restore("key_0", tmp_path / "restored")
+    assert sorted(p.name for p in cache.cache_dir.iterdir()) == ["key_0", "key_2"]
+    assert (tmp_path / "restored" / "clusters.tsv").read_text() == "0" * 100
+    assert not (tmp_path / "restored" / "temp_cell_metadata.tsv").exists()
+    assert not cache.restore("key_1", tmp_path / "restored")
+
+
+def test_process_cache_wrapper_key(tmp_path):
+    process_path = tmp_path / "normalize_min_genes:5"
+    forest = _Forest(tmp_path, process_path, ["a", "b", "c"])
+    ran = []
+    run = process_cache("normalize")(lambda forest: ran.append(True))
+    forest._process_cache_keys = {"normalize": "precomputed"}
+    run(forest)
+    assert ran == [True]
+    output_dir = tmp_path / "outputs"
+    output_dir.mkdir()
+    (output_dir / "clusters.tsv").write_text("0")
+    ProcessCache(tmp_path).store("precomputed", output_dir)
+    run(forest)
+    assert ran == [True] and (process_path / "clusters.tsv").read_text() == "0"
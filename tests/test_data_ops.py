@@ -11,3 +11,115 @@ def test_filter(build_root_fix):
 
 def test_partition(build_root_fix):
     pass
+
+
+def test_groupby(build_root_fix):
+    cf = build_root_fix
+    groups = dict(cf.groupby("sample"))
+    assert sum(len(forest.meta) for forest in groups.values()) == len(cf.meta)
+    for name, forest in groups.items():
+        assert (forest.meta.index == cf.meta.index[cf.meta["sample"] == name]).all()
+        # counts are sliced from the parent's, in the order of the child's `meta`
+        assert (forest.rna.cell_ids.to_numpy() == forest.meta.index.to_numpy()).all()
+
+
+def _append_task(i):
+    from cellforest.templates.BatchMethodsSC import _FORK_STATE
+
+    _FORK_STATE["seen"].append(i)
+    return list(_FORK_STATE["seen"])
+
+
+def test_fork_map():
+    from cellforest.templates.BatchMethodsSC import BatchMethodsSC, _FORK_STATE
+
+    results = BatchMethodsSC._fork_map(_append_task, [1, 2, 3, 4], {"seen": []}, n_workers=2)
+    # each task starts from the parent's state, and results are in task order
+    assert results == [[1], [2], [3], [4]]
+    assert not _FORK_STATE
+
+
+def test_gsea_bulk_kwargs(monkeypatch):
+    import sys
+    from types import ModuleType, SimpleNamespace
+
+    from cellforest.templates.BatchMethodsSC import BatchMethodsSC
+
+    runs = []
+
+    class GSEAGroup:
+        def __init__(self, forest, batch_vars, process_name):
+            self.groups = [("a",), ("b",)]
+            self.group_results_df = len(runs)
+
+        def run_grp(self, grp_vals, **kwargs):
+            runs.append(kwargs)
+
+    module = ModuleType("scgsea.GSEAGroup")
+    module.GSEAGroup = GSEAGroup
+    monkeypatch.setitem(sys.modules, "scgsea", ModuleType("scgsea"))
+    monkeypatch.setitem(sys.modules, "scgsea.GSEAGroup", module)
+    monkeypatch.setattr(BatchMethodsSC, "logger", SimpleNamespace(info=lambda msg: None), raising=False)
+    BatchMethodsSC.gsea_bulk(None, "sample", shuffling=True)
+    assert runs == [{"shuffling": True}] * 2
+    runs.clear()
+    BatchMethodsSC.gsea_bulk_repeat(None, "sample", n_repeat=2)
+    assert runs == [{}, {}, {"no_plot": True}, {"no_plot": True}]
+
+
+def test_meta_parquet(tmp_path):
+    import numpy as np
+    import pandas as pd
+
+    from cellforest.utils.metadata import read_meta, write_meta
+
+    meta = pd.DataFrame(
+        {"sample": ["a b", "c", "a b"], "n_genes": [10, 20, 30]}, index=pd.Index(["x", "y", "z"], name="barcode")
+    )
+    write_meta(meta, tmp_path / "meta.parquet")
+    df = read_meta(tmp_path / "meta.parquet")
+    assert df["sample"].dtype == "category"
+    assert df["sample"].tolist() == ["a_b", "c", "a_b"]
+    assert df.index.tolist() == ["x", "y", "z"]
+    mixed = pd.DataFrame(
+        {"sample": ["a b", "a_b", None], "lane": [1, "2", None], "run": np.array([1, 2, 1], dtype=object)},
+        index=["x", "y", "z"],
+    )
+    write_meta(mixed, tmp_path / "mixed.parquet")
+    df = read_meta(tmp_path / "mixed.parquet")
+    assert df["sample"].cat.categories.tolist() == ["a_b"] and df["sample"].isna().tolist() == [False, False, True]
+    assert df["lane"].tolist()[:2] == ["1", "2"] and df["lane"].isna()["z"]
+    assert df["run"].tolist() == [1, 2, 1]
+    # only the projected columns that exist are read
+    assert read_meta(tmp_path / "meta.parquet", columns=["n_genes", "missing"]).columns.tolist() == ["n_genes"]
+
+
+def test_join_by_position():
+    import pandas as pd
+
+    from cellforest.templates.CellForest import CellForest
+
+    meta = pd.DataFrame({"sample": ["a", "b", "c"]}, index=["x", "y", "z"])
+    clusters = pd.DataFrame({"cluster_id": [2, 1]}, index=["z", "x"])
+    df = CellForest._join_by_position(meta, clusters)
+    assert df["cluster_id"].astype(pd.Int16Dtype()).tolist() == [1, pd.NA, 2]
+    assert "cluster_id" not in meta
+
+
+def test_selection_index():
+    import numpy as np
+    import pandas as pd
+
+    from cellforest.structures.SelectionIndex import SelectionIndex
+
+    meta = pd.DataFrame({"donor": ["b", "a", None, "a", "b"], "condition": ["x", "y", "x", "x", "x"]})
+    index = SelectionIndex(meta)
+    assert index.select({"donor": "a", "condition": "x"}).tolist() == [3]
+    assert len(index.select({"donor": "c"})) == 0
+    groups = index.groups(["donor", "condition"])
+    expected = meta.groupby(["donor", "condition"]).indices
+    assert list(groups) == list(expected)
+    assert all(np.array_equal(groups[k], expected[k]) for k in expected)
+    assert index.take(np.array([0, 4])).select({"donor": "b"}).tolist() == [0, 1]
+    child = index.take(np.array([0, 4]), meta.iloc[[0, 4]].drop(columns="condition"))
+    assert "condition" not in child._codes and child.select({"donor": "b"}).tolist() == [0, 1]
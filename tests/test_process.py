@@ -1,7 +1,24 @@
+import sys
+
+import numpy as np
 import pytest
 import pandas as pd
+from scipy.sparse import csr_matrix
 
 from cellforest import CellForest, Counts
+from cellforest.processes.processes.cluster.snn import find_clusters, order_by_size, snn_graph
+from cellforest.processes.processes.expression.wilcox import find_all_markers, find_markers
+from cellforest.processes.processes.normalize.sctransform import fit_nb, sctransform
+from cellforest.processes.processes.normalize.seurat_default import (
+    filter_counts,
+    get_n_cells,
+    get_n_genes,
+    get_percent_mito,
+    loess,
+    seurat_default_normalize,
+)
+from cellforest.processes.processes.reduce.knn import _self_first, knn_arrays, knn_graph
+from cellforest.processes.processes.reduce.pca import scaled_pca
 from tests.fixtures import *
 import tests
 from tests.test_init import build_root_fix
@@ -24,6 +41,157 @@ def test_normalize_fix(root_path, build_root_fix):
     return cf
 
 
+@pytest.fixture
+def test_normalize_py_fix(root_path, build_root_fix):
+    spec = {
+        "normalize": {
+            "min_genes": 5,
+            "max_genes": 5000,
+            "min_cells": 5,
+            "nfeatures": 30,
+            "perc_mito_cutoff": 20,
+            "method": "seurat_default_py",
+        },
+    }
+    cf = CellForest(root_dir=root_path, spec_dict=spec)
+    cf.process.normalize()
+    return cf
+
+
+def test_normalize_py(test_normalize_py_fix):
+    cf = test_normalize_py_fix
+    rna = Counts.load(cf["normalize"].path_map["rna"])
+    hvf = cf.f["normalize"]["variable_features"]
+    assert hvf["variable"].sum() == 30
+    assert rna.cell_ids.tolist() == cf.f["normalize"]["cell_ids"][0].tolist()
+
+
+def test_seurat_default_py(sample_1):
+    counts = Counts.from_cellranger(sample_1)
+    rna, hvf = seurat_default_normalize(counts, min_genes=5, max_genes=5000, perc_mito_cutoff=0.2, nfeatures=30)
+    kept = counts[rna.cell_ids.tolist()][:, rna.ensgs.tolist()].toarray()
+    expected = np.log1p(kept / kept.sum(axis=1, keepdims=True) * 1e4)
+    assert np.allclose(rna.toarray(), expected)
+    assert hvf["variable"].sum() == 30
+    assert (hvf["variance_standardized"][hvf["variable"]].min() >= hvf["variance_standardized"][~hvf["variable"]]).all()
+    qc = pd.DataFrame({"n_genes": get_n_genes(counts), "percent_mito": get_percent_mito(counts)}, index=counts.cell_ids)
+    filtered = filter_counts(counts, 5, 5000, 0.2, qc=qc.iloc[::-1])
+    assert filtered.cell_ids.tolist() == rna.cell_ids.tolist() and filtered.shape[1] == counts.shape[1]
+    assert (get_n_cells(filter_counts(counts, 5, 5000, 0.2, min_cells=5)) > 0).all()
+
+
+def test_fit_nb():
+    rng = np.random.default_rng(0)
+    log_umi = rng.normal(3.5, 0.2, 4000)
+    theta = np.array([1.0, 5.0, 20.0])
+    mu = np.exp(np.log(5) + np.log(10) * (log_umi - 3.5))[:, None] * np.ones(3)
+    y = rng.negative_binomial(theta, theta / (theta + mu)).astype(float)
+    params = fit_nb(y, log_umi)
+    assert np.allclose(params[:, 1], np.log(10), atol=0.15)
+    assert np.allclose(np.log10(params[:, 2]), np.log10(theta), atol=0.15)
+
+
+def test_sctransform(sample_1, tmp_path):
+    counts = Counts.from_cellranger(sample_1)
+    corrected, model = sctransform(counts, tmp_path / "residuals.npy", nfeatures=30, n_workers=2)
+    residuals = np.load(tmp_path / "residuals.npy")
+    assert residuals.dtype == np.float32
+    assert residuals.shape == (counts.shape[0], 30)
+    assert model["variable"].sum() == 30
+    assert corrected.shape == (counts.shape[0], len(model))
+    assert (corrected.data >= 0).all()
+    top = model["residual_variance"][model["variable"]].min()
+    assert (top >= model["residual_variance"][~model["variable"]]).all()
+    assert residuals.flags.f_contiguous
+
+
+def test_loess():
+    x = np.random.default_rng(0).normal(size=1000)
+    y = 1 + 2 * x - 0.5 * x**2
+    for surface in ["interpolate", "direct"]:
+        assert np.allclose(loess(x, y, surface=surface), y)
+
+
+def test_scaled_pca():
+    rng = np.random.default_rng(0)
+    rates = np.exp(rng.normal(size=(500, 4)) @ rng.normal(size=(4, 80)) * 0.5 - 1)
+    matrix = np.log1p(rng.poisson(rates).astype(float))
+    embeddings, loadings, stdev = scaled_pca(csr_matrix(matrix), n_components=4)
+    scaled = (matrix - matrix.mean(axis=0)) / matrix.std(axis=0, ddof=1)
+    u, s, vt = np.linalg.svd(scaled, full_matrices=False)
+    assert np.allclose(stdev, s[:4] / np.sqrt(499))
+    assert np.allclose(np.abs(embeddings), np.abs(u[:, :4] * s[:4]), atol=1e-3)
+    assert np.allclose(np.abs(loadings), np.abs(vt[:4].T), atol=1e-4)
+
+
+def test_knn_graph():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(300, 5))
+    embeddings[1] = embeddings[0]
+    indices, distances = knn_arrays(knn_graph(embeddings, k=10, exact=True))
+    dist = np.linalg.norm(embeddings[:, None] - embeddings[None], axis=2)
+    assert (indices[:, 0] == np.arange(300)).all()
+    assert indices[0, 1] == 1 and indices[1, 1] == 0
+    assert np.allclose(distances, np.sort(dist, axis=1)[:, :10])
+    assert np.allclose(np.take_along_axis(dist, indices, axis=1), distances)
+    approx_indices, approx_distances = knn_arrays(knn_graph(embeddings, k=10))
+    assert (approx_indices[:, 0] == np.arange(300)).all()
+    recall = np.mean([len(set(a) & set(b)) / 10 for a, b in zip(approx_indices, indices)])
+    assert recall > 0.9
+
+
+def test_knn_graph_fallback(monkeypatch):
+    embeddings = np.random.default_rng(0).normal(size=(100, 5))
+    monkeypatch.setitem(sys.modules, "pynndescent", None)
+    fallback = knn_graph(embeddings, k=10)
+    assert (fallback != knn_graph(embeddings, k=10, exact=True)).nnz == 0
+    indices = np.array([[5, 0, 6], [2, 3, 7]])
+    distances = np.array([[0.0, 0.0, 2.0], [1.0, 2.0, 3.0]])
+    indices, distances = _self_first(indices, distances)
+    assert indices.tolist() == [[0, 5, 6], [1, 2, 3]] and distances.tolist() == [[0, 0, 2], [0, 1, 2]]
+
+
+def test_snn_graph():
+    rng = np.random.default_rng(0)
+    embeddings = np.concatenate([rng.normal(size=(100, 5)), rng.normal(10, size=(60, 5))])
+    knn = knn_graph(embeddings, k=10, exact=True)
+    snn = snn_graph(knn).toarray()
+    indices, _ = knn_arrays(knn)
+    neighbors = [set(row) for row in indices]
+    i, j = 3, indices[3, 1]
+    shared = len(neighbors[i] & neighbors[j])
+    assert np.isclose(snn[i, j], shared / (20 - shared))
+    assert np.allclose(snn, snn.T)
+    assert (np.diag(snn) == 0).all()
+    assert (snn[:100, 100:] == 0).all()
+    assert (order_by_size(np.array([2, 0, 0, 1, 1, 1])) == [2, 1, 1, 0, 0, 0]).all()
+    pytest.importorskip("igraph")
+    clusterings = find_clusters(snn_graph(knn), [0.1, 0.8])
+    assert all(len(np.unique(labels[:100])) < len(np.unique(labels)) for labels in clusterings)
+
+
+def test_find_all_markers():
+    from scipy.stats import mannwhitneyu
+
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, 3, 300)
+    rates = rng.gamma(1, 1, (1, 40)) * (1 + groups[:, None] * (np.arange(40) < 10))
+    matrix = np.log1p(rng.poisson(rates).astype(float))
+    features = pd.DataFrame({"ensgs": [f"E{i}" for i in range(40)], "genes": [f"G{i}" for i in range(40)]})
+    counts = Counts(csr_matrix(matrix), pd.Series([f"c{i}" for i in range(300)]), features)
+    markers = find_all_markers(counts, groups, logfc_thresh=0, min_pct=0)
+    assert len(markers) == 120
+    for _, row in markers.sample(20, random_state=0).iterrows():
+        in_group, gene = groups == row["cluster"], int(row["gene"][1:])
+        expected = mannwhitneyu(matrix[in_group, gene], matrix[~in_group, gene], method="asymptotic")
+        assert np.isclose(row["p_val"], expected.pvalue, rtol=1e-10)
+        log_fc = np.log1p(np.expm1(matrix[in_group, gene]).mean()) - np.log1p(np.expm1(matrix[~in_group, gene]).mean())
+        assert np.isclose(row["avg_logFC"], log_fc)
+    filtered = find_all_markers(counts, groups, logfc_thresh=0.25)
+    assert (filtered["avg_logFC"].abs() >= 0.25).all()
+    assert set(find_markers(counts, groups, 2, 0).index) <= set(features["genes"])
+
+
 def test_logging(test_normalize_fix):
     # TODO: QUEUE
     pass
@@ -1,4 +1,15 @@
+import os
+import tracemalloc
+
+import numpy as np
+from scipy import io
+from scipy.sparse import random as sparse_random
+
 from cellforest import Counts
+from cellforest.structures.CountsStoreWriter import CountsStoreWriter
+from cellforest.utils.cellranger import MtxQC
+from cellforest.utils.cellranger.DataMerge import DataMerge
+from cellforest.utils.cellranger.matrix_market import read_mtx, write_mtx
 from tests.fixtures import *
 
 
@@ -24,11 +35,134 @@ def test_from_cellranger_gz(sample_1_gz):
     return rna
 
 
+def test_read_mtx(sample_1_gz, tmp_path):
+    filepath = sample_1_gz / "matrix.mtx.gz"
+    expected = io.mmread(str(filepath)).T.tocsr()
+    for n_workers in [None, 2]:
+        matrix = read_mtx(filepath, block_size=1024, n_workers=n_workers)
+        assert matrix.shape == expected.shape
+        assert (matrix != expected).nnz == 0
+    # entries not sorted by cell
+    unsorted_path = tmp_path / "matrix.mtx"
+    io.mmwrite(str(unsorted_path), expected.T.tocsr())
+    assert (read_mtx(unsorted_path, block_size=1024) != expected).nnz == 0
+
+
+def test_read_mtx_qc(sample_1_gz):
+    counts = Counts.from_cellranger(sample_1_gz)
+    qc = MtxQC()
+    Counts.from_cellranger(sample_1_gz, qc=qc, n_workers=2)
+    matrix = counts._matrix
+    mito = counts.genes.str.contains("^MT-").to_numpy()
+    assert np.allclose(qc.n_counts, np.asarray(matrix.sum(axis=1)).ravel())
+    assert np.array_equal(qc.n_genes, np.diff(matrix.indptr))
+    assert np.array_equal(qc.n_cells, np.bincount(matrix.indices, minlength=matrix.shape[1]))
+    expected_mito = np.asarray(matrix[:, mito].sum(axis=1)).ravel() / np.asarray(matrix.sum(axis=1)).ravel()
+    assert np.allclose(qc.percent_mito, expected_mito, equal_nan=True)
+    assert qc.cell_metrics.columns.tolist() == ["n_counts", "n_genes", "percent_mito"]
+
+
+def test_write_mtx(test_from_cellranger_fix, tmp_path):
+    matrix = test_from_cellranger_fix._matrix
+    for filename, n_workers in [("matrix.mtx", None), ("matrix.mtx.gz", 2)]:
+        write_mtx(tmp_path / filename, matrix, rows_per_chunk=16, n_workers=n_workers)
+        assert (io.mmread(str(tmp_path / filename)).T != matrix).nnz == 0
+        assert (read_mtx(tmp_path / filename) != matrix).nnz == 0
+
+
+def test_to_cellranger(test_from_cellranger_fix, tmp_path):
+    rna = test_from_cellranger_fix
+    rna.to_cellranger(tmp_path, n_workers=2)
+    assert sorted(os.listdir(tmp_path)) == ["barcodes.tsv.gz", "features.tsv.gz", "matrix.mtx.gz"]
+    exported = Counts.from_cellranger(tmp_path)
+    assert np.array_equal(exported.toarray(), rna.toarray())
+    assert exported.cell_ids.tolist() == rna.cell_ids.tolist()
+    assert exported.features.equals(rna.features)
+    assert "mode" not in rna.features
+
+
+@pytest.fixture
+def test_save_store_fix(test_from_cellranger_fix, counts_store_path):
+    test_from_cellranger_fix.save(counts_store_path)
+    return counts_store_path
+
+
 def test_load(test_save_fix):
     rna = Counts.load(test_save_fix)
     return rna
 
 
+def test_load_store(test_from_cellranger_fix, test_save_store_fix):
+    rna = test_from_cellranger_fix
+    for mmap in [False, True]:
+        loaded = Counts.load(test_save_store_fix, mmap=mmap)
+        assert loaded.shape == rna.shape
+        assert np.array_equal(loaded.toarray(), rna.toarray())
+        assert loaded.cell_ids.tolist() == rna.cell_ids.tolist()
+        assert loaded.features.equals(rna.features)
+    loaded = Counts.load(test_save_store_fix, mmap=True)
+    cells = rna.cell_ids[[3, 1]].tolist()
+    assert np.array_equal(loaded[cells].toarray(), rna[cells].toarray())
+
+
+def test_concatenate_join(test_from_cellranger_fix):
+    rna = test_from_cellranger_fix
+    lane_1, lane_2 = rna[:100, :60], rna[100:, 30:][:, ::-1]
+    outer = Counts.concatenate([lane_1, lane_2])
+    assert outer.ensgs.tolist() == rna.ensgs[:60].tolist() + rna.ensgs[60:][::-1].tolist()
+    assert np.array_equal(outer[:, rna.ensgs.tolist()].toarray()[:100, :60], rna[:100, :60].toarray())
+    assert np.array_equal(outer[100:, rna.ensgs[30:].tolist()].toarray(), rna[100:, 30:].toarray())
+    assert outer[100:, rna.ensgs[:30].tolist()].nnz == 0
+    inner = Counts.concatenate([lane_1, lane_2], join="inner")
+    assert inner.ensgs.tolist() == rna.ensgs[30:60].tolist()
+    assert np.array_equal(inner.toarray(), rna[:, 30:60].toarray())
+
+
+def test_reindex_features(test_from_cellranger_fix, sample_1_v2):
+    rna = test_from_cellranger_fix
+    reference = rna.features[::-1].reset_index(drop=True)
+    reindexed = Counts.from_cellranger(sample_1_v2).reindex_features(reference)
+    assert reindexed.ensgs.tolist() == reference["ensgs"].tolist()
+    assert np.array_equal(reindexed.toarray(), rna.toarray()[:, ::-1])
+    stacked = rna.vstack(reindexed)
+    assert np.array_equal(stacked[rna.shape[0] :].toarray(), rna.toarray())
+
+
+def test_store_writer(test_from_cellranger_fix, tmp_path):
+    rna = test_from_cellranger_fix
+    with CountsStoreWriter(tmp_path / "rna.counts") as writer:
+        writer.append(rna[:120])
+        writer.append(rna[120:])
+    loaded = Counts.load(tmp_path / "rna.counts", mmap=True)
+    assert writer.rows_per_block == [120, rna.shape[0] - 120]
+    assert np.array_equal(loaded.toarray(), rna.toarray())
+    assert loaded.cell_ids.tolist() == rna.cell_ids.tolist()
+    assert loaded.indices.dtype == loaded.indptr.dtype == np.int32
+    with CountsStoreWriter(tmp_path / "wide.counts") as writer:
+        writer._get_index_dtype = lambda *args: np.dtype(np.int64)
+        writer._WIDEN_CHUNK_SIZE = 1000
+        writer.append(rna)
+    indices, indptr = [np.load(tmp_path / "wide.counts" / f"{name}.npy") for name in ["indices", "indptr"]]
+    assert indices.dtype == indptr.dtype == np.int64
+    loaded = Counts.load(tmp_path / "wide.counts", mmap=True)
+    assert np.array_equal(loaded.toarray(), rna.toarray())
+    with pytest.raises(ValueError):
+        with CountsStoreWriter(tmp_path / "partial.counts") as writer:
+            writer.append(rna)
+            writer.append(rna[:, :10])
+    assert not (tmp_path / "partial.counts").exists()
+
+
+def test_merge_rna(sample_paths):
+    expected = Counts.concatenate([Counts.from_cellranger(path) for path in sample_paths])
+    for n_workers in [None, 2]:
+        rna, meta = DataMerge.merge_assay(sample_paths, "rna", n_workers=n_workers)
+        assert np.array_equal(rna.toarray(), expected.toarray())
+        assert rna.cell_ids.tolist() == expected.cell_ids.tolist()
+        assert (meta.index == rna.cell_ids).all()
+        assert np.array_equal(meta["n_genes"].to_numpy(), np.diff(expected.indptr))
+
+
 def test_concatenate(test_from_cellranger_fix):
     rna = test_from_cellranger_fix[:50, :50]
     assert rna.append(rna).shape[0] == 100
@@ -60,3 +194,47 @@ def test_from_cellranger(test_from_cellranger_fix):
 
 def test_save(test_save_fix):
     pass
+
+
+def test_load_store_cells(test_from_cellranger_fix, test_save_store_fix):
+    rna = test_from_cellranger_fix
+    cells = rna.cell_ids[[7, 2, 5]].tolist()
+    subset = Counts.load(test_save_store_fix, cells=cells + ["MISSING-1"])
+    assert subset.cell_ids.tolist() == cells
+    assert np.array_equal(subset.toarray(), rna[cells].toarray())
+
+
+def test_slice_label_index(test_from_cellranger_fix):
+    rna = test_from_cellranger_fix
+    duplicated = rna.genes[rna.genes.duplicated()].iloc[0]
+    sliced = rna[:, duplicated]
+    assert sliced.shape[1] == (rna.genes == duplicated).sum()
+    assert (sliced.genes == duplicated).all()
+    genes = rna.genes[[9, 3]].tolist()
+    assert rna[:, genes].genes.tolist() == genes
+    cells = rna[:10]
+    assert cells._get_label_index("genes") is rna._get_label_index("genes")
+
+
+def test_slice_memory():
+    n_cells, n_genes = 20000, 1000
+    matrix = sparse_random(n_cells, n_genes, density=0.05, format="csr", random_state=0)
+    cell_ids = pd.DataFrame([f"CELL{i}-1" for i in range(n_cells)])
+    features = pd.DataFrame({0: [f"ENSG{i:011d}" for i in range(n_genes)], 1: [f"GENE{i}" for i in range(n_genes)]})
+    rna = Counts(matrix, cell_ids, features)
+    rng = np.random.default_rng(0)
+    cells_pos = rng.choice(n_cells, 200, replace=False)
+    genes_pos = rng.choice(n_genes, 100, replace=False)
+    cells = rna.cell_ids.values[cells_pos].tolist()
+    genes = rna.genes.values[genes_pos].tolist()
+    _ = rna[cells[0], genes[0]]  # build label indices, which are kept for the lifetime of `rna`
+    tracemalloc.start()
+    sliced = rna[cells, genes]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert np.array_equal(sliced.toarray(), matrix[cells_pos][:, genes_pos].toarray())
+    # allocation is bounded by the nonzeros of the selected cells, not the full matrix
+    rows_nbytes = sum(x.nbytes for x in [rna[cells].data, rna[cells].indices, rna[cells].indptr])
+    full_nbytes = sum(x.nbytes for x in [rna.data, rna.indices, rna.indptr])
+    assert peak < 2 * rows_nbytes
+    assert peak < full_nbytes / 20